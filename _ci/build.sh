@@ -1,26 +1,64 @@
 #!/bin/bash
 #
-# Script to build python-ldap and/or related python packages for lambda.
+# Builds the python dependency layer of a lambda function.
 #
-# Requires two arguments: package and version.
+#   _ci/build.sh [--slim] <layer zip> <function source dir> <package>...
 #
-# You can use it to build inside an Amazon Linux AMI (default) or with docker
-# with --docker (you need docker installed and network access to reach lambci's
-# docker-lambda image).
+# e.g. the python-ldap layer of the ldap query function:
 #
-# Defaults to building both python2.7 and python3.6 packages. If you only want
-# one of them use either --py2-only or --py3-only.
+#   _ci/build.sh --slim modules/lambda_functions/ldap_query/lambda_layer_payload.zip \
+#       modules/lambda_functions/ldap_query/src python-ldap
 #
-
-# requirements..
+# and the slack SDK layer of the slack notifier:
+#
+#   _ci/build.sh --slim modules/lambda_functions/slack_notifier/lambda_layer_payload.zip \
+#       modules/lambda_functions/slack_notifier "slackclient>=2,<3"
+#
+# Build inside an Amazon Linux AMI or the lambci/lambda:build-python3.7
+# docker image so the extension modules (and with --slim the bytecode)
+# match the python3.7 runtime.
+#
+# With --slim the layer only holds the packages the function and the
+# common layer import, extension modules are stripped and every module is
+# precompiled to bytecode that replaces its source (see slim_package.py).
 #
 
-sudo yum install python-devel openldap-devel gcc
-layer_path="/$(pwd)/lambda-package/python/lib/python3.7/site-packages/"
+set -e
+
+SLIM=0
+if [ "$1" == "--slim" ]; then
+    SLIM=1
+    shift
+fi
+if [ $# -lt 3 ]; then
+    sed -n '3,23p' "$0"
+    exit 1
+fi
+
+CI_DIR="$(cd "$(dirname "$0")" && pwd)"
+REPO_DIR="$(dirname "$CI_DIR")"
+OUTPUT="$(realpath -m "$1")"
+SOURCE="$(realpath "$2")"
+shift 2
+
+sudo yum install -y python3-devel openldap-devel gcc
+
+BUILD_DIR="$(mktemp -d)"
+trap 'rm -rf "$BUILD_DIR"' EXIT
+layer_path="$BUILD_DIR/python/lib/python3.7/site-packages"
 mkdir -p "$layer_path"
-pip3 install ldap-python -t "$layer_path"
-# this is going to create the zip in the wrong dir. need to update this..
-zip -r /"$(pwd)"/lambda-package.zip "$layer_path" -x "setuptools*/*" "pkg_resources/*" "easy_install*"
+pip3 install --target "$layer_path" "$@"
+
+rm -f "$OUTPUT"
+if [ "$SLIM" == 1 ]; then
+    python3.7 "$CI_DIR/slim_package.py" "$OUTPUT" \
+        --site-packages "$layer_path" \
+        --entry "$SOURCE" \
+        --entry "$REPO_DIR/modules/lambda_layers/common/layer/python"
+else
+    (cd "$BUILD_DIR" && zip -r "$OUTPUT" python \
+        -x "*/setuptools*/*" "*/pkg_resources/*" "*/easy_install*")
+fi
 
 
 
@@ -0,0 +1,216 @@
+"""
+Builds a slim lambda layer from an installed set of packages.
+
+    python3.7 _ci/slim_package.py lambda_layer_payload.zip \\
+        --site-packages build/site-packages \\
+        --entry modules/lambda_functions/ldap_query/src \\
+        --entry modules/lambda_layers/common/layer/python
+
+Only the top level packages the function can import are kept: the imports
+of the modules under each --entry are followed (including those deferred
+into functions) and anything in site-packages they never reach is left
+out, as are the packages the lambda runtime already provides, package
+metadata and test suites. Extension modules are stripped of their symbols
+and every module is replaced by its bytecode, compiled ahead of time so
+the runtime neither compiles it on a cold start nor tries to write a
+__pycache__ to the read only layer.
+
+Bytecode only loads on the python version that compiled it, so the script
+must run on the function's runtime version (python3.7, see --runtime).
+"""
+import argparse
+import modulefinder
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+# installed with the lambda python runtime, never bundled
+RUNTIME_PACKAGES = {
+    "boto3", "botocore", "s3transfer", "jmespath", "dateutil", "six",
+    "urllib3", "pip", "setuptools", "pkg_resources", "easy_install",
+    "wheel", "_distutils_hack"
+}
+# directories of tests and tooling inside packages
+UNUSED_DIRS = {"tests", "test", "testing", "__pycache__"}
+# sources of extension modules and type stubs
+UNUSED_SUFFIXES = (".c", ".cpp", ".h", ".pyx", ".pxd", ".pyi")
+# zip entries get a fixed timestamp so the same input builds the same
+# layer and terraform only publishes a new version when it changed
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def get_top_level_name(path, site_packages):
+    """Returns the top level package or module path belongs to"""
+    relative = os.path.relpath(path, site_packages)
+    if relative.startswith(os.pardir):
+        return None
+    # _ldap.cpython-37m-x86_64-linux-gnu.so -> _ldap
+    return relative.split(os.sep)[0].split(".")[0]
+
+
+def find_imported(entries, site_packages, keep=()):
+    """
+    Returns the top level names in site_packages that the modules of
+    entries import, directly or through each other.
+    """
+    finder = modulefinder.ModuleFinder(
+        path=list(entries) + [site_packages] + sys.path[1:],
+        excludes=list(RUNTIME_PACKAGES))
+    for entry in entries:
+        for root, dirs, files in os.walk(entry):
+            dirs[:] = [name for name in dirs if name not in UNUSED_DIRS]
+            for name in sorted(files):
+                if name.endswith(".py"):
+                    finder.run_script(os.path.join(root, name))
+    imported = set(keep)
+    for module in finder.modules.values():
+        if module.__file__:
+            name = get_top_level_name(module.__file__, site_packages)
+            if name:
+                imported.add(name)
+    return imported
+
+
+def shake(site_packages, imported):
+    """Removes what isn't imported from site_packages"""
+    removed = []
+    for name in sorted(os.listdir(site_packages)):
+        path = os.path.join(site_packages, name)
+        top_level = name.split(".")[0]
+        # *.libs hold the shared libraries vendored by manylinux wheels
+        if name.endswith(".libs") or (
+                top_level in imported and top_level not in RUNTIME_PACKAGES
+                and not name.endswith((".dist-info", ".egg-info"))):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        removed.append(name)
+    for root, dirs, files in os.walk(site_packages):
+        for name in [name for name in dirs if name in UNUSED_DIRS]:
+            shutil.rmtree(os.path.join(root, name))
+            dirs.remove(name)
+        for name in files:
+            if name.endswith(UNUSED_SUFFIXES):
+                os.remove(os.path.join(root, name))
+    return removed
+
+
+def strip_extensions(site_packages):
+    """Strips the symbols of the extension modules, returns bytes saved"""
+    strip = shutil.which("strip")
+    if strip is None:
+        print("strip not found, extension modules are left as they are")
+        return 0
+    saved = 0
+    for root, _, files in os.walk(site_packages):
+        for name in files:
+            if ".so" not in name:
+                continue
+            path = os.path.join(root, name)
+            size = os.path.getsize(path)
+            subprocess.run([strip, "--strip-unneeded", path], check=True)
+            saved += size - os.path.getsize(path)
+    return saved
+
+
+def compile_modules(site_packages, install_dir):
+    """
+    Replaces every module by its bytecode, next to where the source was so
+    it is imported without the source. Unchecked hash based pycs are never
+    compared to a source that isn't there, tracebacks show the path the
+    module is installed to on lambda.
+    """
+    compiled = 0
+    unchecked = py_compile.PycInvalidationMode.UNCHECKED_HASH
+    for root, _, files in os.walk(site_packages):
+        for name in files:
+            if not name.endswith(".py"):
+                continue
+            path = os.path.join(root, name)
+            py_compile.compile(
+                path, cfile=path + "c",
+                dfile=os.path.join(
+                    install_dir, os.path.relpath(path, site_packages)),
+                doraise=True, invalidation_mode=unchecked)
+            os.remove(path)
+            compiled += 1
+    return compiled
+
+
+def write_zip(output, site_packages, prefix):
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as bundle:
+        for root, dirs, files in os.walk(site_packages):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                arcname = os.path.join(
+                    prefix, os.path.relpath(path, site_packages))
+                info = zipfile.ZipInfo(arcname, ZIP_DATE_TIME)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = (os.stat(path).st_mode & 0o777) << 16
+                with open(path, "rb") as source:
+                    bundle.writestr(info, source.read())
+
+
+def get_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path) for name in files)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("output", help="layer zip to write")
+    parser.add_argument(
+        "--site-packages", required=True,
+        help="directory the layer's packages were installed to, e.g. with "
+             "pip install --target")
+    parser.add_argument(
+        "--entry", action="append", default=[],
+        help="directory of the function's own modules, may be repeated. "
+             "Without any, every installed package is kept")
+    parser.add_argument(
+        "--keep", action="append", default=[],
+        help="top level package to keep although no entry imports it, "
+             "e.g. one that is imported dynamically")
+    parser.add_argument("--prefix", default="python",
+                        help="directory of the packages in the zip")
+    parser.add_argument("--runtime", default="python3.7",
+                        help="lambda runtime the layer is built for")
+    args = parser.parse_args(argv)
+
+    version = f"python{sys.version_info[0]}.{sys.version_info[1]}"
+    if version != args.runtime:
+        parser.error(
+            f"the bytecode of {version} doesn't load on {args.runtime}, "
+            f"run the script with {args.runtime}")
+
+    with tempfile.TemporaryDirectory() as build:
+        site_packages = os.path.join(build, "site-packages")
+        shutil.copytree(args.site_packages, site_packages, symlinks=True)
+        installed = get_size(site_packages)
+        if args.entry:
+            imported = find_imported(args.entry, site_packages, args.keep)
+            removed = shake(site_packages, imported)
+            print(f"Removed {len(removed)} unused entries: "
+                  f"{', '.join(removed)}")
+        saved = strip_extensions(site_packages)
+        print(f"Stripped {saved // 1024} KiB of symbols")
+        # layers are extracted to /opt
+        compiled = compile_modules(
+            site_packages, os.path.join("/opt", args.prefix))
+        print(f"Compiled {compiled} modules")
+        write_zip(args.output, site_packages, args.prefix)
+        print(f"Wrote {args.output}: {get_size(site_packages) // 1024} KiB "
+              f"unpacked, {installed // 1024} KiB installed, "
+              f"{os.path.getsize(args.output) // 1024} KiB zipped")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
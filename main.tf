@@ -9,6 +9,12 @@ module "api_gateway" {
   slack_event_listener_lambda_name    = module.slack_event_listener.function_name
 }
 
+module "common_layer" {
+  source = "./modules/lambda_layers/common"
+
+  project_name = var.project_name
+}
+
 module "slack_event_listener" {
   source = "./modules/lambda_functions/slack_listener"
 
@@ -16,16 +22,26 @@ module "slack_event_listener" {
   artifacts_bucket_name = aws_s3_bucket.artifacts.id
   slack_api_token       = var.slack_api_token
   slack_signing_secret  = var.slack_signing_secret
+  approver_group_dn     = var.approver_group_dn
   step_function_arns    = list(aws_sfn_state_machine.ldap_maintenance.id)
   api_gw_role_arn       = module.api_gateway.api_gw_role_arn
 
+  slack_signing_secret_ssm_key = var.slack_signing_secret_ssm_key
+
   slack_listener_api_endpoint_arn = module.api_gateway.slack_listener_api_endpoint_arn
 
+  common_layer_arn  = module.common_layer.layer_arn
+  metrics_namespace = var.metrics_namespace
+  profiler          = var.profiler
+  trace_exporter    = var.trace_exporter
+
   log_level = var.log_level
 }
 
 locals {
   svc_user_dn = "CN=${var.svc_user_dn},CN=Users,${var.domain_base_dn}"
+  # the directory of the function's environment when none are listed
+  directories = length(var.directories) > 0 ? var.directories : [{ name = "" }]
 }
 
 module "ldap_query_lambda" {
@@ -34,13 +50,32 @@ module "ldap_query_lambda" {
   project_name          = var.project_name
   artifacts_bucket_name = aws_s3_bucket.artifacts.id
   ldaps_url             = var.ldaps_url
+  ldap_srv_domain       = var.ldap_srv_domain
   domain_base_dn        = var.domain_base_dn
   filter_prefixes       = var.filter_prefixes
   svc_user_dn           = var.svc_user_dn
   svc_user_pwd_ssm_key  = var.svc_user_pwd_ssm_key
+  directory_ssm_keys    = compact([for directory in var.directories : lookup(directory, "ssm_key", "")])
   vpc_id                = var.vpc_id
+  approver_group_dn     = var.approver_group_dn
 
-  log_level = var.log_level
+  common_layer_arn  = module.common_layer.layer_arn
+  metrics_namespace = var.metrics_namespace
+  profiler          = var.profiler
+  trace_exporter    = var.trace_exporter
+
+  shard_strategy     = var.shard_strategy
+  shard_count        = var.shard_count
+  classify_workers   = var.classify_workers
+  search_connections = var.search_connections
+  memory_size        = var.ldap_query_memory_size
+
+  disable_rate             = var.disable_rate
+  disable_max_concurrency  = var.disable_max_concurrency
+  remove_group_memberships = var.remove_group_memberships
+
+  log_level       = var.log_level
+  log_sample_rate = var.log_sample_rate
 }
 
 module "slack_notifier" {
@@ -53,6 +88,14 @@ module "slack_notifier" {
   sfn_activity_arn      = aws_sfn_activity.account_deactivation_approval.id
   invoke_base_url       = module.api_gateway.invoke_url
 
+  post_user_details      = var.post_user_details
+  user_details_max_pages = var.user_details_max_pages
+
+  common_layer_arn  = module.common_layer.layer_arn
+  metrics_namespace = var.metrics_namespace
+  profiler          = var.profiler
+  trace_exporter    = var.trace_exporter
+
   log_level = var.log_level
 }
 
@@ -63,6 +106,11 @@ module "dynamodb_cleanup" {
   dynamodb_table_name   = var.dynamodb_table_name
   artifacts_bucket_name = aws_s3_bucket.artifacts.id
 
+  common_layer_arn  = module.common_layer.layer_arn
+  metrics_namespace = var.metrics_namespace
+  profiler          = var.profiler
+  trace_exporter    = var.trace_exporter
+
   log_level = var.log_level
 }
 
@@ -74,7 +122,12 @@ resource "random_string" "this" {
 }
 
 locals {
-  object_prefixes = ["user_expiration_table", "slack-response"]
+  artifact_prefixes = ["user_expiration_table", "user_expiration_diff", "scan_index", "slack-response", "approvers", "profiles", "shards", "disable_checkpoints", "disabled_users"]
+  # the artifacts of named directories are kept under their name
+  directory_names = compact([for directory in var.directories : lookup(directory, "name", "")])
+  object_prefixes = concat(local.artifact_prefixes, [
+    for pair in setproduct(local.directory_names, local.artifact_prefixes) : join("/", pair)
+  ])
 }
 
 resource "aws_s3_bucket" "artifacts" {
@@ -130,6 +183,7 @@ resource "aws_s3_bucket_policy" "artifacts" {
         "Action": [
             "s3:GetObject",
             "s3:PutObject",
+            "s3:PutObjectTagging",
             "s3:DeleteObject"
         ],
         "Resource": "${aws_s3_bucket.artifacts.arn}/*"
@@ -189,18 +243,125 @@ resource "aws_sfn_state_machine" "ldap_maintenance" {
   definition = <<EOF
 {
   "Comment": "Ldap account deactivation manager",
-  "StartAt": "run_ldap_query",
+  "StartAt": "list_directories",
   "States": {
 
-    "run_ldap_query": {
-    "Type": "Task",
-    "Resource": "arn:aws:states:::lambda:invoke",
+    "list_directories": {
+    "Type": "Pass",
+    "Result": ${jsonencode(local.directories)},
+    "ResultPath": "$.directories",
+    "Next": "scan_directories"
+    },
+
+    "scan_directories": {
+    "Type": "Map",
+    "ItemsPath": "$.directories",
+    "MaxConcurrency": ${var.directory_concurrency},
     "Parameters": {
-      "FunctionName": "${module.ldap_query_lambda.function_arn}",
-      "Payload": {
-        "Input": {"action": "query"}
+      "directory.$": "$$.Map.Item.Value"
+    },
+    "Iterator": {
+      "StartAt": "plan_ldap_query",
+      "States": {
+
+        "plan_ldap_query": {
+          "Type": "Task",
+          "Resource": "arn:aws:states:::lambda:invoke",
+          "Parameters": {
+            "FunctionName": "${module.ldap_query_lambda.function_arn}",
+            "Payload": {
+              "Input": {
+                "action": "plan",
+                "directory.$": "$.directory"
+              },
+              "execution_id.$": "$$.Execution.Id",
+              "trace": {
+                "state.$": "$$.State.Name",
+                "entered.$": "$$.State.EnteredTime"
+              }
+            }
+          },
+          "ResultSelector": {
+            "run_id.$": "$.Payload.run_id",
+            "shards.$": "$.Payload.shards"
+          },
+          "ResultPath": "$.plan",
+          "Next": "scan_ldap_shards"
+        },
+
+        "scan_ldap_shards": {
+          "Type": "Map",
+          "ItemsPath": "$.plan.shards",
+          "MaxConcurrency": ${var.shard_concurrency},
+          "Parameters": {
+            "shard.$": "$$.Map.Item.Value",
+            "run_id.$": "$.plan.run_id",
+            "directory.$": "$.directory"
+          },
+          "Iterator": {
+            "StartAt": "scan_ldap_shard",
+            "States": {
+              "scan_ldap_shard": {
+                "Type": "Task",
+                "Resource": "arn:aws:states:::lambda:invoke",
+                "Parameters": {
+                  "FunctionName": "${module.ldap_query_lambda.function_arn}",
+                  "Payload": {
+                    "Input": {
+                      "action": "scan-shard",
+                      "shard.$": "$.shard",
+                      "run_id.$": "$.run_id",
+                      "directory.$": "$.directory"
+                    },
+                    "execution_id.$": "$$.Execution.Id",
+                    "trace": {
+                      "state.$": "$$.State.Name",
+                      "entered.$": "$$.State.EnteredTime"
+                    }
+                  }
+                },
+                "OutputPath": "$.Payload",
+                "Retry": [
+                  {
+                    "ErrorEquals": ["States.TaskFailed"],
+                    "IntervalSeconds": 5,
+                    "MaxAttempts": 2,
+                    "BackoffRate": 2
+                  }
+                ],
+                "End": true
+              }
+            }
+          },
+          "ResultPath": "$.shard_results",
+          "Next": "merge_ldap_shards"
+        },
+
+        "merge_ldap_shards": {
+          "Type": "Task",
+          "Resource": "arn:aws:states:::lambda:invoke",
+          "Parameters": {
+            "FunctionName": "${module.ldap_query_lambda.function_arn}",
+            "Payload": {
+              "Input": {
+                "action": "merge",
+                "run_id.$": "$.plan.run_id",
+                "shards.$": "$.shard_results",
+                "directory.$": "$.directory"
+              },
+              "execution_id.$": "$$.Execution.Id",
+              "trace": {
+                "state.$": "$$.State.Name",
+                "entered.$": "$$.State.EnteredTime"
+              }
+            }
+          },
+          "OutputPath": "$.Payload",
+          "End": true
+        }
       }
     },
+    "ResultPath": "$.scans",
     "Next": "wait_for_manual_approval"
     },
 
@@ -211,9 +372,15 @@ resource "aws_sfn_state_machine" "ldap_maintenance" {
             "FunctionName": "${module.slack_notifier.function_name}",
             "Payload":{
                "event.$": "$",
-               "token.$": "$$.Task.Token"
+               "token.$": "$$.Task.Token",
+               "execution_id.$": "$$.Execution.Id",
+               "trace": {
+                 "state.$": "$$.State.Name",
+                 "entered.$": "$$.State.EnteredTime"
+               }
             }
       },
+      "ResultPath": "$.approval",
       "Next": "check_manual_approval"
     },
 
@@ -221,7 +388,7 @@ resource "aws_sfn_state_machine" "ldap_maintenance" {
       "Type": "Choice",
       "Choices": [
         {
-          "Variable": "$.button_pressed",
+          "Variable": "$.approval.button_pressed",
           "StringEquals": "Approve",
           "Next": "notify_slack_of_approval"
         }
@@ -235,7 +402,13 @@ resource "aws_sfn_state_machine" "ldap_maintenance" {
       "Parameters": {
             "FunctionName": "${module.slack_notifier.function_name}",
             "Payload":{
-               "message_to_slack": "The LDAP operation has been disapproved"
+               "message_to_slack": "The LDAP operation has been disapproved",
+               "execution_id.$": "$$.Execution.Id",
+               "trace": {
+                 "state.$": "$$.State.Name",
+                 "entered.$": "$$.State.EnteredTime",
+                 "execution_start.$": "$$.Execution.StartTime"
+               }
             }
       },
       "Next": "disapproved"
@@ -252,33 +425,108 @@ resource "aws_sfn_state_machine" "ldap_maintenance" {
     "Parameters": {
       "FunctionName": "${module.slack_notifier.function_name}",
       "Payload": {
-        "message_to_slack": "The LDAP operation has been approved. I'll notify you when the operation is complete."
+        "message_to_slack": "The LDAP operation has been approved. I'll notify you when the operation is complete.",
+        "execution_id.$": "$$.Execution.Id",
+        "trace": {
+          "state.$": "$$.State.Name",
+          "entered.$": "$$.State.EnteredTime"
+        }
       }
     },
-    "Next": "run_ldap_query_again"
+    "ResultPath": null,
+    "Next": "disable_directories"
     },
 
-    "run_ldap_query_again": {
-    "Type": "Task",
-    "Resource": "arn:aws:states:::lambda:invoke",
+    "disable_directories": {
+    "Type": "Map",
+    "ItemsPath": "$.directories",
+    "MaxConcurrency": ${var.directory_concurrency},
     "Parameters": {
-      "FunctionName": "${module.ldap_query_lambda.function_arn}",
-      "Payload": {
-        "Input": {"action": "disable"}
-      }
-    },
-    "Next": "dynamodb_cleanup"
+      "directory.$": "$$.Map.Item.Value"
     },
+    "Iterator": {
+      "StartAt": "run_ldap_query_again",
+      "States": {
+
+        "run_ldap_query_again": {
+          "Type": "Task",
+          "Resource": "arn:aws:states:::lambda:invoke",
+          "Parameters": {
+            "FunctionName": "${module.ldap_query_lambda.function_arn}",
+            "Payload": {
+              "Input": {
+                "action": "disable",
+                "directory.$": "$.directory"
+              },
+              "execution_id.$": "$$.Execution.Id",
+              "trace": {
+                "state.$": "$$.State.Name",
+                "entered.$": "$$.State.EnteredTime"
+              }
+            }
+          },
+          "ResultPath": "$.disable",
+          "Next": "check_disable_progress"
+        },
 
-    "dynamodb_cleanup": {
-    "Type": "Task",
-    "Resource": "arn:aws:states:::lambda:invoke",
-    "Parameters": {
-      "FunctionName": "${module.dynamodb_cleanup.function_arn}",
-      "Payload": {
-        "Input": {"action": "remove"}
+        "check_disable_progress": {
+          "Type": "Choice",
+          "Choices": [
+            {
+              "Variable": "$.disable.Payload.status",
+              "StringEquals": "incomplete",
+              "Next": "continue_disable"
+            }
+          ],
+          "Default": "dynamodb_cleanup"
+        },
+
+        "continue_disable": {
+          "Type": "Task",
+          "Resource": "arn:aws:states:::lambda:invoke",
+          "Parameters": {
+            "FunctionName": "${module.ldap_query_lambda.function_arn}",
+            "Payload": {
+              "Input": {
+                "action": "disable",
+                "checkpoint.$": "$.disable.Payload.checkpoint",
+                "directory.$": "$.directory"
+              },
+              "execution_id.$": "$$.Execution.Id",
+              "trace": {
+                "state.$": "$$.State.Name",
+                "entered.$": "$$.State.EnteredTime"
+              }
+            }
+          },
+          "ResultPath": "$.disable",
+          "Next": "check_disable_progress"
+        },
+
+        "dynamodb_cleanup": {
+          "Type": "Task",
+          "Resource": "arn:aws:states:::lambda:invoke",
+          "Parameters": {
+            "FunctionName": "${module.dynamodb_cleanup.function_arn}",
+            "Payload": {
+              "Input": {
+                "action": "remove",
+                "disabled.$": "$.disable.Payload.disabled",
+                "directory.$": "$.directory"
+              },
+              "execution_id.$": "$$.Execution.Id",
+              "trace": {
+                "state.$": "$$.State.Name",
+                "entered.$": "$$.State.EnteredTime"
+              }
+            }
+          },
+          "ResultPath": null,
+          "End": true
+        }
       }
     },
+    "ResultPath": null,
     "Next": "send_status_to_slack"
     },
 
@@ -289,7 +537,13 @@ resource "aws_sfn_state_machine" "ldap_maintenance" {
             "FunctionName": "${module.slack_notifier.function_name}",
             "Payload":{
                "event.$": "$",
-               "message_to_slack": "LDAP operations are complete"
+               "message_to_slack": "LDAP operations are complete",
+               "execution_id.$": "$$.Execution.Id",
+               "trace": {
+                 "state.$": "$$.State.Name",
+                 "entered.$": "$$.State.EnteredTime",
+                 "execution_start.$": "$$.Execution.StartTime"
+               }
             }
       },
      "End": true
@@ -59,33 +59,21 @@ resource "aws_api_gateway_method" "event_listener_post" {
   authorization = "NONE"
 }
 
+# forward slack's form encoded request body to SQS untouched so that the
+# listener can decode it (and verify its signature) exactly as it was
+# sent, the slack headers are carried as message attributes
 locals {
-  request_template = <<TEMPLATE
-Action=SendMessage&MessageBody=
-#set($allParams = $input.params())
-{
-"body-json" : $input.json('$'),
-"params" : {
-#foreach($type in $allParams.keySet())
-    #set($params = $allParams.get($type))
-"$type" : {
-    #foreach($paramName in $params.keySet())
-    "$paramName" : "$util.escapeJavaScript($params.get($paramName))"
-        #if($foreach.hasNext),#end
-    #end
-}
-    #if($foreach.hasNext),#end
-#end
-},
-"stage-variables" : {
-#foreach($key in $stageVariables.keySet())
-"$key" : "$util.escapeJavaScript($stageVariables.get($key))"
-    #if($foreach.hasNext),#end
-#end
-}
-}
-TEMPLATE
-
+  slack_headers = ["X-Slack-Request-Timestamp", "X-Slack-Signature"]
+  request_template = join("&", concat(
+    ["Action=SendMessage", "MessageBody=$util.urlEncode($input.body)"],
+    flatten([
+      for i, header in local.slack_headers : [
+        "MessageAttribute.${i + 1}.Name=${header}",
+        "MessageAttribute.${i + 1}.Value.DataType=String",
+        "MessageAttribute.${i + 1}.Value.StringValue=$util.urlEncode($input.params('${header}'))"
+      ]
+    ])
+  ))
 }
 
 resource "aws_api_gateway_integration" "event_listener" {
@@ -3,41 +3,15 @@
 Slack chat-bot Lambda handler.
 """
 import boto3
-import collections
-import json
 import logging
 import os
 
-s3 = boto3.client('s3')
-
-DEFAULT_LOG_LEVEL = logging.DEBUG
-LOG_LEVELS = collections.defaultdict(
-    lambda: DEFAULT_LOG_LEVEL,
-    {
-        'critical': logging.CRITICAL,
-        'error': logging.ERROR,
-        'warning': logging.WARNING,
-        'info': logging.INFO,
-        'debug': logging.DEBUG
-    }
-)
-
-# Lambda initializes a root logger that needs to be removed in order to set a
-# different logging config
-root = logging.getLogger()
-if root.handlers:
-    for handler in root.handlers:
-        root.removeHandler(handler)
-
-log_file_name = ""
-if not os.environ.get("AWS_EXECUTION_ENV"):
-    log_file_name = 'ldap_maintainer_slack.log'
-
-logging.basicConfig(
-    filename=log_file_name,
-    format='%(asctime)s.%(msecs)03dZ [%(name)s][%(levelname)-5s]: %(message)s',
-    datefmt='%Y-%m-%dT%H:%M:%S',
-    level=LOG_LEVELS[os.environ.get('LOG_LEVEL', '').lower()])
+from ldap_maintainer import artifact_store
+from ldap_maintainer.logs import configure_logging, summarize
+from ldap_maintainer.metrics import instrumented, metrics
+from ldap_maintainer.profiling import profiled
+
+configure_logging('ldap_maintainer_slack.log')
 log = logging.getLogger(__name__)
 
 
@@ -50,9 +24,10 @@ def scan_table(scan_attributes):
     """
     Scan the target table by attribute list.
     """
-    return table.scan(
-            AttributesToGet=scan_attributes,
-        )
+    with metrics.timer("dynamodb.scan"):
+        return table.scan(
+                AttributesToGet=scan_attributes,
+            )
 
 
 def modify_scan_results(email_address, scan_results):
@@ -63,7 +38,7 @@ def modify_scan_results(email_address, scan_results):
                 if email_address in email_distro:
                     email_distro.remove(email_address)
                     item['has_updates'] = True
-                    log.info(f"removed {email_address} from {distro}")
+                    log.info("removed %s from %s", email_address, distro)
         except KeyError:
             continue
     return scan_results
@@ -71,51 +46,34 @@ def modify_scan_results(email_address, scan_results):
 
 def apply_scan_results(updated_scan_results):
     for item in updated_scan_results['Items']:
-        if item['has_updates']:
-            table.update_item(
-                Key={
-                    "account_name": item["account_name"]
-                },
-                UpdateExpression="set email_distros = :distros",
-                ExpressionAttributeValues={
-                    ":distros": item['email_distros']
-                },
-                ReturnValues="UPDATED_NEW"
-            )
-            print(f"updated {item['account_name']}")
-
-
-def get_last_modified():
-    return lambda obj: int(obj['LastModified'].strftime('%s'))
-
-
-def get_latest_s3_object(
-    bucket=os.environ['ARTIFACTS_BUCKET'],
-    prefix='user_expiration_table'
-):
+        if item.get('has_updates'):
+            with metrics.timer("dynamodb.update"):
+                table.update_item(
+                    Key={
+                        "account_name": item["account_name"]
+                    },
+                    UpdateExpression="set email_distros = :distros",
+                    ExpressionAttributeValues={
+                        ":distros": item['email_distros']
+                    },
+                    ReturnValues="UPDATED_NEW"
+                )
+            log.info("updated %s", item['account_name'])
+
+
+def get_disabled_users(key=None, directory=None):
     """
-    Retrieve the newest object in the target s3 bucket
+    Returns the users the ldap query function disabled: those published
+    under key, or the last ones of the named directory (the only one when
+    the deployment maintains a single directory). The approved users of
+    the scan aren't used, the disable step skips those that are no longer
+    stale.
     """
-    response = s3.list_objects_v2(
-        Bucket=bucket,
-        Prefix=prefix)
-    all = response['Contents']
-    return max(all, key=lambda x: x['LastModified'])
-
-
-def retrieve_s3_object_contents(
-    s3_obj,
-    bucket=os.environ['ARTIFACTS_BUCKET']
-):
-    return json.loads(s3.get_object(
-        Bucket=bucket,
-        Key=s3_obj['Key']
-        )['Body'].read().decode('utf-8'))
-
-
-def get_previous_scan_results():
-    s3_obj = get_latest_s3_object()
-    return retrieve_s3_object_contents(s3_obj)
+    with metrics.timer("s3.download"):
+        if key:
+            return artifact_store.get_json(key)
+        return artifact_store.get_latest_json(
+            artifact_store.get_directory_key('disabled_users', directory))
 
 
 # this should probably be called recursively for all users in the input list
@@ -131,13 +89,19 @@ def remove_users_in_list(users):
     scan_results = scan_table(scan_attributes)
     for user in users:
         remove_user(user['email'], scan_results)
+    metrics.count("users.removed", len(users))
 
 
+@instrumented
+@profiled
 def handler(event, context):
-    log.debug(f"Received event: {event}")
+    log.debug("Received event: %s", summarize(event))
     if event.get('Input'):
         event = event['Input']
     if event['action'] == "remove":
-        users = get_previous_scan_results()['120']
+        # the state machine passes the directory descriptor of the
+        # ldap query function, only its name is needed here
+        directory = (event.get('directory') or {}).get('name')
+        users = get_disabled_users(event.get('disabled'), directory)
         remove_users_in_list(users)
         log.info('Successfully removed the stale users from dynamodb')
@@ -55,9 +55,15 @@ module "lambda" {
       DYNAMODB_TABLE   = data.aws_dynamodb_table.target.id
       LOG_LEVEL        = var.log_level
       ARTIFACTS_BUCKET = var.artifacts_bucket_name
+
+      METRICS_NAMESPACE = var.metrics_namespace
+      PROFILER          = var.profiler
+      TRACE_EXPORTER    = var.trace_exporter
     }
   }
 
+  layers = [var.common_layer_arn]
+
   policy = {
     json = data.aws_iam_policy_document.lambda.json
   }
@@ -24,4 +24,27 @@ variable "dynamodb_table_name" {
 variable "artifacts_bucket_name" {
   description = "Name of the artifacts bucket"
   type        = string
-}
\ No newline at end of file
+}
+
+variable "common_layer_arn" {
+  description = "ARN of the layer with the code shared by the lambda functions"
+  type        = string
+}
+
+variable "metrics_namespace" {
+  default     = "LdapMaintainer"
+  description = "CloudWatch namespace of the embedded metrics emitted by the function"
+  type        = string
+}
+
+variable "profiler" {
+  default     = ""
+  description = "Profiles every invocation and uploads the result to the artifacts bucket when set, one of: cprofile or sampling"
+  type        = string
+}
+
+variable "trace_exporter" {
+  default     = "log"
+  description = "Where the spans of every invocation are exported, one of: log (the function's log), file or none"
+  type        = string
+}
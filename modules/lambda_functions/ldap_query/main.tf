@@ -7,6 +7,47 @@ resource "random_string" "this" {
   upper   = false
 }
 
+# the users seen by the last directory scan, keyed by DN. Only stale
+# users have a bucket so the bucket index holds just those.
+resource "aws_dynamodb_table" "projection" {
+  name         = "${var.project_name}-ldap-projection-${random_string.this.result}"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "dn"
+
+  attribute {
+    name = "dn"
+    type = "S"
+  }
+
+  attribute {
+    name = "bucket"
+    type = "S"
+  }
+
+  attribute {
+    name = "directory"
+    type = "S"
+  }
+
+  global_secondary_index {
+    name            = "bucket-index"
+    hash_key        = "bucket"
+    range_key       = "dn"
+    projection_type = "ALL"
+  }
+
+  # the rows of each directory, read by a complete scan to remove the
+  # users it didn't see
+  global_secondary_index {
+    name            = "directory-index"
+    hash_key        = "directory"
+    range_key       = "dn"
+    projection_type = "KEYS_ONLY"
+  }
+
+  tags = var.tags
+}
+
 data "aws_s3_bucket" "artifacts" {
   bucket = var.artifacts_bucket_name
 }
@@ -16,7 +57,8 @@ data "aws_iam_policy_document" "lambda" {
   statement {
     actions = ["ssm:GetParameter*"]
     resources = [
-      "arn:aws:ssm:*:${data.aws_caller_identity.current.account_id}:parameter${var.svc_user_pwd_ssm_key}"
+      for key in concat([var.svc_user_pwd_ssm_key], var.directory_ssm_keys) :
+      "arn:aws:ssm:*:${data.aws_caller_identity.current.account_id}:parameter${key}"
     ]
   }
 
@@ -24,6 +66,22 @@ data "aws_iam_policy_document" "lambda" {
     actions   = ["S3:*"]
     resources = [data.aws_s3_bucket.artifacts.arn]
   }
+
+  statement {
+    sid = "MaintainProjection"
+    actions = [
+      "dynamodb:BatchGetItem",
+      "dynamodb:BatchWriteItem",
+      "dynamodb:GetItem",
+      "dynamodb:PutItem",
+      "dynamodb:Query",
+      "dynamodb:Scan"
+    ]
+    resources = [
+      aws_dynamodb_table.projection.arn,
+      "${aws_dynamodb_table.projection.arn}/index/*"
+    ]
+  }
 }
 
 data "aws_subnet_ids" "private" {
@@ -76,8 +134,9 @@ module "lambda" {
   handler       = "lambda.handler"
   runtime       = "python3.7"
   timeout       = 300
+  memory_size   = var.memory_size
 
-  source_path = "${path.module}/lambda.py"
+  source_path = "${path.module}/src"
 
   policy = {
     json = data.aws_iam_policy_document.lambda.json
@@ -93,6 +152,25 @@ module "lambda" {
       LOG_LEVEL          = var.log_level
       ARTIFACTS_BUCKET   = var.artifacts_bucket_name
       HANDS_OFF_ACCOUNTS = jsonencode(local.hands_off_accounts)
+      APPROVER_GROUP_DN  = var.approver_group_dn
+
+      METRICS_NAMESPACE  = var.metrics_namespace
+      PROFILER           = var.profiler
+      TRACE_EXPORTER     = var.trace_exporter
+      LOG_SAMPLE_RATE    = var.log_sample_rate
+      SHARD_STRATEGY     = var.shard_strategy
+      SHARD_COUNT        = var.shard_count
+      CLASSIFY_WORKERS   = var.classify_workers
+      SEARCH_CONNECTIONS = var.search_connections
+
+      LDAP_SRV_DOMAIN      = var.ldap_srv_domain
+      LDAP_CONNECT_TIMEOUT = var.ldap_connect_timeout
+
+      PROJECTION_TABLE = aws_dynamodb_table.projection.name
+
+      DISABLE_RATE             = var.disable_rate
+      DISABLE_MAX_CONCURRENCY  = var.disable_max_concurrency
+      REMOVE_GROUP_MEMBERSHIPS = var.remove_group_memberships
     }
   }
 
@@ -101,5 +179,8 @@ module "lambda" {
     security_group_ids = [aws_security_group.lambda.id]
   }
 
-  layers = [aws_lambda_layer_version.lambda_layer.arn]
+  layers = [
+    aws_lambda_layer_version.lambda_layer.arn,
+    var.common_layer_arn
+  ]
 }
\ No newline at end of file
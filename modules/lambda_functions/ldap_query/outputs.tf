@@ -26,4 +26,8 @@ output "role_arn" {
 output "role_name" {
   description = "The name of the IAM role created for the Lambda function"
   value       = module.lambda.role_name
-}
\ No newline at end of file
+}
+output "projection_table_name" {
+  description = "The name of the DynamoDB projection of the last directory scan"
+  value       = aws_dynamodb_table.projection.name
+}
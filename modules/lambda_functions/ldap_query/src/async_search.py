@@ -0,0 +1,219 @@
+"""
+Concurrent paged searches over python-ldap's message id API.
+
+python-ldap's synchronous calls wait for one request/response cycle at a
+time. Here every search is a coroutine that sends its page request with
+`search_ext` and polls for the answers with `result3(msgid, timeout=0)`,
+waking up when the connection's socket becomes readable. Any number of
+searches can share a connection and several connections can be driven by
+one event loop, so the entries of one search are processed while the
+controller is still sending those of the others.
+
+Results are paged with the simple paged results control (AD returns at
+most MaxPageSize, 1000 by default, entries per page) so no search runs
+into the server side size limit, and the values of large multi valued
+attributes (e.g. the members of a group) are read in ranges since AD
+returns at most MaxValRange, 1500 by default, values per search. AD
+also keeps at most MaxResultSetsPerConn, 10 by default, paged searches
+open per connection and refuses the next ones with UNWILLING_TO_PERFORM,
+so each connection runs up to MAX_SEARCHES_PER_CONNECTION searches at a
+time and the others wait for one of them to finish.
+"""
+import asyncio
+import logging
+import os
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+log = logging.getLogger(__name__)
+
+# entries per page requested from the controller
+SEARCH_PAGE_LIMIT = int(os.environ.get('SEARCH_PAGE_LIMIT', 1000))
+# paged searches in flight per connection, below AD's MaxResultSetsPerConn
+MAX_SEARCHES_PER_CONNECTION = int(
+    os.environ.get('MAX_SEARCHES_PER_CONNECTION', 8))
+# seconds between polls of a connection whose socket isn't readable,
+# libldap may already have buffered the messages of another search
+POLL_INTERVAL = 0.05
+
+
+class _Waiter:
+    """A wake up shared by the searches waiting on a connection"""
+
+    def __init__(self, loop, fd):
+        self.loop = loop
+        self.fd = fd
+        self.future = loop.create_future()
+        self.timer = None
+
+
+class AsyncConnection:
+    """Runs searches concurrently over a bound python-ldap connection"""
+
+    def __init__(
+        self,
+        connection,
+        poll_interval=POLL_INTERVAL,
+        max_searches=MAX_SEARCHES_PER_CONNECTION
+    ):
+        self.connection = connection
+        self.poll_interval = poll_interval
+        self.max_searches = max_searches
+        self._waiter = None
+        self._slots = None
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is None:
+            return
+        waiter.loop.remove_reader(waiter.fd)
+        waiter.timer.cancel()
+        if not waiter.future.done():
+            waiter.future.set_result(None)
+
+    async def _wait(self):
+        """
+        Waits until the socket is readable or the poll interval passed,
+        every search waiting on the connection is woken up at once.
+        """
+        if self._waiter is None:
+            loop = asyncio.get_event_loop()
+            waiter = self._waiter = _Waiter(loop, self.connection.fileno())
+            loop.add_reader(waiter.fd, self._wake)
+            waiter.timer = loop.call_later(self.poll_interval, self._wake)
+        await asyncio.shield(self._waiter.future)
+
+    async def _result(self, msgid):
+        """Returns the next message of the request msgid"""
+        while True:
+            result_type, data, _, controls = self.connection.result3(
+                msgid, all=0, timeout=0)
+            if result_type is not None:
+                return result_type, data, controls
+            await self._wait()
+
+    async def search(
+        self,
+        base,
+        scope,
+        filter_string,
+        attrlist=None,
+        page_size=SEARCH_PAGE_LIMIT
+    ):
+        """
+        Returns the entries of a paged search, in the format of
+        ldap.asyncsearch.List.allResults. The search waits while
+        max_searches others are in flight on the connection.
+        """
+        if self._slots is None:
+            # bound to the loop running the searches
+            self._slots = asyncio.Semaphore(self.max_searches)
+        async with self._slots:
+            return await self._search(
+                base, scope, filter_string, attrlist, page_size)
+
+    async def _search(self, base, scope, filter_string, attrlist, page_size):
+        control = SimplePagedResultsControl(True, size=page_size, cookie="")
+        entries = []
+        pages = 0
+        while True:
+            msgid = self.connection.search_ext(
+                base, scope, filter_string, attrlist, serverctrls=[control])
+            pages += 1
+            # let the other searches send their requests and process the
+            # entries they received before reading this page
+            await asyncio.sleep(0)
+            while True:
+                result_type, data, controls = await self._result(msgid)
+                if result_type == ldap.RES_SEARCH_RESULT:
+                    break
+                for entry in data:
+                    entries.append((result_type, entry))
+            cookie = next((
+                response.cookie for response in controls or ()
+                if response.controlType == control.controlType
+            ), None)
+            if not cookie:
+                log.debug(
+                    "Searched %s: %s entries in %s pages",
+                    base, len(entries), pages)
+                return entries
+            control.cookie = cookie
+
+    async def get_values(self, dn, attribute):
+        """
+        Returns every value of a multi valued attribute of the object dn,
+        reading it in ranges (member;range=0-*, member;range=1500-*, ...)
+        until the controller returns the last one.
+        """
+        values = []
+        start = 0
+        prefix = f"{attribute.lower()};range="
+        while True:
+            entries = await self.search(
+                dn, ldap.SCOPE_BASE, "(objectClass=*)",
+                [f"{attribute};range={start}-*"])
+            attributes = next(
+                (entry for _, (entry_dn, entry) in entries if entry_dn), {})
+            name, chunk = next((
+                (name, chunk) for name, chunk in attributes.items()
+                if name.lower() == attribute.lower() or
+                name.lower().startswith(prefix)
+            ), ("", []))
+            values.extend(chunk)
+            end = name.rpartition("-")[2]
+            if not name.lower().startswith(prefix) or end == "*":
+                return values
+            start = int(end) + 1
+
+
+def run_concurrently(connections, calls):
+    """
+    Runs calls, functions that take an AsyncConnection and return a
+    coroutine, at the same time, spread round robin over the bound
+    connections, at most MAX_SEARCHES_PER_CONNECTION searches of them at
+    a time on each. Returns the results of the calls in their order.
+    """
+    if not connections:
+        raise ValueError("At least one connection is required")
+
+    async def run():
+        clients = [AsyncConnection(connection) for connection in connections]
+        tasks = [
+            asyncio.ensure_future(call(clients[index % len(clients)]))
+            for index, call in enumerate(calls)
+        ]
+        try:
+            return await asyncio.gather(*tasks)
+        except Exception:
+            # don't leave the other calls pending on a closed loop
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def search_concurrently(connections, searches):
+    """
+    Runs searches, a list of (base, scope, filter, attrlist), at the same
+    time. Returns the entries of every search, in the order of searches.
+    """
+    return run_concurrently(connections, [
+        lambda client, search=search: client.search(*search)
+        for search in searches
+    ])
+
+
+def get_values_concurrently(connections, dns, attribute):
+    """Returns the values of attribute of every object in dns, by DN"""
+    return dict(zip(dns, run_concurrently(connections, [
+        lambda client, dn=dn: client.get_values(dn, attribute)
+        for dn in dns
+    ])))
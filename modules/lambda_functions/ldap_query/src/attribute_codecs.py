@@ -0,0 +1,127 @@
+"""
+Decoding of Active Directory attribute values by attribute syntax.
+
+python-ldap returns every value as bytes. Each attribute the functions
+read is mapped to its AD syntax once, and values are decoded with the
+codec of that syntax: Integer and Integer8 (e.g. pwdLastSet) become ints,
+SIDs their S-1-5-... string form, GUIDs their canonical string form and
+strings and DNs str. Attributes missing from the table are decoded as
+strings, undecodable bytes are escaped rather than raising.
+
+ref: https://learn.microsoft.com/en-us/windows/win32/adschema/syntaxes
+"""
+import struct
+import uuid
+
+# attributeSyntax OIDs
+SYNTAX_DN = "2.5.5.1"
+SYNTAX_OID = "2.5.5.2"
+SYNTAX_BOOLEAN = "2.5.5.8"
+SYNTAX_INTEGER = "2.5.5.9"
+SYNTAX_OCTET_STRING = "2.5.5.10"
+SYNTAX_GENERALIZED_TIME = "2.5.5.11"
+SYNTAX_DIRECTORY_STRING = "2.5.5.12"
+SYNTAX_INTEGER8 = "2.5.5.16"
+SYNTAX_SID = "2.5.5.17"
+# an octet string holding a GUID, AD has no separate syntax for it
+SYNTAX_GUID = "guid"
+
+
+def decode_string(value):
+    return value.decode("utf-8", "backslashreplace")
+
+
+def decode_integer(value):
+    return int(value)
+
+
+def decode_boolean(value):
+    return value == b"TRUE"
+
+
+def decode_guid(value):
+    """GUIDs are stored little endian, e.g. 6f9619ff-8b86-d011-b42d-..."""
+    return str(uuid.UUID(bytes_le=value))
+
+
+def decode_sid(value):
+    """
+    Binary SIDs hold the revision, the number of sub authorities, a 48
+    bit big endian authority and the little endian sub authorities.
+    """
+    revision, count = value[0], value[1]
+    authority = int.from_bytes(value[2:8], "big")
+    sub_authorities = struct.unpack_from(f"<{count}I", value, 8)
+    return "-".join(
+        ["S", str(revision), str(authority)] +
+        [str(sub_authority) for sub_authority in sub_authorities])
+
+
+SYNTAX_CODECS = {
+    SYNTAX_DN: decode_string,
+    SYNTAX_OID: decode_string,
+    SYNTAX_BOOLEAN: decode_boolean,
+    SYNTAX_INTEGER: decode_integer,
+    SYNTAX_OCTET_STRING: bytes.hex,
+    SYNTAX_GENERALIZED_TIME: decode_string,
+    SYNTAX_DIRECTORY_STRING: decode_string,
+    SYNTAX_INTEGER8: decode_integer,
+    SYNTAX_SID: decode_sid,
+    SYNTAX_GUID: decode_guid,
+}
+
+ATTRIBUTE_SYNTAXES = {
+    "accountExpires": SYNTAX_INTEGER8,
+    "badPwdCount": SYNTAX_INTEGER,
+    "cn": SYNTAX_DIRECTORY_STRING,
+    "description": SYNTAX_DIRECTORY_STRING,
+    "displayName": SYNTAX_DIRECTORY_STRING,
+    "distinguishedName": SYNTAX_DN,
+    "givenName": SYNTAX_DIRECTORY_STRING,
+    "lastLogonTimestamp": SYNTAX_INTEGER8,
+    "mail": SYNTAX_DIRECTORY_STRING,
+    "member": SYNTAX_DN,
+    "memberOf": SYNTAX_DN,
+    "objectCategory": SYNTAX_DN,
+    "objectClass": SYNTAX_OID,
+    "objectGUID": SYNTAX_GUID,
+    "objectSid": SYNTAX_SID,
+    "pwdLastSet": SYNTAX_INTEGER8,
+    "sAMAccountName": SYNTAX_DIRECTORY_STRING,
+    "sn": SYNTAX_DIRECTORY_STRING,
+    "userAccountControl": SYNTAX_INTEGER,
+    "userPrincipalName": SYNTAX_DIRECTORY_STRING,
+    "whenChanged": SYNTAX_GENERALIZED_TIME,
+    "whenCreated": SYNTAX_GENERALIZED_TIME,
+}
+# attribute names are case insensitive
+_CODECS = {
+    name.lower(): SYNTAX_CODECS[syntax]
+    for name, syntax in ATTRIBUTE_SYNTAXES.items()
+}
+
+
+class AttributeDecoder:
+    """Decodes search results with the codec of each attribute"""
+
+    def __init__(self, attributes=None):
+        """attributes are the projected attributes, if known up front"""
+        self.codecs = {}
+        for name in attributes or ():
+            self.get_codec(name)
+
+    def get_codec(self, name):
+        codec = self.codecs.get(name)
+        if codec is None:
+            codec = self.codecs[name] = _CODECS.get(
+                name.lower(), decode_string)
+        return codec
+
+    def decode(self, attributes):
+        """Returns a copy of an entry's attributes with decoded values"""
+        codecs = self.codecs
+        decoded = {}
+        for name, values in attributes.items():
+            codec = codecs.get(name) or self.get_codec(name)
+            decoded[name] = [codec(value) for value in values]
+        return decoded
@@ -0,0 +1,184 @@
+"""
+Load balancing and failover across the domain controllers of a domain.
+
+The controllers come from LDAPS_URL, which may list several comma
+separated URLs, or are discovered through the domain's SRV records when
+LDAP_SRV_DOMAIN is set (this requires dnspython in the lambda layer).
+
+Every controller is scored by an exponentially weighted moving average of
+its bind latency. Connections go to the fastest healthy controller, or
+are spread over the healthy controllers by key (e.g. a shard id) so that
+parallel scans don't all pull from the same one. A controller that fails
+is skipped for a cool down period that grows with its consecutive
+failures, and when every controller fails the pool retries with a
+bounded exponential backoff before giving up.
+"""
+import logging
+import os
+import re
+import time
+
+import ldap
+
+from ldap_maintainer.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+LDAP_SRV_DOMAIN = os.environ.get('LDAP_SRV_DOMAIN', '')
+# seconds allowed to open a connection to a domain controller
+LDAP_CONNECT_TIMEOUT = float(os.environ.get('LDAP_CONNECT_TIMEOUT', 5))
+# weight of the latest bind in a controller's latency score
+LATENCY_SMOOTHING = 0.3
+# controllers within this factor of the fastest one share the load
+LATENCY_TOLERANCE = 2.0
+
+
+class NoDomainControllerAvailable(Exception):
+    """Raised when no domain controller accepted a connection"""
+
+
+class DomainController:
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0
+
+    def is_healthy(self, now):
+        return self.down_until <= now
+
+    def record_success(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        self.failures = 0
+        self.down_until = 0
+
+    def record_failure(self, now, cooldown):
+        self.failures += 1
+        self.down_until = now + cooldown * 2 ** min(self.failures - 1, 4)
+
+    def __repr__(self):
+        return (
+            f"DomainController({self.uri!r}, latency={self.latency}, "
+            f"failures={self.failures})")
+
+
+def discover_domain_controllers(domain):
+    """
+    Returns the ldaps URLs of the domain controllers advertised in the
+    _ldap._tcp.dc._msdcs SRV records of domain, by priority and weight.
+    """
+    try:
+        import dns.resolver
+    except ImportError:
+        log.error("dnspython is not installed, can't discover %s", domain)
+        return []
+    try:
+        answers = dns.resolver.resolve(
+            f"_ldap._tcp.dc._msdcs.{domain}", "SRV")
+    except Exception as e:
+        log.error("Failed to discover the controllers of %s: %s", domain, e)
+        return []
+    records = sorted(answers, key=lambda r: (r.priority, -r.weight))
+    # the SRV records advertise plain ldap, the ldaps port is fixed
+    return [
+        f"ldaps://{str(record.target).rstrip('.')}:636"
+        for record in records
+    ]
+
+
+def get_domain_controller_urls(ldaps_url, srv_domain=LDAP_SRV_DOMAIN):
+    urls = []
+    if srv_domain:
+        urls = discover_domain_controllers(srv_domain)
+    if not urls:
+        urls = [url for url in re.split(r"[\s,]+", ldaps_url) if url]
+    return urls
+
+
+class DomainControllerPool:
+
+    def __init__(
+        self,
+        uris,
+        bind,
+        max_attempts=3,
+        base_delay=0.5,
+        max_delay=4,
+        cooldown=30
+    ):
+        """
+        bind is called with a controller URI and returns a bound
+        connection or raises ldap.LDAPError.
+        """
+        if not uris:
+            raise ValueError("At least one domain controller is required")
+        self.controllers = [DomainController(uri) for uri in uris]
+        self.bind = bind
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cooldown = cooldown
+
+    def ranked(self, key=None, now=None):
+        """
+        Returns the controllers in the order they should be tried.
+
+        Healthy controllers come first, fastest first. Controllers that
+        have never been measured are tried before slow ones so every
+        controller gets scored. With a key, the healthy controllers that
+        are within LATENCY_TOLERANCE of the fastest are rotated by key to
+        spread the load.
+        """
+        now = time.time() if now is None else now
+        healthy = [dc for dc in self.controllers if dc.is_healthy(now)]
+        down = sorted(
+            (dc for dc in self.controllers if not dc.is_healthy(now)),
+            key=lambda dc: dc.down_until)
+        healthy.sort(key=lambda dc: -1 if dc.latency is None else dc.latency)
+        if key is not None and healthy:
+            fastest = healthy[0].latency
+            balanced = [
+                dc for dc in healthy
+                if fastest is None or dc.latency is None or
+                dc.latency <= fastest * LATENCY_TOLERANCE
+            ]
+            offset = hash(key) % len(balanced)
+            balanced = balanced[offset:] + balanced[:offset]
+            healthy = balanced + healthy[len(balanced):]
+        return healthy + down
+
+    def connect(self, key=None):
+        """
+        Returns a bound connection to the best available controller.
+        Raises NoDomainControllerAvailable once every attempt failed.
+        """
+        errors = []
+        for attempt in range(self.max_attempts):
+            if attempt:
+                delay = min(self.base_delay * 2 ** (attempt - 1),
+                            self.max_delay)
+                time.sleep(delay)
+            for dc in self.ranked(key):
+                start = time.perf_counter()
+                try:
+                    with metrics.timer("ldap.bind"):
+                        connection = self.bind(dc.uri)
+                except ldap.INVALID_CREDENTIALS:
+                    # every controller will reject the service account
+                    raise
+                except ldap.LDAPError as e:
+                    metrics.count("ldap.failover")
+                    log.error("Failed to connect to %s: %s", dc.uri, e)
+                    dc.record_failure(time.time(), self.cooldown)
+                    errors.append(f"{dc.uri}: {e}")
+                    continue
+                dc.record_success(time.perf_counter() - start)
+                metrics.set_property("domain_controller", dc.uri)
+                log.debug("Connected to %s", dc)
+                return connection
+        raise NoDomainControllerAvailable(
+            f"Failed to connect to any domain controller: {errors}")
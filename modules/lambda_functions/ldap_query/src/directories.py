@@ -0,0 +1,80 @@
+"""
+The directories a deployment maintains.
+
+The query, disable and cleanup actions act on the directory described by
+the directory field of their event, e.g.
+
+    {
+        "action": "plan",
+        "directory": {
+            "name": "emea",
+            "ldaps_url": "ldaps://dc1.emea.example.com",
+            "domain_base": "DC=emea,DC=example,DC=com",
+            "svc_user_dn": "CN=svc_ldapmaint,CN=Users,DC=emea,...",
+            "ssm_key": "/ldap-maintainer/emea/svc_user_pwd"
+        }
+    }
+
+Fields that are left out fall back to the function's environment
+(LDAPS_URL, DOMAIN_BASE, SVC_USER_DN, SSM_KEY and LDAP_SRV_DOMAIN), so an
+event without a directory acts on the directory of the environment. Only
+that directory (whatever its name) publishes the members of
+APPROVER_GROUP_DN, another one only if its descriptor names an
+approver_group_dn.
+
+The artifacts of a named directory are kept under its name in the
+artifacts bucket (emea/user_expiration_table-...), those of the
+environment's directory at the root of the bucket.
+"""
+import os
+import re
+from collections import namedtuple
+
+from ldap_maintainer.artifact_store import get_directory_key
+
+from dc_pool import LDAP_SRV_DOMAIN
+
+LDAPS_URL = os.environ.get('LDAPS_URL', '')
+DOMAIN_BASE = os.environ.get('DOMAIN_BASE', '')
+SSM_KEY = os.environ.get('SSM_KEY', '')
+SVC_USER_DN = os.environ.get('SVC_USER_DN', '')
+
+# names become a prefix of the artifact keys
+DIRECTORY_NAME = re.compile(r"[A-Za-z0-9_.-]*")
+
+
+class Directory(namedtuple("Directory", (
+        "name",
+        "ldaps_url",
+        "domain_base",
+        "svc_user_dn",
+        "ssm_key",
+        "ldap_srv_domain",
+        "approver_group_dn"))):
+
+    __slots__ = ()
+
+    def get_key(self, key):
+        """Returns the key of one of the directory's artifacts"""
+        return get_directory_key(key, self.name)
+
+
+def get_directory(descriptor=None):
+    """Returns the Directory of an event's descriptor"""
+    descriptor = descriptor or {}
+    name = descriptor.get('name') or ""
+    if not DIRECTORY_NAME.fullmatch(name):
+        raise ValueError(f"Invalid directory name {name!r}")
+    domain_base = descriptor.get('domain_base') or DOMAIN_BASE
+    approver_group_dn = descriptor.get('approver_group_dn') or ""
+    if domain_base == DOMAIN_BASE:
+        approver_group_dn = approver_group_dn or os.environ.get(
+            'APPROVER_GROUP_DN', '')
+    return Directory(
+        name=name,
+        ldaps_url=descriptor.get('ldaps_url') or LDAPS_URL,
+        domain_base=domain_base,
+        svc_user_dn=descriptor.get('svc_user_dn') or SVC_USER_DN,
+        ssm_key=descriptor.get('ssm_key') or SSM_KEY,
+        ldap_srv_domain=descriptor.get('ldap_srv_domain') or LDAP_SRV_DOMAIN,
+        approver_group_dn=approver_group_dn)
@@ -0,0 +1,1241 @@
+import boto3
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+
+import ldap
+import ldap.asyncsearch
+import ldap.filter
+
+from ldap_maintainer import artifact_store
+from ldap_maintainer.logs import (
+    StructuredMessage,
+    configure_logging,
+    sample,
+    summarize
+)
+from ldap_maintainer.metrics import instrumented, metrics
+from ldap_maintainer.profiling import profiled
+
+from async_search import get_values_concurrently, search_concurrently
+from attribute_codecs import AttributeDecoder
+from dc_pool import (
+    LDAP_CONNECT_TIMEOUT,
+    DomainControllerPool,
+    get_domain_controller_urls
+)
+from directories import get_directory
+from process_pool import ProcessPool
+from projection import BUCKETS, Projection, get_row
+from scan_diff import (
+    CHANGE_KEYS,
+    DISABLED,
+    SCAN_INDEX_PREFIX,
+    ScanDiff,
+    dump_index
+)
+from write_scheduler import WriteScheduler, unbind
+
+
+configure_logging('ldap_maintainer.log')
+log = logging.getLogger(__name__)
+
+
+# nothing below connects to the directory or SSM at import time, so the
+# classification can be replayed offline (see replay.py). The directory's
+# settings are read from the event or the environment, see directories.py
+# how the plan action splits the directory scan: "ou" for one shard per
+# top level OU or container, "prefix" for sAMAccountName initial ranges
+SHARD_STRATEGY = os.environ.get('SHARD_STRATEGY', 'ou')
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 8))
+SHARD_PREFIX = "shards"
+# worker processes that decode and classify the search results while the
+# next page is read from the directory, 0 does it all in the handler
+CLASSIFY_WORKERS = int(os.environ.get('CLASSIFY_WORKERS', 0))
+# entries per page of search results handed to a worker
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 2000))
+# connections the query action searches the top level OUs and containers
+# over concurrently, 0 searches the whole domain in a single request
+SEARCH_CONNECTIONS = int(os.environ.get('SEARCH_CONNECTIONS', 0))
+# userAccountControl flag of disabled accounts
+ACCOUNTDISABLE = 0x2
+CHECKPOINT_PREFIX = "disable_checkpoints"
+# the users a disable run disabled, whose distros the cleanup removes
+DISABLED_USERS_PREFIX = "disabled_users"
+# users looked up per search when the disable action re-verifies them
+REVERIFY_BATCH_SIZE = int(os.environ.get('REVERIFY_BATCH_SIZE', 200))
+# remove the disabled users from the groups they are members of
+REMOVE_GROUP_MEMBERSHIPS = (
+    os.environ.get('REMOVE_GROUP_MEMBERSHIPS', 'false') == "true")
+# members deleted from a group per modify
+GROUP_MODIFY_BATCH_SIZE = int(os.environ.get('GROUP_MODIFY_BATCH_SIZE', 500))
+# seconds before the lambda times out at which the disable action stops
+# and checkpoints the users it didn't get to
+DISABLE_CHECKPOINT_MARGIN = float(
+    os.environ.get('DISABLE_CHECKPOINT_MARGIN', 30))
+
+USER_FILTER_TERMS = "(objectCategory=person)(objectClass=user)"
+USER_FILTER = f"(&{USER_FILTER_TERMS})"
+# the only attributes requested and decoded for user objects
+USER_ATTRIBUTES = [
+    "cn",
+    "description",
+    "distinguishedName",
+    "mail",
+    "objectGUID",
+    "objectSid",
+    "pwdLastSet",
+    "sAMAccountName",
+    "userAccountControl"
+]
+# sAMAccountName initials that the prefix strategy distributes over shards
+SHARD_INITIALS = "abcdefghijklmnopqrstuvwxyz0123456789"
+SEARCH_SCOPES = {
+    "base": ldap.SCOPE_BASE,
+    "onelevel": ldap.SCOPE_ONELEVEL,
+    "subtree": ldap.SCOPE_SUBTREE
+}
+
+projection = Projection()
+user_decoder = AttributeDecoder(USER_ATTRIBUTES)
+# the passwords, by SSM key, and the controller scores, by directory, are
+# kept for the lifetime of the container once the first invocation
+# connected to a directory
+_svc_user_pwds = {}
+_domain_controllers = {}
+
+
+def get_svc_user_pwd(ssm_key):
+    if ssm_key not in _svc_user_pwds:
+        _svc_user_pwds[ssm_key] = boto3.client('ssm').get_parameter(
+            Name=ssm_key,
+            WithDecryption=True
+        )['Parameter']['Value']
+    return _svc_user_pwds[ssm_key]
+
+
+def bind(uri, directory):
+    """Returns a connection to uri bound as the service account"""
+    ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+    con = ldap.initialize(uri)
+    con.set_option(ldap.OPT_REFERRALS, 0)
+    con.set_option(ldap.OPT_NETWORK_TIMEOUT, LDAP_CONNECT_TIMEOUT)
+    con.bind_s(directory.svc_user_dn, get_svc_user_pwd(directory.ssm_key))
+    return con
+
+
+def get_domain_controllers(directory):
+    if directory not in _domain_controllers:
+        _domain_controllers[directory] = DomainControllerPool(
+            get_domain_controller_urls(
+                directory.ldaps_url, directory.ldap_srv_domain),
+            lambda uri: bind(uri, directory))
+    return _domain_controllers[directory]
+
+
+def escape_guid(guid):
+    """Returns a GUID string as a filter assertion value, e.g. \\ff\\19..."""
+    return "".join(f"\\{byte:02x}" for byte in uuid.UUID(guid).bytes_le)
+
+
+class LdapMaintainer:
+
+    def __init__(self, key=None, directory=None):
+        """
+        Initialize, key (e.g. a shard id) spreads the connections of
+        parallel invocations over the domain controllers. directory is
+        the Directory to maintain, the environment's by default.
+        """
+        self.key = key
+        self.directory = directory or get_directory()
+        self.connection = self.connect()
+
+    def filetime_to_dt(self, ft):
+        """
+        Convert windowsfiletime to python datetime.
+        ref: https://gist.github.com/Mostafa-Hamdy-Elgiar/9714475f1b3bc224ea063af81566d873  # noqa: E501
+        """
+        # January 1, 1970 as MS file time
+        epoch_as_filetime = 116444736000000000
+        hundreds_of_nanoseconds = 10000000
+        return datetime.utcfromtimestamp(
+            (int(ft) - epoch_as_filetime) / hundreds_of_nanoseconds)
+
+    def connect(self):
+        """
+        Establish a connection to the LDAP server.
+        Raises NoDomainControllerAvailable when none is reachable.
+        """
+        log.debug("Attempting to connect to the LDAP server..")
+        con = get_domain_controllers(self.directory).connect(self.key)
+        log.debug("Successfully connected to LDAP server.")
+        return con
+
+    def get_connection(self):
+        """Returns the maintainer's connection, bound again once closed"""
+        if self.connection is None:
+            self.connection = self.connect()
+        return self.connection
+
+    def hand_over_connection(self):
+        """
+        Connect for a WriteScheduler: the maintainer's connection is handed
+        over on the first call, to be unbound by the scheduler, and a new
+        one is bound when the scheduler reconnects.
+        """
+        connection, self.connection = self.connection, None
+        return connection or self.connect()
+
+    def close(self):
+        """Unbinds the maintainer's connection"""
+        if self.connection is not None:
+            unbind(self.connection)
+            self.connection = None
+
+    def search(
+        self,
+        filter_string=None,
+        search_root=None,
+        scope=ldap.SCOPE_SUBTREE,
+        attrlist=None
+    ):
+        """Search LDAP using the provided filter string."""
+        results = []
+        for page in self.search_pages(
+                filter_string, search_root, scope, attrlist, page_size=0):
+            results.extend(page)
+        return results
+
+    def search_pages(
+        self,
+        filter_string=None,
+        search_root=None,
+        scope=ldap.SCOPE_SUBTREE,
+        attrlist=None,
+        page_size=SEARCH_PAGE_SIZE
+    ):
+        """
+        Search LDAP using the provided filter string, yields the results
+        in pages of page_size entries as they arrive, or all of them at
+        once when page_size is 0. The domain base is searched by default.
+        """
+        search_root = search_root or self.directory.domain_base
+        log.debug("starting search of %s with %s", search_root, filter_string)
+        ldap_async = ldap.asyncsearch.List(self.get_connection())
+        ldap_async.startSearch(
+            search_root,
+            scope,
+            filter_string,
+            attrlist
+        )
+        entries = 0
+        elapsed = 0
+        more = True
+        try:
+            while more:
+                start = time.perf_counter()
+                try:
+                    more = ldap_async.processResults(
+                        processResultsCount=page_size)
+                except ldap_async.SIZELIMIT_EXCEEDED:
+                    metrics.count("ldap.sizelimit_exceeded")
+                    log.error("Warning: Server-side size limit exceeded")
+                    more = False
+                elapsed += time.perf_counter() - start
+                page, ldap_async.allResults = ldap_async.allResults, []
+                entries += len(page)
+                if page:
+                    yield page
+        finally:
+            self.close()
+            metrics.put(
+                "ldap.search", round(elapsed * 1000, 3), "Milliseconds")
+            metrics.count("ldap.entries", entries)
+
+    @staticmethod
+    def byte_decode_search_results(search_results, decoder=user_decoder):
+        """
+        Returns the entries of the search results with their attribute
+        values decoded, search references are skipped.
+        """
+        decode = decoder.decode
+        return [
+            {"dn": dn, "user": decode(attributes)}
+            for _, (dn, attributes) in search_results
+            if dn is not None
+        ]
+
+    def search_users(self, shard=None, page_size=0):
+        """
+        Yields pages of the raw search results of all user objects, or
+        only those in the shard when one is given.
+        """
+        if not shard and SEARCH_CONNECTIONS > 0:
+            return self.search_users_concurrently(
+                page_size, SEARCH_CONNECTIONS)
+        if shard:
+            return self.search_pages(
+                f"(&{USER_FILTER_TERMS}{shard.get('filter', '')})",
+                search_root=shard['base'],
+                scope=SEARCH_SCOPES[shard['scope']],
+                attrlist=USER_ATTRIBUTES,
+                page_size=page_size)
+        return self.search_pages(
+            USER_FILTER, attrlist=USER_ATTRIBUTES, page_size=page_size)
+
+    def search_users_concurrently(
+        self,
+        page_size=0,
+        connections=SEARCH_CONNECTIONS
+    ):
+        """
+        Searches the users of every top level OU and container at once,
+        over up to `connections` connections, and yields them in pages in
+        the order of the containers.
+        """
+        searches = [
+            (
+                shard['base'],
+                SEARCH_SCOPES[shard['scope']],
+                USER_FILTER,
+                USER_ATTRIBUTES
+            )
+            for shard in self._get_container_shards()
+        ]
+        bound = [
+            self.connect() for _ in range(min(connections, len(searches)))
+        ]
+        try:
+            with metrics.timer("ldap.search"):
+                results = search_concurrently(bound, searches)
+        finally:
+            for connection in bound:
+                connection.unbind()
+        entries = [entry for result in results for entry in result]
+        metrics.count("ldap.entries", len(entries))
+        metrics.put("ldap.search_concurrency", len(searches))
+        page_size = page_size or max(len(entries), 1)
+        for start in range(0, len(entries), page_size):
+            yield entries[start:start + page_size]
+
+    def get_all_users(self, shard=None):
+        """
+        Search LDAP and return all user objects, or only those in the
+        shard when one is given.
+        """
+        results = []
+        for page in self.search_users(shard):
+            results.extend(page)
+        with metrics.timer("ldap.decode"):
+            users = self.byte_decode_search_results(results)
+        metrics.set_directory_size(len(users))
+        return users
+
+    def get_group_member_emails(self, group_dn):
+        """
+        Returns the lower cased email addresses of the direct and nested
+        members of a group.
+        """
+        # LDAP_MATCHING_RULE_IN_CHAIN walks nested group membership
+        members = self.byte_decode_search_results(self.search(
+            f"(&(objectCategory=person)(objectClass=user)"
+            f"(memberOf:1.2.840.113556.1.4.1941:="
+            f"{ldap.filter.escape_filter_chars(group_dn)}))",
+            attrlist=["mail"]))
+        return sorted({
+            member['user']['mail'][0].lower()
+            for member in members if member['user'].get('mail')
+        })
+
+    def get_shards(self, strategy=SHARD_STRATEGY, count=SHARD_COUNT):
+        """
+        Splits the directory scan into shards that can be searched
+        independently.
+
+        output:
+        [
+            {
+                "shard_id": 0,
+                "base": "OU=Staff,DC=foo,DC=bar,DC=com",
+                "scope": "subtree",
+                "filter": ""
+            },
+            ...
+        ]
+        """
+        if strategy == "ou":
+            shards = self._get_container_shards()
+        elif strategy == "prefix":
+            shards = self._get_prefix_shards(
+                count, self.directory.domain_base)
+        else:
+            shards = [
+                {"base": self.directory.domain_base, "scope": "subtree"}]
+        for shard_id, shard in enumerate(shards):
+            shard["shard_id"] = shard_id
+            shard.setdefault("filter", "")
+        return shards
+
+    def _get_container_shards(self):
+        """
+        One subtree shard per top level OU or container, plus a one level
+        shard for the users directly below the domain base.
+        """
+        containers = self.search(
+            "(|(objectClass=organizationalUnit)(objectClass=container))",
+            scope=ldap.SCOPE_ONELEVEL,
+            attrlist=["distinguishedName"])
+        shards = [{"base": self.directory.domain_base, "scope": "onelevel"}]
+        for _, (dn, _) in containers:
+            shards.append({"base": dn, "scope": "subtree"})
+        return shards
+
+    @staticmethod
+    def _get_prefix_shards(count, base):
+        """
+        Splits the sAMAccountName initials into count contiguous ranges,
+        plus a shard for names starting with any other character, of the
+        users below base.
+        """
+        count = max(1, min(count, len(SHARD_INITIALS)))
+        size, remainder = divmod(len(SHARD_INITIALS), count)
+        shards = []
+        start = 0
+        for index in range(count):
+            end = start + size + (1 if index < remainder else 0)
+            initials = "".join(
+                f"(sAMAccountName={initial}*)"
+                for initial in SHARD_INITIALS[start:end])
+            shards.append({
+                "base": base,
+                "scope": "subtree",
+                "filter": f"(|{initials})"
+            })
+            start = end
+        every_initial = "".join(
+            f"(sAMAccountName={initial}*)" for initial in SHARD_INITIALS)
+        shards.append({
+            "base": base,
+            "scope": "subtree",
+            "filter": f"(!(|{every_initial}))"
+        })
+        return shards
+
+    def get_users(self, shard=None, diff=None):
+        """
+        Returns a list of active users.
+        User accounts in the target OU that have been previously disabled
+        or configured with passwords that don't expire are ignored.
+        Disabled accounts are recorded in diff when one is given.
+        """
+        return self.filter_users(self.get_all_users(shard), diff)
+
+    @staticmethod
+    def filter_users(users, diff=None):
+        """
+        Returns the decoded user objects of the active users among users,
+        see get_users.
+        """
+
+        non_svc_users = []
+
+        # code reference:
+        # https://jackstromberg.com/2013/01/useraccountcontrol-attributeflag-values/
+        disabled_codes = [
+            514,     # Disabled Account
+            65536,   # DONT_EXPIRE_PASSWORD
+            66048,   # Enabled, Password Doesn’t Expire
+            66050,   # Disabled, Password Doesn’t Expire
+            66080,   # Disabled, Password Doesn’t Expire & Not Required
+            262658,  # Disabled, Smartcard Required
+            262690   # Disabled, Smartcard Required, Password Not Required
+        ]
+        # list of three letter prefixes to filter out of results
+        filter_prefixes = json.loads(os.environ['FILTER_PREFIXES'])
+        # list of accounts not to touch
+        hands_off = json.loads(os.environ['HANDS_OFF_ACCOUNTS'])
+        for user_obj in users:
+            try:
+                uac = user_obj['user']['userAccountControl'][0]
+                sam_name = user_obj['user']['sAMAccountName'][0]
+                if sam_name[:3] in filter_prefixes or sam_name in hands_off:
+                    continue
+                if uac not in disabled_codes:
+                    non_svc_users.append(user_obj['user'])
+                elif diff is not None and uac & ACCOUNTDISABLE:
+                    diff.add_disabled(user_obj['dn'], {
+                        "name": user_obj['user'].get('cn', [""])[0],
+                        "email": user_obj['user'].get('mail', [""])[0],
+                        "dn": user_obj['dn']
+                    })
+            except KeyError:
+                # the service account can't read every attribute of
+                # some objects
+                continue
+        # log.debug(f"found users that met filter criteria: {non_svc_users}")
+        return non_svc_users
+
+    def reverify_stale_users(
+        self,
+        user_list,
+        bucket="120",
+        batch_size=REVERIFY_BATCH_SIZE,
+        today=None,
+        groups=False
+    ):
+        """
+        Looks the listed users up again and returns the ones that are still
+        active and in bucket, with their current details, in the order of
+        user_list. With groups, every user also lists the DNs of the groups
+        it is a member of under "groups".
+
+        Users are looked up by objectGUID, which survives renames and
+        moves, or by DN when the scan didn't record one. The lookups are
+        OR filters of batch_size users, searched concurrently over the
+        maintainer's connection, so this costs a handful of searches
+        instead of a rescan. The connection stays bound for the writes
+        that follow.
+        """
+        terms = []
+        for user in user_list:
+            if user.get('guid'):
+                terms.append(f"(objectGUID={escape_guid(user['guid'])})")
+            else:
+                dn = ldap.filter.escape_filter_chars(user['dn'])
+                terms.append(f"(distinguishedName={dn})")
+        attributes = USER_ATTRIBUTES + (["memberOf"] if groups else [])
+        searches = [
+            (
+                self.directory.domain_base,
+                ldap.SCOPE_SUBTREE,
+                f"(&{USER_FILTER_TERMS}"
+                f"(|{''.join(terms[start:start + batch_size])}))",
+                attributes
+            )
+            for start in range(0, len(terms), batch_size)
+        ]
+        if not searches:
+            return []
+        with metrics.timer("ldap.reverify"):
+            results = search_concurrently([self.get_connection()], searches)
+        metrics.count("ldap.reverify_searches", len(searches))
+        entries = self.byte_decode_search_results(
+            [entry for result in results for entry in result])
+        stale_users = {"120": [], "90": [], "60": [], "never": []}
+        self.classify_users(
+            self.filter_users(entries), stale_users, today or datetime.now())
+        member_of = {
+            entry['dn'].lower(): entry['user'].get('memberOf', [])
+            for entry in entries
+        }
+        by_guid = {}
+        by_dn = {}
+        for user in stale_users[bucket]:
+            if groups:
+                user['groups'] = member_of.get(user['dn'].lower(), [])
+            by_guid[user['guid']] = user
+            by_dn[user['dn'].lower()] = user
+        return [
+            current for current in (
+                by_guid.get(user['guid']) if user.get('guid')
+                else by_dn.get(user['dn'].lower())
+                for user in user_list
+            )
+            if current is not None
+        ]
+
+    def disable_users(self, user_list, should_stop=lambda: False):
+        """
+        Disables the users at the pace the directory allows.
+        Returns the users that could not be disabled and the ones left
+        over because should_stop returned True.
+        """
+        date = datetime.now().strftime("%Y-%m-%d-T%H%M")
+        d = f"***Disabled {date} by ldapmaintbot***"
+        operations = [
+            (user_obj['dn'], [
+                (ldap.MOD_REPLACE, 'userAccountControl', [b'66050']),
+                (ldap.MOD_REPLACE, 'description', [d.encode('utf-8')])
+            ])
+            for user_obj in user_list
+        ]
+        scheduler = WriteScheduler(self.hand_over_connection)
+        with metrics.timer("ldap.disable"):
+            succeeded, failed, remaining = scheduler.run(
+                operations, should_stop)
+        for index, error in failed:
+            log.error(
+                "Failed to disable %s: %s", user_list[index]['dn'], error)
+        metrics.count("users.disabled", len(succeeded))
+        metrics.count("users.disable_failed", len(failed))
+        return (
+            [user_list[index] for index, _ in failed],
+            [user_list[index] for index in remaining]
+        )
+
+    def remove_group_memberships(self, user_list, should_stop=lambda: False):
+        """
+        Removes the users from the groups listed under their "groups" with
+        one modify per group (of up to GROUP_MODIFY_BATCH_SIZE members)
+        instead of one per user and group.
+
+        A MOD_DELETE of a member that is gone fails the whole modify, so
+        the current members of every group are read first, in ranges for
+        large groups, and only those still present are deleted. The retry
+        of a delete whose result was lost fails with NO_SUCH_ATTRIBUTE
+        when the first attempt went through, it counts as removed.
+        Returns the users with the groups they are still to be removed
+        from because should_stop returned True.
+        """
+        removals = {}
+        for user in user_list:
+            for group_dn in user.get('groups', ()):
+                removals.setdefault(group_dn, []).append(user['dn'])
+        if not removals:
+            return []
+        if should_stop():
+            return [user for user in user_list if user.get('groups')]
+        with metrics.timer("ldap.group_members"):
+            members = get_values_concurrently(
+                [self.get_connection()], list(removals), "member")
+        operations = []
+        for group_dn, user_dns in removals.items():
+            current = {
+                member.decode("utf-8", "backslashreplace").lower()
+                for member in members[group_dn]
+            }
+            present = [
+                dn.encode('utf-8') for dn in user_dns if dn.lower() in current
+            ]
+            for start in range(0, len(present), GROUP_MODIFY_BATCH_SIZE):
+                batch = present[start:start + GROUP_MODIFY_BATCH_SIZE]
+                operations.append(
+                    (group_dn, [(ldap.MOD_DELETE, 'member', batch)]))
+        scheduler = WriteScheduler(self.hand_over_connection)
+        with metrics.timer("ldap.group_cleanup"):
+            # the retry of a delete that went through finds the members
+            # gone
+            succeeded, failed, remaining = scheduler.run(
+                operations, should_stop, applied=(ldap.NO_SUCH_ATTRIBUTE,))
+        for index, error in failed:
+            log.error(
+                "Failed to remove %s members from %s: %s",
+                len(operations[index][1][0][2]), operations[index][0], error)
+        metrics.count("groups.modified", len(succeeded))
+        metrics.count("groups.memberships_removed", sum(
+            len(operations[index][1][0][2]) for index in succeeded))
+        left = {}
+        for index in remaining:
+            group_dn, modlist = operations[index]
+            for member in modlist[0][2]:
+                left.setdefault(member.decode('utf-8').lower(), []).append(
+                    group_dn)
+        return [
+            dict(user, groups=left[user['dn'].lower()])
+            for user in user_list if user['dn'].lower() in left
+        ]
+
+    def get_stale_users(self, shard=None, rows=None, diff=None, today=None):
+        """
+        Returns map of users that have not logged on
+        in 120, 90, and 60 day increments, as of today (by default now)
+
+        When rows is a list, the projection row of every active user,
+        stale or not, is appended to it. Every user is also recorded in
+        diff when one is given.
+
+        example:
+        {
+            "120": [
+                {
+                    "name" = "Jane Doe",
+                    "email" = "jane.doe@someemail.com",
+                    "dn" = ""
+
+                }
+            ]
+            "90": [userobj0, userobj1, etc..]
+            "60": [userobj0, userobj1, etc..]
+            "never": [userobj0, userobj1, etc..]
+        }
+        """
+        stale_users = {
+            "120": [],
+            "90": [],
+            "60": [],
+            "never": []
+        }
+        today = today or datetime.now()
+        if CLASSIFY_WORKERS > 0:
+            self.classify_in_workers(
+                shard, stale_users, today, rows, diff, CLASSIFY_WORKERS)
+        else:
+            self.classify_serially(shard, stale_users, today, rows, diff)
+        for key in stale_users:
+            metrics.count(f"users.stale.{key}", len(stale_users[key]))
+        # log.debug(f"retrieved the following stale users: {stale_users}")
+        return stale_users
+
+    def classify_serially(
+        self,
+        shard,
+        stale_users,
+        today,
+        rows=None,
+        diff=None
+    ):
+        """
+        Decodes, filters and classifies all the users at once, see
+        get_stale_users.
+        """
+        users = self.get_users(shard, diff)
+        with metrics.timer("classify"):
+            self.classify_users(users, stale_users, today, rows, diff)
+
+    def classify_users(self, users, stale_users, today, rows=None, diff=None):
+        """
+        Adds the active users that are stale as of today to the buckets of
+        stale_users, see get_stale_users.
+        """
+        debug = log.isEnabledFor(logging.DEBUG)
+        for user_obj in users:
+            try:
+                ft = user_obj['pwdLastSet'][0]
+                desc = user_obj['description'][0]
+                pwd_last_set = self.filetime_to_dt(ft)
+                days = (today - pwd_last_set).days
+                user = {
+                    "name": user_obj['cn'][0],
+                    "email": user_obj['mail'][0],
+                    "dn": user_obj['distinguishedName'][0],
+                    "guid": user_obj.get('objectGUID', [None])[0],
+                    "days_since_last_pwd_change": days
+                }
+                if debug and sample("classify"):
+                    log.debug(
+                        "processing user: %s, got user: %s",
+                        summarize(user_obj), user)
+                # if employeeType is set to DTU assume the user is a
+                # test user
+                if days >= 120 or desc == "Test account":
+                    bucket = "120"
+                elif days >= 90:
+                    bucket = "90"
+                elif days >= 60:
+                    bucket = "60"
+                else:
+                    bucket = None
+                if bucket:
+                    stale_users[bucket].append(user)
+                if rows is not None:
+                    rows.append(
+                        get_row(user_obj, bucket, self.directory.name))
+                if diff is not None:
+                    diff.add(user['dn'], bucket, user)
+            except KeyError:
+                continue
+
+    def classify_page(self, page, today, diff=None, rows=False):
+        """
+        Decodes, filters and classifies a page of search results on its
+        own, recording the users in a ScanDiff of the page when diff is
+        given. The results are merged by merge_pages.
+        """
+        page_diff = None if diff is None else ScanDiff(diff.previous)
+        page_stale = {key: [] for key in BUCKETS}
+        page_rows = [] if rows else None
+        users = self.byte_decode_search_results(page)
+        self.classify_users(
+            self.filter_users(users, page_diff),
+            page_stale, today, page_rows, page_diff)
+        return {
+            "entries": len(users),
+            "stale_users": page_stale,
+            "rows": page_rows,
+            "index": page_diff and page_diff.index,
+            "changes": page_diff and page_diff.changes
+        }
+
+    @staticmethod
+    def merge_pages(results, stale_users, rows=None, diff=None):
+        """
+        Merges the results of classify_page in search order and the scan
+        index in the order the serial path builds it (disabled users
+        first), so the results are identical to those of get_users and
+        classify_users. Returns the number of entries.
+        """
+        entries = 0
+        disabled = {}
+        active = {}
+        for result in results:
+            entries += result['entries']
+            for key, users in result['stale_users'].items():
+                stale_users[key].extend(users)
+            if rows is not None:
+                rows.extend(result['rows'])
+            if diff is not None:
+                for key, state in result['index'].items():
+                    if state == DISABLED:
+                        disabled[key] = state
+                    else:
+                        active[key] = state
+                diff.merge({}, result['changes'])
+        if diff is not None:
+            diff.index.update(disabled)
+            diff.index.update(active)
+        return entries
+
+    def classify_in_workers(
+        self,
+        shard,
+        stale_users,
+        today,
+        rows=None,
+        diff=None,
+        workers=CLASSIFY_WORKERS
+    ):
+        """
+        Decodes, filters and classifies the users in worker processes,
+        one page of search results at a time, while the next page is read
+        from the directory.
+        """
+        def classify_page(page):
+            return self.classify_page(page, today, diff, rows is not None)
+
+        with metrics.timer("classify"), ProcessPool(
+                classify_page, workers) as pool:
+            entries = self.merge_pages(
+                pool.imap(self.search_users(shard, SEARCH_PAGE_SIZE)),
+                stale_users, rows, diff)
+        metrics.set_directory_size(entries)
+        metrics.put("classify.workers", workers)
+
+    def get_ldif(self):
+        """Creates a ldif document with the query results"""
+        # could be an alternative way of user disablement
+
+
+def create_table(content):
+    """
+    Serializes the stale user map as json with one user per line
+
+    The output is still a single json document but keeping each user on
+    its own line lets consumers (e.g. the slack notifier) stream a single
+    bucket out of the artifact without loading the entire table.
+
+    example:
+    {
+    "120": [
+    {"name": "Jane Doe", ...},
+    {"name": "John Smith", ...}
+    ],
+    "90": [
+    ]
+    }
+    """
+    buckets = []
+    for key in content:
+        users = ",\n".join(json.dumps(user) for user in content[key])
+        buckets.append(f"{json.dumps(key)}: [\n{users}\n]")
+    return "{\n" + ",\n".join(buckets) + "\n}"
+
+
+def generate_artifacts(content, changes=None):
+    """Returns the list of objects to upload to s3"""
+    artifacts = {}
+    artifacts['user_expiration_table'] = create_table(content)
+    if changes is not None:
+        artifacts['user_expiration_diff'] = create_table(changes)
+    # artifacts.append(LdapMaintainer().get_ldif())
+    return artifacts
+
+
+def upload_artifacts(content, changes=None, directory=None):
+    """
+    Uploads the generated artifacts to s3
+
+    Returns a tuple of the presigned urls and the object keys of the
+    uploaded artifacts, both keyed by artifact name.
+    """
+    directory = directory or get_directory()
+    presigned_urls = {}
+    object_names = {}
+    with metrics.timer("artifacts.serialize"):
+        artifacts = generate_artifacts(content, changes)
+    log.debug("generated artifacts: %s", summarize(artifacts))
+    timestamp = datetime.now().strftime("%Y-%m-%d-T%H%M%S.%f")
+    for key in artifacts:
+        object_name = directory.get_key(f"{key}-{timestamp}.json")
+        log.debug("Uploading object: %s", object_name)
+        with metrics.timer("s3.upload"):
+            uploaded = artifact_store.put_object(
+                object_name, artifacts[key])
+        if uploaded:
+            presigned_urls[key] = artifact_store.create_presigned_url(
+                object_name)
+            object_names[key] = object_name
+        else:
+            log.error('Encountered error when uploading artifact')
+    return presigned_urls, object_names
+
+
+def upload_approvers(emails, directory=None):
+    """
+    Publishes the members of the approver group so the slack listener can
+    authorize button presses without querying LDAP. Every directory
+    publishes its own list (approvers/emea/approvers-...), the listener
+    accepts the members of any of them.
+    """
+    directory = directory or get_directory()
+    timestamp = datetime.now().strftime("%Y-%m-%d-T%H%M%S.%f")
+    object_name = f"approvers-{timestamp}.json"
+    if directory.name:
+        object_name = f"approvers/{directory.name}/{object_name}"
+    log.debug("Uploading object: %s", object_name)
+    if not artifact_store.put_json(object_name, emails):
+        log.error('Encountered error when uploading the approver list')
+
+
+def upload_scan_index(index, directory=None):
+    """Publishes the index of the scan the next scan is compared to"""
+    directory = directory or get_directory()
+    timestamp = datetime.now().strftime("%Y-%m-%d-T%H%M%S.%f")
+    object_name = directory.get_key(f"{SCAN_INDEX_PREFIX}-{timestamp}.json")
+    with metrics.timer("s3.upload"):
+        uploaded = artifact_store.put_object(object_name, dump_index(index))
+    if not uploaded:
+        log.error('Encountered error when uploading the scan index')
+
+
+def get_previous_scan_index(directory=None):
+    """Returns the index of the last scan, None before the first scan"""
+    directory = directory or get_directory()
+    with metrics.timer("s3.download"):
+        try:
+            return artifact_store.get_latest_json(
+                directory.get_key(SCAN_INDEX_PREFIX))
+        except KeyError:
+            log.info("No previous scan index, reporting every user as new")
+            return None
+
+
+def get_user_counts(users):
+    response = {}
+    for key in users:
+        response[key] = len(users[key])
+    return response
+
+
+def upload_shard_results(
+        run_id, shard_id, users, seen=None, diff=None, directory=None):
+    """
+    Uploads the stale users found in one shard, the DNs of the users it
+    added to the projection and its part of the scan diff, returns the
+    object key
+    """
+    directory = directory or get_directory()
+    object_name = directory.get_key(f"{SHARD_PREFIX}/{run_id}/{shard_id}.json")
+    content = dict(users)
+    if seen is not None:
+        content["seen"] = seen
+    if diff is not None:
+        content["index"] = list(diff.index.items())
+        for key in CHANGE_KEYS:
+            content[f"changes.{key}"] = diff.changes[key]
+    with metrics.timer("s3.upload"):
+        uploaded = artifact_store.put_object(
+            object_name, create_table(content))
+    if not uploaded:
+        # fail the shard so the state machine retries it
+        raise RuntimeError(f"Failed to upload shard results {object_name}")
+    return object_name
+
+
+def merge_shard_results(shard_results, seen=None, diff=None):
+    """
+    Combines the partial results of every shard, in shard order, into a
+    single stale user map. The projection DNs seen by the shards are
+    appended to seen when it is a list and their diffs are merged into
+    diff when one is given.
+    """
+    users = {
+        "120": [],
+        "90": [],
+        "60": [],
+        "never": []
+    }
+    for result in sorted(shard_results, key=lambda r: r['shard_id']):
+        with metrics.timer("s3.download"):
+            content = artifact_store.get_json(result['key'])
+        for key in users:
+            users[key].extend(content.get(key, []))
+        if seen is not None:
+            seen.extend(content.get("seen", []))
+        if diff is not None:
+            diff.merge(
+                dict(content.get("index", [])),
+                {key: content.get(f"changes.{key}", [])
+                 for key in CHANGE_KEYS})
+    metrics.count("shards", len(shard_results))
+    return users
+
+
+def publish_scan_results(users, diff=None, directory=None):
+    """
+    Uploads the artifacts of a directory scan, its index and the approver
+    list and returns the summary passed on to the slack notifier.
+    """
+    directory = directory or get_directory()
+    query_results = {"totals": get_user_counts(users)}
+    changes = None
+    if diff is not None:
+        query_results["changes"] = diff.finish()
+        changes = diff.changes
+        upload_scan_index(diff.index, directory)
+    artifact_urls, artifact_keys = upload_artifacts(users, changes, directory)
+    if directory.approver_group_dn:
+        upload_approvers(
+            LdapMaintainer(directory=directory).get_group_member_emails(
+                directory.approver_group_dn),
+            directory)
+    return {
+        "directory": directory.name,
+        "query_results": query_results,
+        "artifact_urls": artifact_urls,
+        "artifact_keys": artifact_keys,
+        }
+
+
+def update_projection(rows, scan_id, complete=True, directory=None):
+    """
+    Applies the rows of a scan to the projection. A complete scan also
+    removes the rows of the users it didn't see.
+    """
+    projection.update(rows, scan_id)
+    if complete:
+        finish_projection(scan_id, (row['dn'] for row in rows), directory)
+
+
+def finish_projection(scan_id, seen_dns, directory=None):
+    """
+    Removes the rows of the directory's users the scan didn't see and
+    records the scan. The rows of the other directories are kept.
+    """
+    directory = directory or get_directory()
+    projection.remove_unseen(seen_dns, directory.name)
+    projection.record_scan(
+        scan_id,
+        projection.query({"directory": directory.name})['totals'],
+        directory.name)
+
+
+def save_checkpoint(users, disabled=(), directory=None):
+    """
+    Saves the users a disable run didn't get to and those it disabled so
+    far, returns the key
+    """
+    directory = directory or get_directory()
+    timestamp = datetime.now().strftime("%Y-%m-%d-T%H%M%S.%f")
+    object_name = directory.get_key(f"{CHECKPOINT_PREFIX}/{timestamp}.json")
+    checkpoint = {"users": users, "disabled": list(disabled)}
+    if not artifact_store.put_json(object_name, checkpoint):
+        raise RuntimeError(f"Failed to save the checkpoint {object_name}")
+    return object_name
+
+
+def load_checkpoint(object_name):
+    """Returns the users left to disable and those already disabled"""
+    with metrics.timer("s3.download"):
+        checkpoint = artifact_store.get_json(object_name)
+    # checkpoints used to be the list of users left
+    if isinstance(checkpoint, list):
+        return checkpoint, []
+    return checkpoint['users'], list(checkpoint['disabled'])
+
+
+def save_disabled_users(users, directory=None):
+    """
+    Publishes the users a disable run disabled for the dynamodb cleanup,
+    returns the key
+    """
+    directory = directory or get_directory()
+    timestamp = datetime.now().strftime("%Y-%m-%d-T%H%M%S.%f")
+    object_name = directory.get_key(
+        f"{DISABLED_USERS_PREFIX}-{timestamp}.json")
+    if not artifact_store.put_json(object_name, users):
+        raise RuntimeError(f"Failed to save the disabled users {object_name}")
+    return object_name
+
+
+def get_previous_scan_results(directory=None):
+    directory = directory or get_directory()
+    with metrics.timer("s3.download"):
+        return artifact_store.get_latest_json(
+            directory.get_key('user_expiration_table'))
+
+
+@instrumented
+@profiled
+def handler(event, context):
+    """
+    expected event:
+    {
+        "action": query | plan | scan-shard | merge | disable | projection
+    }
+
+    plan, scan-shard and merge split the query across the shards of a
+    step functions Map state:
+    plan -> {"run_id": "...", "shards": [shard, ...]}
+    {"action": "scan-shard", "run_id": "...", "shard": shard}
+        -> {"shard_id": 0, "key": "shards/...", "totals": {...}}
+    {"action": "merge", "run_id": "...", "shards": [scan-shard results]}
+        -> the same output as query
+
+    disable stops before the lambda times out and saves the users it
+    didn't get to, they are disabled by invoking it again with the
+    checkpoint:
+    {"action": "disable", "checkpoint": "disable_checkpoints/..."}
+        -> {"status": "complete" | "incomplete", "checkpoint": "..."}
+    once complete it publishes the users it disabled for the cleanup:
+        -> {"status": "complete", "disabled": "disabled_users-..."}
+
+    projection answers ad-hoc queries against the DynamoDB projection of
+    the last scan, see Projection.query:
+    {"action": "projection", "query": "counts", "parent": "OU=..."}
+
+    every action acts on the directory described by the event's
+    directory field, or the environment's, see directories.py:
+    {"action": "plan", "directory": {"name": "emea", ...}}
+    """
+    log.debug("Received event: %s", summarize(event))
+    if event.get('Input'):
+        event = event['Input']
+    if event.get("action"):
+        directory = get_directory(event.get('directory'))
+        if directory.name:
+            metrics.set_dimension("Directory", directory.name)
+        if event['action'] == "query":
+            rows = [] if projection.enabled else None
+            diff = ScanDiff(get_previous_scan_index(directory))
+            users = LdapMaintainer(directory=directory).get_stale_users(
+                rows=rows, diff=diff)
+            if projection.enabled:
+                update_projection(
+                    rows,
+                    datetime.now().strftime("%Y-%m-%d-T%H%M%S.%f"),
+                    directory=directory)
+            # users = {
+            #     "120": ["user1", "user2", "user3"],
+            #     "90": ["user1", "user2", "user3"],
+            #     "60": ["user1", "user2", "user3"],
+            #     "never": ["user1", "user2", "user3"],
+            # }
+            log.debug("Ldap query results: %s", summarize(users))
+            return publish_scan_results(users, diff, directory)
+        elif event['action'] == "plan":
+            shards = LdapMaintainer(directory=directory).get_shards()
+            log.info("Planned %s shards", len(shards))
+            return {
+                "run_id": datetime.now().strftime("%Y-%m-%d-T%H%M%S.%f"),
+                "shards": shards
+            }
+        elif event['action'] == "scan-shard":
+            shard = event['shard']
+            rows = [] if projection.enabled else None
+            diff = ScanDiff(get_previous_scan_index(directory))
+            users = LdapMaintainer(
+                shard['shard_id'], directory).get_stale_users(
+                    shard, rows, diff)
+            seen = None
+            if projection.enabled:
+                update_projection(rows, event['run_id'], complete=False)
+                seen = [row['dn'] for row in rows]
+            return {
+                "shard_id": shard['shard_id'],
+                "key": upload_shard_results(
+                    event['run_id'], shard['shard_id'], users, seen, diff,
+                    directory),
+                "totals": get_user_counts(users)
+            }
+        elif event['action'] == "merge":
+            seen = [] if projection.enabled else None
+            diff = ScanDiff(get_previous_scan_index(directory))
+            users = merge_shard_results(event['shards'], seen, diff)
+            if projection.enabled:
+                finish_projection(event['run_id'], seen, directory)
+            log.debug("Merged shard results: %s", summarize(users))
+            return publish_scan_results(users, diff, directory)
+        elif event['action'] == "disable":
+            def should_stop():
+                return (
+                    context is not None and
+                    context.get_remaining_time_in_millis() <
+                    DISABLE_CHECKPOINT_MARGIN * 1000)
+
+            # only the users disabled here lose their distros
+            disabled = []
+            # one connection for the lookups and writes of the invocation
+            maintainer = LdapMaintainer(directory=directory)
+            try:
+                if event.get('checkpoint'):
+                    users, disabled = load_checkpoint(event['checkpoint'])
+                else:
+                    approved = get_previous_scan_results(directory)['120']
+                    # the approval may have waited for hours, skip the users
+                    # that changed their password or were disabled meanwhile
+                    users = maintainer.reverify_stale_users(
+                        approved, groups=REMOVE_GROUP_MEMBERSHIPS)
+                    verified = {user['guid'] for user in users}
+                    verified.update(user['dn'].lower() for user in users)
+                    skipped = [
+                        user['dn'] for user in approved
+                        if (user.get('guid') or user['dn'].lower())
+                        not in verified
+                    ]
+                    metrics.count("users.reverify_skipped", len(skipped))
+                    if skipped:
+                        log.info(StructuredMessage(
+                            "Skipping users that are no longer stale",
+                            count=len(skipped), users=skipped))
+                log.info(StructuredMessage(
+                    "Disabling users", count=len(users), users=users))
+                # users of a checkpoint that are disabled but still in groups
+                leaving = [user for user in users if user.get('disabled')]
+                users = [user for user in users if not user.get('disabled')]
+                failed, remaining = maintainer.disable_users(
+                    users, should_stop)
+                not_disabled = {user['dn'] for user in failed + remaining}
+                disabled.extend(
+                    user for user in users if user['dn'] not in not_disabled)
+                if REMOVE_GROUP_MEMBERSHIPS:
+                    leaving.extend(
+                        dict(user, disabled=True) for user in users
+                        if user['dn'] not in not_disabled and
+                        user.get('groups'))
+                    remaining.extend(maintainer.remove_group_memberships(
+                        leaving, should_stop))
+            finally:
+                maintainer.close()
+            if remaining:
+                checkpoint = save_checkpoint(remaining, disabled, directory)
+                log.info(
+                    "Ran out of time, %s users left in %s",
+                    len(remaining), checkpoint)
+                return {
+                    "status": "incomplete",
+                    "checkpoint": checkpoint,
+                    "failed": len(failed)
+                }
+            log.info("Users successfully disabled")
+            return {
+                "status": "complete",
+                "failed": len(failed),
+                "disabled": save_disabled_users(disabled, directory)
+            }
+        elif event['action'] == "projection":
+            if not projection.enabled:
+                raise ValueError("PROJECTION_TABLE is not configured")
+            return projection.query(dict(event, directory=directory.name))
@@ -0,0 +1,106 @@
+"""
+A pool of forked worker processes connected by pipes.
+
+Lambda has no /dev/shm, so multiprocessing.Pool and Queue, which need
+POSIX semaphores, can't be used. The workers of this pool are plain
+forked processes that each own one end of a Pipe (a socket pair). Tasks
+are handed out round robin, one per worker at a time, and the results are
+read back in the order the tasks were submitted, so whatever merges them
+sees them in the same order as if they had been computed serially.
+
+The workers are forked when the pool is created and inherit the parent's
+memory: the function they apply and any read-only state it uses (e.g.
+the index of the previous scan) are not pickled, only the tasks and the
+results cross the pipes. Metrics recorded in a worker are lost.
+"""
+import logging
+import multiprocessing
+import traceback
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class WorkerError(Exception):
+    """Raised when a task failed in a worker or a worker died"""
+
+
+def _work(function, connection):
+    """Applies function to the tasks received until the pool is closed"""
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            result = (True, function(task))
+        except Exception:
+            result = (False, traceback.format_exc())
+        connection.send(result)
+    connection.close()
+
+
+class ProcessPool:
+
+    def __init__(self, function, workers):
+        context = multiprocessing.get_context("fork")
+        self.connections = []
+        self.processes = []
+        for _ in range(max(workers, 1)):
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=_work, args=(function, child), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        log.debug("Started %s workers", len(self.processes))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _receive(connection):
+        try:
+            ok, result = connection.recv()
+        except EOFError:
+            raise WorkerError("A worker exited unexpectedly")
+        if not ok:
+            raise WorkerError(f"A task failed in a worker:\n{result}")
+        return result
+
+    def imap(self, tasks):
+        """
+        Applies the function to every task and yields the results in the
+        order of the tasks. tasks is consumed lazily, e.g. the next page
+        of a search is read while the workers process the previous ones.
+        """
+        pending = deque()
+        for index, task in enumerate(tasks):
+            if len(pending) == len(self.connections):
+                # the oldest task ran on the worker whose turn it is
+                yield self._receive(pending.popleft())
+            connection = self.connections[index % len(self.connections)]
+            connection.send(task)
+            pending.append(connection)
+        while pending:
+            yield self._receive(pending.popleft())
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.connections = []
+        self.processes = []
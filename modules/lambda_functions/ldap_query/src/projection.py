@@ -0,0 +1,300 @@
+"""
+A DynamoDB projection of the scanned directory, keyed by DN.
+
+Every active user considered by a scan has a row holding the attributes
+the maintainer acts on (pwdLastSet, userAccountControl, mail, ...) and,
+when the user is stale, its bucket. Users that are not stale have no
+bucket attribute so the bucket-index GSI is sparse: it only holds the
+users the notifier reports and the disable step acts on.
+
+Scans update the table incrementally: the stored row hashes are read back
+in batches and only new or changed rows are written, each tagged with the
+id of the scan that wrote it. Rows of users that a complete scan did not
+see any more are deleted, so every row in the table was seen by the scan
+recorded in the SCAN_ITEM_DN item.
+
+The directories of a deployment that maintains several share the table:
+every row is tagged with the name of its directory (DEFAULT_DIRECTORY for
+the environment's), a scan only deletes the rows of its own directory,
+read from the directory-index GSI, and records itself in a scan item of
+its own (#scan:emea). Counts are per directory too, the domain base of a
+parent domain is a suffix of the DNs of its child domains.
+
+The projection is disabled when PROJECTION_TABLE is unset.
+"""
+import hashlib
+import logging
+import os
+import re
+from datetime import datetime
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import Attr, Key
+
+from ldap_maintainer.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+PROJECTION_TABLE = os.environ.get('PROJECTION_TABLE', '')
+BUCKET_INDEX = "bucket-index"
+DIRECTORY_INDEX = "directory-index"
+# the directory tag of the environment's directory, GSI keys can't be empty
+DEFAULT_DIRECTORY = "#default"
+BUCKETS = ("120", "90", "60", "never")
+# the item that records the last scan applied to the table
+SCAN_ITEM_DN = "#scan"
+# BatchGetItem accepts at most 100 keys per request
+BATCH_GET_SIZE = 100
+
+
+def get_parent_dn(dn):
+    """Returns the DN of the OU or container holding dn"""
+    parts = re.split(r"(?<!\\),", dn, maxsplit=1)
+    return parts[1] if len(parts) > 1 else ""
+
+
+def get_directory_tag(directory=""):
+    return directory or DEFAULT_DIRECTORY
+
+
+def is_below(dn, base):
+    """Returns whether dn is base or an object below it"""
+    dn = dn.lower()
+    base = base.lower()
+    return dn == base or dn.endswith("," + base)
+
+
+def get_row(user_obj, bucket=None, directory=""):
+    """
+    Returns the projection row of a decoded user object, bucket is the
+    stale user bucket the user was classified in, if any, and directory
+    the name of the directory it was read from.
+    """
+    dn = user_obj['distinguishedName'][0]
+    row = {
+        "dn": dn,
+        "directory": get_directory_tag(directory),
+        "parent": get_parent_dn(dn),
+        "name": user_obj['cn'][0],
+        "mail": user_obj['mail'][0],
+        "sam_account_name": user_obj['sAMAccountName'][0],
+        "uac": user_obj['userAccountControl'][0],
+        "pwd_last_set": user_obj['pwdLastSet'][0],
+    }
+    if bucket:
+        row["bucket"] = bucket
+    row["row_hash"] = hashlib.sha1(
+        "\0".join(str(row.get(key, "")) for key in sorted(row)).encode(
+            "utf-8")).hexdigest()[:16]
+    return row
+
+
+def to_json_types(value):
+    """Converts the Decimals DynamoDB returns so the value is serializable"""
+    if isinstance(value, dict):
+        return {key: to_json_types(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_json_types(item) for item in value]
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    return value
+
+
+class Projection:
+
+    def __init__(self, table_name=PROJECTION_TABLE):
+        self.table_name = table_name
+        self.dynamodb = None
+        self.table = None
+        if table_name:
+            self.dynamodb = boto3.resource('dynamodb')
+            self.table = self.dynamodb.Table(table_name)
+
+    @property
+    def enabled(self):
+        return self.table is not None
+
+    def get_row_hashes(self, dns):
+        """Returns the stored row hash of every dn that has a row"""
+        hashes = {}
+        dns = list(dns)
+        for start in range(0, len(dns), BATCH_GET_SIZE):
+            batch = dns[start:start + BATCH_GET_SIZE]
+            request = {self.table_name: {
+                "Keys": [{"dn": dn} for dn in batch],
+                "ProjectionExpression": "dn, row_hash"
+            }}
+            while request:
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.table_name, []):
+                    hashes[item['dn']] = item.get('row_hash')
+                request = response.get('UnprocessedKeys')
+        return hashes
+
+    def update(self, rows, scan_id):
+        """
+        Writes the rows that are new or changed since the last scan and
+        returns the number of rows written.
+        """
+        with metrics.timer("projection.read"):
+            stored = self.get_row_hashes(row['dn'] for row in rows)
+        changed = [
+            row for row in rows if stored.get(row['dn']) != row['row_hash']
+        ]
+        with metrics.timer("projection.write"):
+            with self.table.batch_writer(overwrite_by_pkeys=["dn"]) as batch:
+                for row in changed:
+                    batch.put_item(Item=dict(row, scan_id=scan_id))
+        metrics.count("projection.rows", len(rows))
+        metrics.count("projection.written", len(changed))
+        log.info(
+            "Projection: %s of %s rows changed", len(changed), len(rows))
+        return len(changed)
+
+    def remove_unseen(self, seen_dns, directory=""):
+        """
+        Deletes the rows of the directory's users that a complete scan did
+        not see, e.g. users that were disabled or removed since the last
+        scan.
+        """
+        seen_dns = set(seen_dns)
+        unseen = []
+        with metrics.timer("projection.scan"):
+            kwargs = {
+                "IndexName": DIRECTORY_INDEX,
+                "KeyConditionExpression": Key("directory").eq(
+                    get_directory_tag(directory))
+            }
+            while True:
+                response = self.table.query(**kwargs)
+                unseen.extend(
+                    item['dn'] for item in response['Items']
+                    if item['dn'] not in seen_dns)
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        with metrics.timer("projection.write"):
+            with self.table.batch_writer() as batch:
+                for dn in unseen:
+                    batch.delete_item(Key={"dn": dn})
+        metrics.count("projection.removed", len(unseen))
+        return len(unseen)
+
+    @staticmethod
+    def get_scan_item_dn(directory=""):
+        return f"{SCAN_ITEM_DN}:{directory}" if directory else SCAN_ITEM_DN
+
+    def record_scan(self, scan_id, totals, directory=""):
+        self.table.put_item(Item={
+            "dn": self.get_scan_item_dn(directory),
+            "scan_id": scan_id,
+            "updated_at": datetime.now().isoformat(),
+            "totals": totals
+        })
+
+    def get_last_scan(self, directory=""):
+        return self.table.get_item(
+            Key={"dn": self.get_scan_item_dn(directory)}).get('Item')
+
+    def get_user(self, dn):
+        return self.table.get_item(Key={"dn": dn}).get('Item')
+
+    def count_bucket(self, bucket, parent=None, directory=None):
+        """
+        Returns the number of users in bucket, only counting those of
+        directory and below the parent OU when they are given.
+        """
+        kwargs = {
+            "IndexName": BUCKET_INDEX,
+            "KeyConditionExpression": Key("bucket").eq(bucket),
+            "Select": "COUNT"
+        }
+        if directory is not None:
+            kwargs["FilterExpression"] = Attr("directory").eq(
+                get_directory_tag(directory))
+        if parent:
+            # DynamoDB has no ends with condition, the parents are
+            # compared here
+            kwargs["Select"] = "SPECIFIC_ATTRIBUTES"
+            kwargs["ProjectionExpression"] = "parent"
+        count = 0
+        while True:
+            response = self.table.query(**kwargs)
+            if parent:
+                count += sum(
+                    1 for item in response['Items']
+                    if is_below(item['parent'], parent))
+            else:
+                count += response['Count']
+            if 'LastEvaluatedKey' not in response:
+                return count
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def get_bucket(self, bucket, limit=100, start=None, directory=None):
+        """
+        Returns a page of up to limit users in bucket, ordered by DN, only
+        those of directory when it is given, and the DN to start the next
+        page from.
+        """
+        kwargs = {
+            "IndexName": BUCKET_INDEX,
+            "KeyConditionExpression": Key("bucket").eq(bucket)
+        }
+        if directory is not None:
+            kwargs["FilterExpression"] = Attr("directory").eq(
+                get_directory_tag(directory))
+        if start:
+            kwargs["ExclusiveStartKey"] = {"bucket": bucket, "dn": start}
+        users = []
+        next_start = None
+        # the filter applies after Limit, a query can return a short or
+        # empty page with more users after it
+        while len(users) < limit:
+            kwargs["Limit"] = limit - len(users)
+            response = self.table.query(**kwargs)
+            users.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                next_start = None
+                break
+            next_start = response['LastEvaluatedKey']['dn']
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return users, next_start
+
+    def query(self, request):
+        """
+        Answers an ad-hoc query against the projection
+
+        {"query": "counts", "parent": "OU=Staff,DC=...", "directory": ""}
+            -> {"scan": {...}, "totals": {"120": 3, ...}}
+        {"query": "bucket", "bucket": "120", "limit": 100, "start": dn,
+         "directory": ""}
+            -> {"users": [...], "next": dn}
+        {"query": "user", "dn": "CN=Jane Doe,..."}
+            -> {"user": {...}}
+        """
+        kind = request.get('query', 'counts')
+        with metrics.timer(f"projection.query.{kind}"):
+            return to_json_types(self._query(kind, request))
+
+    def _query(self, kind, request):
+        if kind == "counts":
+            directory = request.get('directory')
+            return {
+                "scan": self.get_last_scan(directory or ""),
+                "totals": {
+                    bucket: self.count_bucket(
+                        bucket, request.get('parent'), directory)
+                    for bucket in BUCKETS
+                }
+            }
+        elif kind == "bucket":
+            users, next_start = self.get_bucket(
+                request['bucket'],
+                int(request.get('limit', 100)),
+                request.get('start'),
+                request.get('directory'))
+            return {"users": users, "next": next_start}
+        elif kind == "user":
+            return {"user": self.get_user(request['dn'])}
+        raise ValueError(f"Unknown projection query {kind}")
@@ -0,0 +1,291 @@
+"""
+Offline replay of a directory scan.
+
+Runs a recorded dump of the directory through the same decode -> filter ->
+classify -> artifact pipeline as the query action, without a domain
+controller, SSM or S3, e.g. to tune the classification rules or benchmark
+the classifier against a copy of a production directory:
+
+    export PYTHONPATH=modules/lambda_layers/common/layer/python
+    python modules/lambda_functions/ldap_query/src/replay.py \\
+        classify users.ldif --output replay/ --today 2020-06-01
+
+Dumps are either LDIF (e.g. from ldapsearch -LLL) or snapshots: one json
+object per line holding the DN and the attributes the function requests,
+binary values base64 encoded, as written from a live directory by
+
+    python modules/lambda_functions/ldap_query/src/replay.py \\
+        record users.jsonl
+
+The dump is memory-mapped and parsed a page of SEARCH_PAGE_SIZE entries
+at a time as the classification (or CLASSIFY_WORKERS workers) consumes
+it. FILTER_PREFIXES, HANDS_OFF_ACCOUNTS,
+CLASSIFY_WORKERS and SEARCH_PAGE_SIZE apply as they do in the function.
+"""
+import argparse
+import base64
+import importlib
+import json
+import mmap
+import os
+import sys
+import time
+from datetime import datetime
+
+import ldap
+from ldap_maintainer.metrics import metrics
+
+# lambda is a keyword, the handler module can't be imported by name
+maintainer = importlib.import_module("lambda")
+
+# objectCategory values of user objects, the full DN on a domain
+# controller and its first RDN value in some exports
+PERSON_CATEGORIES = (b"person", b"cn=person")
+_USER_ATTRIBUTES = {name.lower() for name in maintainer.USER_ATTRIBUTES}
+
+
+def iter_lines(buffer):
+    """Yields the lines of buffer without their line endings"""
+    start = 0
+    end = len(buffer)
+    while start < end:
+        newline = buffer.find(b"\n", start)
+        if newline < 0:
+            newline = end
+        line = buffer[start:newline]
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        yield line
+        start = newline + 1
+
+
+def unfold(buffer):
+    """
+    Yields the logical lines of an LDIF document, continuation lines are
+    joined and comments dropped. Records are separated by empty lines.
+    """
+    current = None
+    for line in iter_lines(buffer):
+        if line[:1] == b" ":
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None and not current.startswith(b"#"):
+            yield current
+        current = line
+    if current is not None and not current.startswith(b"#"):
+        yield current
+
+
+def parse_ldif_line(line):
+    """Returns the attribute name, without options, and value of a line"""
+    name, _, value = line.partition(b":")
+    if value.startswith(b":"):
+        value = base64.b64decode(value[1:].strip())
+    elif value.startswith(b"<"):
+        raise ValueError(f"URL values are not supported: {line[:80]!r}")
+    else:
+        value = value.lstrip(b" ")
+    return name.decode("ascii").split(";")[0], value
+
+
+def read_ldif(buffer):
+    """Yields the (dn, attributes) of the entries of an LDIF document"""
+    dn = None
+    attributes = {}
+    for line in unfold(buffer):
+        if not line:
+            if dn is not None:
+                yield dn, attributes
+            dn, attributes = None, {}
+            continue
+        name, value = parse_ldif_line(line)
+        if dn is None:
+            # the version line and ldapsearch's result records have no dn
+            if name.lower() == "dn":
+                dn = value.decode("utf-8")
+            continue
+        attributes.setdefault(name, []).append(value)
+    if dn is not None:
+        yield dn, attributes
+
+
+def dump_snapshot_entry(dn, attributes):
+    """Serializes an entry of the search results as a snapshot line"""
+    encoded = {}
+    for name, values in attributes.items():
+        encoded[name] = []
+        for value in values:
+            try:
+                encoded[name].append(value.decode("utf-8"))
+            except UnicodeDecodeError:
+                encoded[name].append(
+                    {"base64": base64.b64encode(value).decode("ascii")})
+    return json.dumps(
+        {"dn": dn, "attributes": encoded},
+        ensure_ascii=False, separators=(",", ":"))
+
+
+def read_snapshot(buffer):
+    """Yields the (dn, attributes) of the entries of a snapshot"""
+    for line in iter_lines(buffer):
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        yield entry['dn'], {
+            name: [
+                base64.b64decode(value['base64'])
+                if isinstance(value, dict) else value.encode("utf-8")
+                for value in values
+            ]
+            for name, values in entry['attributes'].items()
+        }
+
+
+def is_user(attributes):
+    """
+    Mirrors USER_FILTER for the entries of a dump, attributes missing
+    from it (e.g. in snapshots) are not checked.
+    """
+    classes = attributes.get('objectClass')
+    if classes is not None and b"user" not in {
+            value.lower() for value in classes}:
+        return False
+    categories = attributes.get('objectCategory')
+    if categories is not None and not any(
+            value.split(b",")[0].lower() in PERSON_CATEGORIES
+            for value in categories):
+        return False
+    return True
+
+
+def read_pages(path, page_size=0):
+    """
+    Yields the user entries of a dump in pages of page_size search
+    results (all of them in a single page when page_size is 0), with only
+    the attributes the function requests.
+    """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as dump, mmap.mmap(
+            dump.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        first = buffer[:64].lstrip()
+        read_entries = read_snapshot if first[:1] == b"{" else read_ldif
+        page = []
+        for dn, attributes in read_entries(buffer):
+            if not is_user(attributes):
+                continue
+            page.append((ldap.RES_SEARCH_ENTRY, (dn, {
+                name: values for name, values in attributes.items()
+                if name.lower() in _USER_ATTRIBUTES
+            })))
+            if page_size and len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+
+class ReplayMaintainer(maintainer.LdapMaintainer):
+    """Reads the users from a dump instead of searching the directory"""
+
+    def __init__(self, path):
+        self.key = None
+        self.directory = maintainer.get_directory()
+        self.connection = None
+        self.path = path
+
+    def search_users(self, shard=None, page_size=0):
+        return read_pages(self.path, page_size)
+
+    def classify_serially(
+        self,
+        shard,
+        stale_users,
+        today,
+        rows=None,
+        diff=None
+    ):
+        """
+        Classifies the dump one page of SEARCH_PAGE_SIZE entries at a time
+        as it is parsed, instead of decoding all of it at once.
+        """
+        with metrics.timer("classify"):
+            entries = self.merge_pages(
+                (
+                    self.classify_page(page, today, diff, rows is not None)
+                    for page in self.search_users(
+                        shard, maintainer.SEARCH_PAGE_SIZE)
+                ),
+                stale_users, rows, diff)
+        metrics.set_directory_size(entries)
+
+
+def classify(args):
+    previous = None
+    if args.previous:
+        with open(args.previous, "rb") as index:
+            previous = json.load(index)
+    diff = maintainer.ScanDiff(previous)
+    start = time.perf_counter()
+    users = ReplayMaintainer(args.dump).get_stale_users(
+        diff=diff, today=args.today)
+    elapsed = time.perf_counter() - start
+    summary = {
+        "totals": maintainer.get_user_counts(users),
+        "changes": diff.finish(),
+        "seconds": round(elapsed, 3)
+    }
+    os.makedirs(args.output, exist_ok=True)
+    artifacts = maintainer.generate_artifacts(users, diff.changes)
+    for name, content in artifacts.items():
+        with open(os.path.join(args.output, f"{name}.json"), "w") as out:
+            out.write(content)
+    with open(os.path.join(args.output, "scan_index.json"), "wb") as out:
+        out.write(maintainer.dump_index(diff.index))
+    print(json.dumps(summary, indent=2))
+
+
+def record(args):
+    entries = 0
+    with open(args.snapshot, "w", encoding="utf-8") as snapshot:
+        for page in maintainer.LdapMaintainer().search_users(
+                page_size=maintainer.SEARCH_PAGE_SIZE):
+            for _, (dn, attributes) in page:
+                if dn is None:
+                    continue
+                snapshot.write(dump_snapshot_entry(dn, attributes) + "\n")
+                entries += 1
+    print(f"Recorded {entries} entries to {args.snapshot}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    replay = commands.add_parser(
+        "classify", help="classify the users of a dump")
+    replay.add_argument("dump", help="LDIF or snapshot file")
+    replay.add_argument(
+        "--output", default="replay",
+        help="directory the artifacts are written to")
+    replay.add_argument(
+        "--previous", help="scan_index.json of a previous replay to diff")
+    replay.add_argument(
+        "--today", type=datetime.fromisoformat,
+        help="classify as of this date instead of now, e.g. 2020-06-01")
+    replay.set_defaults(run=classify)
+    snapshot = commands.add_parser(
+        "record", help="record a snapshot of the users of the directory")
+    snapshot.add_argument("snapshot", help="file to write")
+    snapshot.set_defaults(run=record)
+    args = parser.parse_args(argv)
+
+    # the filters are lists of json in the function's environment
+    os.environ.setdefault('FILTER_PREFIXES', "[]")
+    os.environ.setdefault('HANDS_OFF_ACCOUNTS', "[]")
+    args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
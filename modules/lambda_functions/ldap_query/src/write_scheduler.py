@@ -0,0 +1,214 @@
+"""
+Rate limited, throttle aware scheduling of directory writes.
+
+Writes are pipelined on a single connection: up to `limit` modify
+requests are in flight at once and their results are collected oldest
+first. Requests are paced by a token bucket (DISABLE_RATE writes per
+second, bursts of DISABLE_BURST) and the number in flight adapts to the
+domain controller: it grows by one every `limit` successful writes and is
+halved whenever the controller pushes back (BUSY, UNAVAILABLE,
+SERVER_DOWN or a timeout), after which the write is retried with a
+bounded exponential backoff. Any other error, including
+UNWILLING_TO_PERFORM (AD's refusal of a write to e.g. a protected
+account), fails the write at once.
+
+The scheduler stops taking new work once `should_stop` returns True
+(e.g. when the lambda is about to time out) and reports the operations it
+didn't get to, so they can be checkpointed and resumed by a follow-up
+invocation. A write whose result was lost is retried, so every operation
+must either be idempotent or name the errors its retry fails with once
+the lost attempt went through (e.g. NO_SUCH_ATTRIBUTE for the MOD_DELETE
+of a member that is already gone), which then count as success.
+"""
+import collections
+import logging
+import os
+import time
+
+import ldap
+
+from ldap_maintainer.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# maximum sustained writes per second
+DISABLE_RATE = float(os.environ.get('DISABLE_RATE', 25))
+DISABLE_BURST = int(os.environ.get('DISABLE_BURST', 10))
+DISABLE_MAX_CONCURRENCY = int(os.environ.get('DISABLE_MAX_CONCURRENCY', 8))
+DISABLE_MAX_RETRIES = int(os.environ.get('DISABLE_MAX_RETRIES', 5))
+# seconds to wait for the result of a single write
+DISABLE_RESULT_TIMEOUT = float(os.environ.get('DISABLE_RESULT_TIMEOUT', 30))
+
+# errors that mean the controller is overloaded or went away, the write
+# is retried and the concurrency reduced
+THROTTLE_ERRORS = (
+    ldap.BUSY,
+    ldap.UNAVAILABLE,
+    ldap.SERVER_DOWN,
+    ldap.TIMEOUT
+)
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it"""
+        while True:
+            now = self.clock()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            self.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveConcurrency:
+    """Additive increase, multiplicative decrease of the writes in flight"""
+
+    def __init__(self, maximum, initial=1):
+        self.maximum = max(maximum, 1)
+        self.limit = min(initial, self.maximum)
+        self._successes = 0
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self._successes = 0
+
+    def on_throttle(self):
+        self.limit = max(1, self.limit // 2)
+        self._successes = 0
+
+
+def unbind(connection):
+    """Closes connection, the controller may already have dropped it"""
+    try:
+        connection.unbind_s()
+    except ldap.LDAPError:
+        pass
+
+
+class WriteScheduler:
+
+    def __init__(
+        self,
+        connect,
+        rate=DISABLE_RATE,
+        burst=DISABLE_BURST,
+        max_concurrency=DISABLE_MAX_CONCURRENCY,
+        max_retries=DISABLE_MAX_RETRIES,
+        result_timeout=DISABLE_RESULT_TIMEOUT,
+        base_delay=0.5,
+        max_delay=8
+    ):
+        """
+        connect returns a bound connection, it is called again when the
+        connection to the controller is lost.
+        """
+        self.connect = connect
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_retries = max_retries
+        self.result_timeout = result_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        time.sleep(min(self.base_delay * 2 ** attempt, self.max_delay))
+
+    def run(self, operations, should_stop=lambda: False, applied=()):
+        """
+        Applies operations, a list of (dn, modlist), in order. applied is
+        a tuple of the errors that mean a retried write was already
+        applied by an attempt whose result was lost.
+
+        Returns the indexes of the operations that succeeded, the ones
+        that failed with the error they failed with and the ones that were
+        not attempted because should_stop returned True.
+        """
+        queue = collections.deque(
+            (index, 0) for index in range(len(operations)))
+        in_flight = collections.OrderedDict()
+        succeeded = []
+        failed = []
+        connection = self.connect()
+
+        def push_back(index, attempt, error):
+            """Retries a write the directory pushed back on"""
+            nonlocal connection
+            metrics.count("ldap.throttled")
+            if attempt >= self.max_retries:
+                failed.append((index, error))
+            else:
+                metrics.count("ldap.write_retries")
+                queue.appendleft((index, attempt + 1))
+            if isinstance(error, (ldap.SERVER_DOWN, ldap.TIMEOUT)):
+                # the results of the other writes are lost with the
+                # connection, send them again
+                for pending in reversed(list(in_flight.values())):
+                    queue.appendleft(pending)
+                in_flight.clear()
+            self.concurrency.on_throttle()
+            log.warning(
+                "Directory pushed back (%s), %s writes in flight",
+                type(error).__name__, self.concurrency.limit)
+            self.backoff(attempt)
+            if isinstance(error, (ldap.SERVER_DOWN, ldap.TIMEOUT)):
+                unbind(connection)
+                connection = self.connect()
+
+        try:
+            while True:
+                while (
+                    queue and
+                    len(in_flight) < self.concurrency.limit and
+                    not should_stop()
+                ):
+                    index, attempt = queue.popleft()
+                    self.bucket.acquire()
+                    dn, modlist = operations[index]
+                    try:
+                        msgid = connection.modify(dn, modlist)
+                    except THROTTLE_ERRORS as e:
+                        push_back(index, attempt, e)
+                        break
+                    except ldap.LDAPError as e:
+                        if attempt and isinstance(e, applied):
+                            succeeded.append(index)
+                        else:
+                            failed.append((index, e))
+                        continue
+                    in_flight[msgid] = (index, attempt)
+                if not in_flight:
+                    if not queue or should_stop():
+                        break
+                    continue
+                msgid, (index, attempt) = in_flight.popitem(last=False)
+                try:
+                    connection.result(
+                        msgid, all=1, timeout=self.result_timeout)
+                except THROTTLE_ERRORS as e:
+                    push_back(index, attempt, e)
+                except ldap.LDAPError as e:
+                    if attempt and isinstance(e, applied):
+                        succeeded.append(index)
+                    else:
+                        failed.append((index, e))
+                else:
+                    succeeded.append(index)
+                    self.concurrency.on_success()
+        finally:
+            unbind(connection)
+        metrics.put("ldap.write_concurrency", self.concurrency.limit)
+        return succeeded, failed, sorted(index for index, _ in queue)
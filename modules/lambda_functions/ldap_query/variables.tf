@@ -5,7 +5,7 @@ variable "project_name" {
 }
 
 variable "ldaps_url" {
-  description = "LDAPS URL for the target domain"
+  description = "LDAPS URL for the target domain, or a comma separated list of the URLs of its domain controllers"
   type        = string
 }
 
@@ -24,6 +24,12 @@ variable "svc_user_pwd_ssm_key" {
   type        = string
 }
 
+variable "directory_ssm_keys" {
+  default     = []
+  description = "SSM parameter keys of the service account passwords of the other directories the function maintains"
+  type        = list(string)
+}
+
 variable "vpc_id" {
   description = "VPC ID of the VPC hosting your Simple AD instance"
   type        = string
@@ -35,6 +41,12 @@ variable "log_level" {
   type        = string
 }
 
+variable "log_sample_rate" {
+  default     = 1000
+  description = "Only one in this many users is logged at the Debug log level"
+  type        = number
+}
+
 variable "filter_prefixes" {
   default     = []
   description = "List of three letter user name prefixes to filter out of the user search results"
@@ -61,4 +73,93 @@ variable "additional_hands_off_accounts" {
 variable "artifacts_bucket_name" {
   description = "Name of the artifacts bucket"
   type        = string
-}
\ No newline at end of file
+}
+
+variable "approver_group_dn" {
+  default     = ""
+  description = "Distinguished name of the group whose members may approve or deny disabling users, empty to allow anyone in the slack channel"
+  type        = string
+}
+
+variable "common_layer_arn" {
+  description = "ARN of the layer with the code shared by the lambda functions"
+  type        = string
+}
+
+variable "metrics_namespace" {
+  default     = "LdapMaintainer"
+  description = "CloudWatch namespace of the embedded metrics emitted by the function"
+  type        = string
+}
+
+variable "profiler" {
+  default     = ""
+  description = "Profiles every invocation and uploads the result to the artifacts bucket when set, one of: cprofile or sampling"
+  type        = string
+}
+
+variable "trace_exporter" {
+  default     = "log"
+  description = "Where the spans of every invocation are exported, one of: log (the function's log), file or none"
+  type        = string
+}
+
+variable "shard_strategy" {
+  default     = "ou"
+  description = "How the plan action splits the directory scan into shards, one of: ou, prefix or none"
+  type        = string
+}
+
+variable "shard_count" {
+  default     = 8
+  description = "Number of sAMAccountName initial ranges planned when shard_strategy is prefix"
+  type        = number
+}
+
+variable "ldap_srv_domain" {
+  default     = ""
+  description = "DNS name of the domain whose SRV records list the domain controllers to use instead of ldaps_url, requires dnspython in the python-ldap layer"
+  type        = string
+}
+
+variable "ldap_connect_timeout" {
+  default     = 5
+  description = "Seconds allowed to connect to a domain controller before failing over to the next one"
+  type        = number
+}
+
+variable "disable_rate" {
+  default     = 25
+  description = "Maximum number of accounts disabled per second"
+  type        = number
+}
+
+variable "disable_max_concurrency" {
+  default     = 8
+  description = "Maximum number of disable requests in flight at once, the actual number adapts to how busy the domain controller is"
+  type        = number
+}
+
+variable "classify_workers" {
+  default     = 0
+  description = "Worker processes that decode and classify the users while the directory is searched, 0 does it in the handler. Only useful with a memory_size that comes with several vCPUs"
+  type        = number
+}
+
+variable "memory_size" {
+  default     = 128
+  description = "Memory size of the function in MB, lambda allocates vCPUs in proportion to it (6 at 10240MB)"
+  type        = number
+}
+
+variable "search_connections" {
+  default     = 0
+  description = "Connections over which the query action searches every top level OU and container concurrently, 0 searches the whole domain in a single request"
+  type        = number
+}
+
+variable "remove_group_memberships" {
+  default     = false
+  description = "Remove the disabled users from the groups they are members of"
+  type        = bool
+}
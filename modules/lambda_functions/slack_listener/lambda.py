@@ -9,38 +9,18 @@ import os
 import hmac
 import hashlib
 import logging
-import re
-from urllib.parse import unquote
+import time
+import urllib.request
+from urllib.parse import parse_qs, quote, unquote
 from datetime import datetime
 
-DEFAULT_LOG_LEVEL = logging.DEBUG
-LOG_LEVELS = collections.defaultdict(
-    lambda: DEFAULT_LOG_LEVEL,
-    {
-        'critical': logging.CRITICAL,
-        'error': logging.ERROR,
-        'warning': logging.WARNING,
-        'info': logging.INFO,
-        'debug': logging.DEBUG
-    }
-)
-
-# Lambda initializes a root logger that needs to be removed in order to set a
-# different logging config
-root = logging.getLogger()
-if root.handlers:
-    for handler in root.handlers:
-        root.removeHandler(handler)
-
-log_file_name = ""
-if not os.environ.get("AWS_EXECUTION_ENV"):
-    log_file_name = 'ldap_maintainer_slack.log'
-
-logging.basicConfig(
-    filename=log_file_name,
-    format='%(asctime)s.%(msecs)03dZ [%(name)s][%(levelname)-5s]: %(message)s',
-    datefmt='%Y-%m-%dT%H:%M:%S',
-    level=LOG_LEVELS[os.environ.get('LOG_LEVEL', '').lower()])
+from ldap_maintainer import artifact_store
+from ldap_maintainer.logs import configure_logging, summarize
+from ldap_maintainer.metrics import instrumented, metrics
+from ldap_maintainer.profiling import profiled
+from ldap_maintainer.tracing import extract, tracer
+
+configure_logging('ldap_maintainer_slack.log')
 log = logging.getLogger(__name__)
 
 # Grab the Bot OAuth token from the environment.
@@ -48,9 +28,61 @@ BOT_TOKEN = os.environ["SLACK_API_TOKEN"]
 
 # Define the URL of the targeted Slack API resource.
 # We'll send our replies there.
-SLACK_URL = "https://slack.com/api/chat.postMessage"
+SLACK_API_URL = os.environ.get('SLACK_API_URL', "https://slack.com/api/")
+SLACK_URL = f"{SLACK_API_URL}chat.postMessage"
+SLACK_USER_INFO_URL = f"{SLACK_API_URL}users.info"
+
+# slack requests with a timestamp further than this from the time they
+# were queued are rejected to protect against replay attacks
+REPLAY_WINDOW_SECONDS = 60 * 5
+
+# how long a slack user's approver group membership is trusted before it
+# is looked up again
+AUTHZ_CACHE_TTL = int(os.environ.get('AUTHZ_CACHE_TTL', 300))
+
+# the approver lists published by the ldap query function
+APPROVERS_PREFIX = "approvers"
+
+# button presses for a task token are only acted on once within this period
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 60 * 60 * 24))
+# number of recently claimed idempotency keys remembered in memory
+IDEMPOTENCY_CACHE_SIZE = 1024
+
+sfn = boto3.client('stepfunctions')
+dynamodb = boto3.client('dynamodb')
+
+
+class UnverifiedRequest(Exception):
+    """The slack request signature of a record couldn't be verified"""
+
+
+class TTLCache:
+    """Minimal in-memory cache whose entries expire after ttl seconds."""
 
-s3 = boto3.client('s3')
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        self._entries.pop(key, None)
+        return None
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+
+# state below is kept for the life of the container so warm invocations
+# can skip the lookups
+_signing_secret = None
+# signature -> (time it was claimed, id of the sqs message that carried it)
+_seen_signatures = {}
+_approvers = TTLCache(AUTHZ_CACHE_TTL)
+_authorized_users = TTLCache(AUTHZ_CACHE_TTL)
+_claimed_keys = collections.OrderedDict()
 
 
 def get_http_response(httpStatusCode, body, headers={}):
@@ -62,66 +94,289 @@ def get_http_response(httpStatusCode, body, headers={}):
         }
 
 
-def get_slack_payload(event):
+def get_slack_payload(record):
     """
-    Extract the body data of the slack request.
+    Decode the slack interaction carried by a single SQS record.
+
+    The api gateway integration forwards slack's form encoded request body
+    untouched as the message body and the slack request headers as message
+    attributes, so the body only has to be url decoded before the
+    interaction payload is loaded.
     """
-    event_body = event['Records'][0]['body'].replace("\n", "")
-    log.debug(f'event body pre-search: {event_body}')
-    payload = re.search(r'(\"payload=)(.*)(\"\,\"params\" \:)', event_body)
-    params = re.search(r'(\"\,\"params\" \:)(.*)(\,\")', event_body)
+    body = record['body']
     try:
-        if payload and params:
-            payload = payload.group(2)
-            params = params.group(2)
-            log.debug(f"payload: {payload}")
-            log.debug(f"params: {params}")
-            response = {}
-            response['payload'] = json.loads(payload)
-            response['params'] = json.loads(params)
-            return response
-        else:
-            log.error("Invalid payload received!")
-            exit
-    except IndexError:
+        payload = json.loads(parse_qs(body)['payload'][0])
+    except (KeyError, json.decoder.JSONDecodeError):
         log.error("Invalid payload received!")
-        exit
-    except json.decoder.JSONDecodeError:
-        log.error("Invalid payload received!")
-        exit
+        return None
+    headers = {
+        name: attribute.get('stringValue')
+        for name, attribute in record.get('messageAttributes', {}).items()
+    }
+    return {
+        "payload": payload,
+        "headers": headers,
+        "body": body
+    }
 
 
 def notify_stepfunction(slack_payload):
     """Sends a task token to the step function service"""
     slack_payload['button_pressed'] = slack_payload['actions'][0]['action_id']
-    task_token = unquote(slack_payload['actions'][0]['value'])
-    sfn = boto3.client("stepfunctions")
+    task_token = get_button_value(slack_payload)[1]
     log.debug("Sending slack_payload to stepfunctions")
-    response = sfn.send_task_success(
-        taskToken=task_token,
-        output=json.dumps(slack_payload)
+    try:
+        with metrics.timer("sfn.send_task_success"):
+            response = sfn.send_task_success(
+                taskToken=task_token,
+                output=json.dumps(slack_payload)
+            )
+    except (sfn.exceptions.InvalidToken, sfn.exceptions.TaskTimedOut) as e:
+        # the other button was already pressed for this task, retrying
+        # won't change the outcome
+        log.info("Task token is no longer valid: %s", e)
+        return
+    log.debug("Received response from stepfunctions: %s", response)
+
+
+def get_button_value(slack_payload):
+    """
+    Returns the span context of the notifier invocation that posted the
+    button, if any, and the task token carried in the button's value.
+    """
+    return extract(unquote(slack_payload['actions'][0]['value']))
+
+
+def get_idempotency_key(slack_payload):
+    """Returns the key that identifies a button press on a task."""
+    action = slack_payload['actions'][0]
+    task_token = get_button_value(slack_payload)[1]
+    token_hash = hashlib.sha256(task_token.encode('utf-8')).hexdigest()
+    return f"{token_hash}:{action['action_id']}"
+
+
+def remember_idempotency_key(key):
+    _claimed_keys[key] = True
+    _claimed_keys.move_to_end(key)
+    if len(_claimed_keys) > IDEMPOTENCY_CACHE_SIZE:
+        _claimed_keys.popitem(last=False)
+
+
+def claim_idempotency_key(key):
+    """
+    Claims a button press so that it is only acted on once.
+
+    Returns False if the key has already been claimed, either by this
+    container or (when IDEMPOTENCY_TABLE is set) by any other invocation.
+    """
+    if key in _claimed_keys:
+        _claimed_keys.move_to_end(key)
+        return False
+    table_name = os.environ.get('IDEMPOTENCY_TABLE')
+    if table_name:
+        now = int(time.time())
+        try:
+            with metrics.timer("dynamodb.claim"):
+                dynamodb.put_item(
+                    TableName=table_name,
+                    Item={
+                        "idempotency_key": {"S": key},
+                        "expires_at": {"N": str(now + IDEMPOTENCY_TTL)}
+                    },
+                    # dynamodb removes expired items lazily so they are
+                    # treated as unclaimed here
+                    ConditionExpression=(
+                        "attribute_not_exists(idempotency_key)"
+                        " OR expires_at < :now"),
+                    ExpressionAttributeValues={":now": {"N": str(now)}}
+                )
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            remember_idempotency_key(key)
+            return False
+    remember_idempotency_key(key)
+    return True
+
+
+def release_idempotency_key(key):
+    """Releases a claimed key so a failed button press can be retried."""
+    _claimed_keys.pop(key, None)
+    table_name = os.environ.get('IDEMPOTENCY_TABLE')
+    if table_name:
+        dynamodb.delete_item(
+            TableName=table_name,
+            Key={"idempotency_key": {"S": key}}
+        )
+
+
+def claim_signature(signature, message_id):
+    """
+    Claims a request signature for the SQS message that carried it.
+
+    Returns False if another message already carried the signature, i.e.
+    the request is being replayed, in this container or (when
+    IDEMPOTENCY_TABLE is set) in any other invocation. Redeliveries of the
+    same message keep their claim.
+    """
+    # a request is only accepted when queued within the replay window of
+    # its timestamp, a replay is queued by the end of the signature's
+    # window and delivered soon after
+    now = int(time.time())
+    for signature_seen, seen in list(_seen_signatures.items()):
+        if now - seen[0] > 2 * REPLAY_WINDOW_SECONDS:
+            del _seen_signatures[signature_seen]
+    seen = _seen_signatures.get(signature)
+    if seen:
+        return seen[1] == message_id
+    table_name = os.environ.get('IDEMPOTENCY_TABLE')
+    if table_name and message_id:
+        try:
+            with metrics.timer("dynamodb.claim"):
+                dynamodb.put_item(
+                    TableName=table_name,
+                    Item={
+                        "idempotency_key": {"S": f"signature:{signature}"},
+                        "message_id": {"S": message_id},
+                        "expires_at": {
+                            "N": str(now + 2 * REPLAY_WINDOW_SECONDS)}
+                    },
+                    ConditionExpression=(
+                        "attribute_not_exists(idempotency_key)"
+                        " OR message_id = :message_id"
+                        " OR expires_at < :now"),
+                    ExpressionAttributeValues={
+                        ":message_id": {"S": message_id},
+                        ":now": {"N": str(now)}
+                    }
+                )
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+    _seen_signatures[signature] = (now, message_id)
+    return True
+
+
+def get_signing_secret():
+    """
+    Returns the slack signing secret, read once per container from SSM
+    when SLACK_SIGNING_SECRET_SSM_KEY is set or from the environment.
+    """
+    global _signing_secret
+    if _signing_secret is None:
+        ssm_key = os.environ.get('SLACK_SIGNING_SECRET_SSM_KEY')
+        if ssm_key:
+            _signing_secret = boto3.client('ssm').get_parameter(
+                Name=ssm_key,
+                WithDecryption=True
+            )['Parameter']['Value']
+        else:
+            _signing_secret = os.environ.get('SLACK_SIGNING_SECRET', '')
+    return _signing_secret
+
+
+def get_slack_user_email(user_id):
+    """Look up the email address of a slack user."""
+    request = urllib.request.Request(
+        f"{SLACK_USER_INFO_URL}?user={quote(user_id)}",
+        headers={"Authorization": f"Bearer {BOT_TOKEN}"}
     )
-    log.debug(f"Received response from stepfunctions: {response}")
+    with metrics.timer("slack.users_info"), \
+            urllib.request.urlopen(request, timeout=5) as response:
+        user_info = json.load(response)
+    if not user_info.get('ok'):
+        log.error("Failed to look up slack user %s: %s", user_id, user_info)
+        return None
+    return user_info['user']['profile'].get('email')
+
+
+def get_approvers():
+    """
+    Returns the email addresses of the members of the approver groups, or
+    None when no directory publishes one.
+
+    The lists are published to s3 by the ldap_query function on every scan
+    so authorizing a button press never requires an LDAP search. Each
+    directory publishes its own (approvers-... for the deployment's own
+    directory, approvers/<name>/approvers-... for the others) and the
+    members of the newest list of every directory are approvers.
+    """
+    cached = _approvers.get('approvers')
+    if cached is None:
+        latest = {}
+        with metrics.timer("s3.download"):
+            for obj in artifact_store.list_objects(APPROVERS_PREFIX):
+                directory = obj['Key'].rpartition("/")[0]
+                if (directory not in latest or obj['LastModified'] >
+                        latest[directory]['LastModified']):
+                    latest[directory] = obj
+            approvers = None
+            if latest:
+                approvers = frozenset(
+                    email
+                    for obj in latest.values()
+                    for email in artifact_store.get_json(obj['Key']))
+        cached = _approvers.set('approvers', (approvers,))
+    return cached[0]
 
 
 def validate_user(slack_payload):
-    """Confirm if the user taking the action has the right."""
-    return True
+    """
+    Confirm if the user taking the action has the right. Anyone may when
+    no approver group is configured for the deployment or any directory.
+    """
+    approvers = get_approvers()
+    if approvers is None:
+        if os.environ.get('APPROVER_GROUP_DN'):
+            log.warning("No approver list has been published yet")
+            return False
+        log.debug("No approver group configured, allowing all users")
+        return True
+    user_id = slack_payload['user']['id']
+    authorized = _authorized_users.get(user_id)
+    if authorized is None:
+        email = get_slack_user_email(user_id)
+        authorized = _authorized_users.set(
+            user_id,
+            bool(email) and email.lower() in approvers
+        )
+    return authorized
 
 
 # borrowed largely from here:
 # https://github.com/codelabsab/timereport-slack/blob/master/chalicelib/lib/slack.py
-def verify_token(headers, body, signing_secret):
+def verify_token(
+    headers,
+    body,
+    signing_secret,
+    message_id=None,
+    received_at=None
+):
     """
     https://api.slack.com/docs/verifying-requests-from-slack
     1. Grab timestamp and slack signature from headers.
-    2. Concat and create a signature with timestamp + body
-    3. Hash the signature together with
+    2. Reject timestamps outside of the replay window around received_at,
+        the time the request was queued, so that redeliveries of the SQS
+        message are verified the same way as its first delivery
+    3. Concat and create a signature with timestamp + raw body
+    4. Hash the signature together with
         your signing_secret token from slack settings
-    4. Compare digest to slack signature from header
+    5. Compare digest to slack signature from header
+    6. Reject signatures that have already been carried by another SQS
+        message, i.e. replayed requests
+
+    Returns the reason the request was rejected, None once verified.
     """
-    request_timestamp = headers['X-Slack-Request-Timestamp'][0]
-    slack_signature = headers['X-Slack-Signature'][0]
+    request_timestamp = headers.get('X-Slack-Request-Timestamp')
+    slack_signature = headers.get('X-Slack-Signature')
+    if not (signing_secret and request_timestamp and slack_signature):
+        return "missing signing secret, timestamp or signature"
+
+    if received_at is None:
+        received_at = time.time()
+    try:
+        request_timestamp = int(request_timestamp)
+    except ValueError:
+        return "invalid timestamp"
+    if abs(received_at - request_timestamp) > REPLAY_WINDOW_SECONDS:
+        return "timestamp outside of replay window"
 
     request_basestring = f'v0:{request_timestamp}:{body}'
     my_sig = hmac.new(
@@ -129,95 +384,121 @@ def verify_token(headers, body, signing_secret):
         bytes(request_basestring, "utf-8"),
         hashlib.sha256).hexdigest()
     my_sig = f'v0={my_sig}'
+    if not hmac.compare_digest(my_sig, slack_signature):
+        return "signature mismatch"
 
-    if hmac.compare_digest(my_sig, slack_signature):
-        return True
-    else:
-        return False
-
+    if not claim_signature(slack_signature, message_id):
+        return "signature has already been used"
+    return None
 
-def get_reserialized_payload(event):
-    for key in event:
-        event[key] = key.encode()
-    return event
 
-
-def put_object(dest_bucket_name, dest_object_name, src_data):
+def get_received_at(record):
     """
-    Add an object to an Amazon S3 bucket
+    Returns the time in seconds SQS received the record's message, None
+    when the record doesn't say.
     """
-
-    # Construct Body= parameter
-    if isinstance(src_data, bytes):
-        object_data = src_data
-    else:
-        log.error(f"Type of {str(type(src_data))}"
-                  f" for the argument \'src_data\' is not supported.")
-        return False
-
-    # Put the object
-    s3 = boto3.client('s3')
-    # log.debug(f"destination object name: {dest_object_name}")
-    try:
-        s3.put_object(
-            Bucket=dest_bucket_name,
-            ACL="private",
-            Key=dest_object_name,
-            Body=object_data
-            )
-    except s3.exceptions.ClientError as e:
-        # AllAccessDisabled error == bucket not found
-        # NoSuchKey or InvalidRequest
-        # error == (dest bucket/obj == src bucket/obj)
-        log.error(e)
-        return False
-    finally:
-        if isinstance(src_data, str):
-            object_data.close()
-    return True
+    sent_timestamp = record.get('attributes', {}).get('SentTimestamp')
+    return int(sent_timestamp) / 1000 if sent_timestamp else None
+
+
+def send_ephemeral_response(slack_payload, text):
+    """Reply to the user that pressed a button without updating the message"""
+    request = urllib.request.Request(
+        slack_payload['response_url'],
+        data=json.dumps({
+            "response_type": "ephemeral",
+            "replace_original": False,
+            "text": text
+        }).encode('utf-8'),
+        headers={"Content-Type": "application/json"}
+    )
+    urllib.request.urlopen(request, timeout=5).close()
 
 
-def s3upload(
-    object_content,
-    prefix="slack-response",
-    bucket=os.environ['ARTIFACTS_BUCKET']
-):
+def s3upload(object_content, prefix="slack-response"):
     timestamp = datetime.now().strftime("%Y-%m-%d-T%H%M%S.%f")
     object_name = f"{prefix}-{timestamp}.json"
-    log.debug(f'Uploading object: {object_name} to {bucket}')
-    put_object(
-            bucket,
-            object_name,
-            json.dumps(object_content).encode("utf-8"))
+    log.debug("Uploading object: %s", object_name)
+    artifact_store.put_json(object_name, object_content)
 
 
-def handler(event, context):
-    log.debug(f"received event: {event}")
-    # parse the slack payload
-    event = get_slack_payload(event)
-    log.debug(f"received slack payload: {event}")
-    # upload the payload to s3
-    s3upload(event['payload'])
-    # send button status to the stepfunction
-    notify_stepfunction(event['payload'])
-
+def process_record(record):
+    """Handle a single slack interaction delivered by SQS."""
+    event = get_slack_payload(record)
+    if not event:
+        # a malformed message will never succeed so it isn't retried
+        return
     # validate the message received from slack and that
     # the user is authorized to take the action
+    with metrics.timer("verify"):
+        rejected = verify_token(
+            event['headers'],
+            event['body'],
+            get_signing_secret(),
+            message_id=record.get('messageId'),
+            received_at=get_received_at(record)
+        )
+    if rejected:
+        metrics.count("records.unverified")
+        raise UnverifiedRequest(rejected)
+    slack_payload = event['payload']
+    log.debug("received slack payload: %s", summarize(slack_payload))
+    if not validate_user(slack_payload):
+        metrics.count("records.unauthorized")
+        log.info("Unauthorized user %s", slack_payload['user']['id'])
+        send_ephemeral_response(
+            slack_payload,
+            "Sorry, you must be a member of the approver group to do that."
+        )
+        return
+    # the button press continues the trace of the execution awaiting it
+    with tracer.span(
+            "slack.button",
+            get_button_value(slack_payload)[0],
+            action=slack_payload['actions'][0]['action_id']) as span:
+        # absorb double clicks and redelivered messages before doing any
+        # work
+        idempotency_key = get_idempotency_key(slack_payload)
+        if not claim_idempotency_key(idempotency_key):
+            span.set_attribute("duplicate", True)
+            metrics.count("records.duplicate")
+            log.info("Ignoring duplicate button press")
+            return
+        try:
+            # upload the payload to s3
+            with metrics.timer("s3.upload"):
+                s3upload(slack_payload)
+            # send button status to the stepfunction
+            notify_stepfunction(slack_payload)
+        except Exception:
+            release_idempotency_key(idempotency_key)
+            raise
+
+
+@instrumented
+@profiled
+def handler(event, context):
+    """
+    Process every slack interaction in the SQS batch.
 
-    # SLACK_SIGNING_SECRET = os.environ['SLACK_SIGNING_SECRET']
-    # user_id = event['payload']['user']['id']
-    # headers = event['params']['header']
-
-    # serialized_payload = get_reserialized_payload(event['payload'])
-    # log.debug(f"serialized_payload: {serialized_payload}")
-    # log.debug(f"{verify_token(
-    #   headers,
-    #   serialized_payload,
-    #   SLACK_SIGNING_SECRET)}")
-
-    # if verify_token(slack_headers, event['body'], SLACK_SIGNING_SECRET):
-    #     slack_payload = get_slack_payload(event)
-    #     if verify_user(slack_payload):
-    #         notify_stepfunction(slack_payload)
-    #     else:
-    #         message = "Sorry, you must be a member of X group to do that."
+    Records that fail, including those whose slack request can't be
+    verified, are reported back to the event source mapping so only those
+    messages are made visible again and retried, until the queue moves
+    them to its dead letter queue.
+    """
+    log.debug("received event: %s", summarize(event))
+    failures = []
+    for record in event['Records']:
+        try:
+            process_record(record)
+        except UnverifiedRequest as e:
+            log.warning(
+                "Failed to verify the slack request of message %s: %s",
+                record['messageId'], e)
+            failures.append({"itemIdentifier": record['messageId']})
+        except Exception:
+            log.exception("Failed to process message %s", record['messageId'])
+            failures.append({"itemIdentifier": record['messageId']})
+    metrics.count("records", len(event['Records']))
+    metrics.count("records.failed", len(failures))
+    return {"batchItemFailures": failures}
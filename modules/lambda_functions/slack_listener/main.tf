@@ -1,3 +1,5 @@
+data "aws_caller_identity" "current" {}
+
 resource "random_string" "this" {
   length  = 8
   special = false
@@ -6,6 +8,36 @@ resource "random_string" "this" {
 
 resource "aws_sqs_queue" "slack_listener" {
   name = "${var.project_name}-async-queue-${random_string.this.result}"
+  # interactions that keep failing, e.g. unverified requests, are moved
+  # to the dead letter queue instead of being retried until they expire
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.slack_listener_dead_letter.arn
+    maxReceiveCount     = var.sqs_max_receive_count
+  })
+  tags = var.tags
+}
+
+resource "aws_sqs_queue" "slack_listener_dead_letter" {
+  name = "${var.project_name}-async-queue-dead-letter-${random_string.this.result}"
+  tags = var.tags
+}
+
+# records the button presses that have already been acted on
+resource "aws_dynamodb_table" "idempotency" {
+  name         = "${var.project_name}-slack-listener-idempotency-${random_string.this.result}"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "idempotency_key"
+
+  attribute {
+    name = "idempotency_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
   tags = var.tags
 }
 
@@ -33,6 +65,26 @@ data "aws_iam_policy_document" "lambda" {
     ]
   }
 
+  dynamic "statement" {
+    for_each = var.slack_signing_secret_ssm_key == "" ? [] : [var.slack_signing_secret_ssm_key]
+    content {
+      sid     = "ReadSigningSecret"
+      actions = ["ssm:GetParameter"]
+      resources = [
+        "arn:aws:ssm:*:${data.aws_caller_identity.current.account_id}:parameter${statement.value}"
+      ]
+    }
+  }
+
+  statement {
+    sid = "TrackButtonPresses"
+    actions = [
+      "dynamodb:PutItem",
+      "dynamodb:DeleteItem"
+    ]
+    resources = [aws_dynamodb_table.idempotency.arn]
+  }
+
   statement {
     sid = "ListenToSQS"
     actions = [
@@ -52,7 +104,10 @@ resource "aws_lambda_event_source_mapping" "sqs" {
   ]
   event_source_arn = aws_sqs_queue.slack_listener.arn
   function_name    = module.lambda.function_name
-  batch_size       = 1
+  batch_size       = var.sqs_batch_size
+
+  maximum_batching_window_in_seconds = var.sqs_batching_window
+  function_response_types            = ["ReportBatchItemFailures"]
 }
 
 module "lambda" {
@@ -72,9 +127,21 @@ module "lambda" {
       LOG_LEVEL            = var.log_level
       SLACK_API_TOKEN      = var.slack_api_token
       SLACK_SIGNING_SECRET = var.slack_signing_secret
+
+      SLACK_SIGNING_SECRET_SSM_KEY = var.slack_signing_secret_ssm_key
+      APPROVER_GROUP_DN            = var.approver_group_dn
+      AUTHZ_CACHE_TTL              = var.authz_cache_ttl
+      IDEMPOTENCY_TABLE            = aws_dynamodb_table.idempotency.name
+      IDEMPOTENCY_TTL              = var.idempotency_ttl
+
+      METRICS_NAMESPACE = var.metrics_namespace
+      PROFILER          = var.profiler
+      TRACE_EXPORTER    = var.trace_exporter
     }
   }
 
+  layers = [var.common_layer_arn]
+
   policy = {
     json = data.aws_iam_policy_document.lambda.json
   }
@@ -34,4 +34,7 @@ output "sqs_queue_arn" {
 
 output "sqs_queue_name" {
   value = aws_sqs_queue.slack_listener.name
-}
\ No newline at end of file
+}
+output "sqs_dead_letter_queue_arn" {
+  value = aws_sqs_queue.slack_listener_dead_letter.arn
+}
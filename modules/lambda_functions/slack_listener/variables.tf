@@ -46,4 +46,69 @@ variable "api_gw_role_arn" {
 variable "artifacts_bucket_name" {
   description = "Name of the artifacts bucket"
   type        = string
-}
\ No newline at end of file
+}
+
+variable "sqs_batch_size" {
+  default     = 10
+  description = "Maximum number of slack interactions processed by a single invocation of the listener"
+  type        = number
+}
+
+variable "sqs_max_receive_count" {
+  default     = 5
+  description = "Times a slack interaction is delivered to the listener before it is moved to the dead letter queue"
+  type        = number
+}
+
+variable "sqs_batching_window" {
+  default     = 0
+  description = "Seconds the event source mapping may wait to fill a batch, keep low so button presses are acknowledged quickly"
+  type        = number
+}
+
+variable "slack_signing_secret_ssm_key" {
+  default     = ""
+  description = "SSM parameter key that contains the slack signing secret, takes precedence over slack_signing_secret"
+  type        = string
+}
+
+variable "approver_group_dn" {
+  default     = ""
+  description = "Distinguished name of the group whose members may approve or deny disabling users, empty to allow anyone in the slack channel"
+  type        = string
+}
+
+variable "authz_cache_ttl" {
+  default     = 300
+  description = "Seconds that a slack user's approver group membership is cached by the listener"
+  type        = number
+}
+
+variable "idempotency_ttl" {
+  default     = 86400
+  description = "Seconds that a button press is remembered so duplicate clicks and redelivered messages are ignored"
+  type        = number
+}
+
+variable "common_layer_arn" {
+  description = "ARN of the layer with the code shared by the lambda functions"
+  type        = string
+}
+
+variable "metrics_namespace" {
+  default     = "LdapMaintainer"
+  description = "CloudWatch namespace of the embedded metrics emitted by the function"
+  type        = string
+}
+
+variable "profiler" {
+  default     = ""
+  description = "Profiles every invocation and uploads the result to the artifacts bucket when set, one of: cprofile or sampling"
+  type        = string
+}
+
+variable "trace_exporter" {
+  default     = "log"
+  description = "Where the spans of every invocation are exported, one of: log (the function's log), file or none"
+  type        = string
+}
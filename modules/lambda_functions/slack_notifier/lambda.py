@@ -1,52 +1,111 @@
-import boto3
 import collections
-import dateutil.tz
+import functools
 import json
 import logging
 import os
+import re
 from datetime import datetime
 
-import slack
+import botocore.exceptions
 
+from ldap_maintainer import artifact_store
+from ldap_maintainer.logs import configure_logging, summarize
+from ldap_maintainer.metrics import instrumented, metrics
+from ldap_maintainer.profiling import profiled
+from ldap_maintainer.tracing import inject
 
-DEFAULT_LOG_LEVEL = logging.DEBUG
-LOG_LEVELS = collections.defaultdict(
-    lambda: DEFAULT_LOG_LEVEL,
-    {
-        'critical': logging.CRITICAL,
-        'error': logging.ERROR,
-        'warning': logging.WARNING,
-        'info': logging.INFO,
-        'debug': logging.DEBUG
-    }
-)
-
-# Lambda initializes a root logger that needs to be removed in order to set a
-# different logging config
-root = logging.getLogger()
-if root.handlers:
-    for handler in root.handlers:
-        root.removeHandler(handler)
-
-log_file_name = ""
-if not os.environ.get("AWS_EXECUTION_ENV"):
-    log_file_name = 'ldap_maintainer_slack.log'
-
-logging.basicConfig(
-    filename=log_file_name,
-    format='%(asctime)s.%(msecs)03dZ [%(name)s][%(levelname)-5s]: %(message)s',
-    datefmt='%Y-%m-%dT%H:%M:%S',
-    level=LOG_LEVELS[os.environ.get('LOG_LEVEL', '').lower()])
+configure_logging('ldap_maintainer_slack.log')
 log = logging.getLogger(__name__)
 
 
 SLACK_API_TOKEN = os.environ['SLACK_API_TOKEN']
-s3 = boto3.client('s3')
+SLACK_API_URL = os.environ.get('SLACK_API_URL', "https://www.slack.com/api/")
+
+# slack rejects messages with more than 50 blocks and section blocks
+# with more than 3000 characters of text
+MAX_BLOCKS_PER_MESSAGE = 50
+MAX_SECTION_TEXT_LENGTH = 3000
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name):
+    """Returns the tzinfo of name, read from the tz database only once"""
+    import dateutil.tz
+    return dateutil.tz.gettz(name)
 
 
 def get_time():
-    eastern = dateutil.tz.gettz(os.environ['TIMEZONE'])
-    return datetime.now(tz=eastern).strftime("%m/%d/%Y, %H:%M:%S")
+    timezone = get_timezone(os.environ['TIMEZONE'])
+    return datetime.now(tz=timezone).strftime("%m/%d/%Y, %H:%M:%S")
+
+
+class BlockTemplate:
+    """
+    A block kit block that is serialized once and rendered by patching
+    only its dynamic fields.
+
+    Dynamic fields are marked with "{{field_name}}" placeholders, each
+    placeholder must make up an entire string value in the block.
+    """
+
+    PLACEHOLDER = re.compile(r'"\{\{(\w+)\}\}"')
+
+    def __init__(self, block_id, block):
+        self.block_id = block_id
+        serialized = json.dumps(
+            dict(block, block_id=block_id), separators=(",", ":"))
+        # literal json fragments alternate with placeholder field names
+        self._parts = self.PLACEHOLDER.split(serialized)
+
+    def render(self, **fields):
+        """Returns the serialized block with its fields filled in."""
+        if len(self._parts) == 1:
+            return self._parts[0]
+        parts = self._parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = json.dumps(fields[parts[i]])
+        return "".join(parts)
+
+
+def render_blocks(templates, **fields):
+    """Merges rendered block templates into a serialized block list."""
+    return "[" + ",".join(
+        template.render(**fields) for template in templates) + "]"
+
+
+def get_text_template(block_id):
+    return BlockTemplate(
+        block_id,
+        {"type": "section", "text": {"type": "mrkdwn", "text": "{{text}}"}}
+    )
+
+
+def get_button(text, style):
+    return {
+        "type": "button",
+        "text": {"type": "plain_text", "text": text},
+        "value": "{{task_token}}",
+        "action_id": text,
+        "confirm": {
+            "title": {
+                "type": "plain_text",
+                "text": "Are you sure?"
+            },
+            "text": {
+                "type": "mrkdwn",
+                "text": "Are you sure you want to take this action?"
+            },
+            "confirm": {
+                "type": "plain_text",
+                "text": "Yes"
+            },
+            "deny": {
+                "type": "plain_text",
+                "text": "No"
+            }
+        },
+        "style": style
+    }
 
 
 class SlackMessageBuilder:
@@ -54,34 +113,48 @@ class SlackMessageBuilder:
 
     INVOKE_BASE_URL = os.environ['INVOKE_BASE_URL']
 
-    HEADER_BLOCK = {
+    HEADER_TEMPLATE = BlockTemplate(
+        "header",
+        {
             "type": "section",
             "text": {
                 "type": "mrkdwn",
                 "text": "A scan of our LDAP directory has been completed."
             }
         }
-
-    DIVIDER_BLOCK = {"type": "divider"}
-
-    CONFIRMATION_BLOCK = {
-        "title": {
-            "type": "plain_text",
-            "text": "Are you sure?"
-        },
-        "text": {
-            "type": "mrkdwn",
-            "text": "Are you sure you want to take this action?"
-        },
-        "confirm": {
-            "type": "plain_text",
-            "text": "Yes"
-        },
-        "deny": {
-            "type": "plain_text",
-            "text": "No"
+    )
+    HEADER_DIVIDER_TEMPLATE = BlockTemplate(
+        "header_divider", {"type": "divider"})
+    SUMMARY_TEMPLATE = get_text_template("summary")
+    SUMMARY_DIVIDER_TEMPLATE = BlockTemplate(
+        "summary_divider", {"type": "divider"})
+    BUTTONS_TEMPLATE = BlockTemplate(
+        "buttons",
+        {
+            "type": "actions",
+            "elements": [
+                get_button("Deny", "danger"),
+                get_button("Approve", "primary")
+            ]
         }
+    )
+    STATUS_TEMPLATE = get_text_template("status")
+    CONTEXT_TEMPLATE = BlockTemplate(
+        "context",
+        {
+            "type": "context",
+            "elements": [{"type": "mrkdwn", "text": "{{report_time}}"}]
         }
+    )
+
+    MESSAGE_LAYOUT = (
+        HEADER_TEMPLATE,
+        HEADER_DIVIDER_TEMPLATE,
+        SUMMARY_TEMPLATE,
+        SUMMARY_DIVIDER_TEMPLATE,
+        BUTTONS_TEMPLATE,
+        CONTEXT_TEMPLATE
+    )
 
     def __init__(
             self,
@@ -89,7 +162,9 @@ class SlackMessageBuilder:
             artifact_urls,
             user_counts,
             report_time,
-            task_token):
+            task_token,
+            changes=None,
+            directory_totals=None):
         self.channel = channel
         self.username = "ldapmaintainerbot"
         self.icon_emoji = ":robot_face:"
@@ -98,189 +173,360 @@ class SlackMessageBuilder:
         self.user_counts = user_counts
         self.report_time = report_time
         self.task_token = task_token
+        self.changes = changes
+        self.directory_totals = directory_totals
 
     def get_message_payload(self):
+        """
+        Returns the report message, blocks are passed to slack as the
+        serialized json string produced by the block templates.
+        """
         return {
             "ts": self.timestamp,
             "channel": self.channel,
             "username": self.username,
             "icon_emoji": self.icon_emoji,
-            "blocks": [
-                self.HEADER_BLOCK,
-                self.DIVIDER_BLOCK,
-                self._get_artifact_urls_block(),
-                self.DIVIDER_BLOCK,
-                # self._get_button_header_block(),
-                self._get_buttons_block(),
-                self._get_context_block()
-            ]
+            "blocks": render_blocks(
+                self.MESSAGE_LAYOUT,
+                text=self._get_summary_text(),
+                task_token=self.task_token,
+                report_time=f"Report Generated: {self.report_time}"
+            )
         }
 
-    def _get_artifact_urls_block(self):
+    def _get_summary_text(self):
         text = (
             f"Total counts of users with passwords"
             f" that have not been changed in.."
             f"\n\t greater than 120 days: {self.user_counts['120']}"
             f"\n\t gerater than 90 days: {self.user_counts['90']}"
-            f"\n\t greater than 60 days: {self.user_counts['60']}"
-            f"\n\n full details available here: ")
+            f"\n\t greater than 60 days: {self.user_counts['60']}")
+        if self.directory_totals:
+            text += self._get_directories_text()
+        if self.changes:
+            text += self._get_changes_text()
+        text += "\n\n full details available here: "
         for url in self.artifact_urls:
             text += f"<{self.artifact_urls[url]}|{url}>\n"
         text += (
             f"\n *Note*: When this message is 1 hour old these"
             f" urls will no longer be functional\n\n")
-        return self._get_text_block(text)
+        return text
+
+    def _get_directories_text(self):
+        text = "\n\n By directory (120 / 90 / 60 days).."
+        for name, totals in self.directory_totals.items():
+            text += (
+                f"\n\t {escape_mrkdwn(name)}: {totals['120']}"
+                f" / {totals['90']} / {totals['60']}")
+        return text
+
+    def _get_changes_text(self):
+        changes = self.changes
+        if changes.get('baseline'):
+            return "\n\n This is the first scan, there are no changes to show."
+        return (
+            f"\n\n Changes since the last scan.."
+            f"\n\t new over 120 days: {changes['120']}"
+            f"\n\t new over 90 days: {changes['90']}"
+            f"\n\t new over 60 days: {changes['60']}"
+            f"\n\t changed their password: {changes['recovered']}"
+            f"\n\t disabled: {changes['disabled']}"
+            f"\n\t removed from the directory: {changes['removed']}")
+
+    @classmethod
+    def get_response_blocks(cls, original_blocks, msg):
+        """
+        Replaces the buttons of a previously sent report with msg.
+
+        Blocks are matched by block_id so updates don't depend on where a
+        block sits in the layout. Repeated updates replace the status
+        block that was added by the previous update and reports sent
+        before block ids were assigned fall back to the actions block.
+        """
+        replaced_ids = (cls.BUTTONS_TEMPLATE.block_id,
+                        cls.STATUS_TEMPLATE.block_id)
+        status = None
+        updated_blocks = []
+        for block in original_blocks:
+            if (
+                block.get('block_id') in replaced_ids or
+                block.get('type') == "actions"
+            ):
+                if status is None:
+                    status = json.loads(cls.STATUS_TEMPLATE.render(text=msg))
+                    updated_blocks.append(status)
+            else:
+                updated_blocks.append(block)
+        if status is None:
+            updated_blocks.append(
+                json.loads(cls.STATUS_TEMPLATE.render(text=msg)))
+        return updated_blocks
+
+
+class UserDetailThreadBuilder:
+    """
+    Constructs the threaded follow up messages that list individual users
+
+    Users are packed into as few messages as slack allows and each page
+    is only built when it is requested so large user lists never have to
+    be held in memory.
+    """
 
-    def _get_context_block(self):
+    def __init__(self, channel, thread_ts, title, max_pages=None):
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.title = title
+        self.max_pages = max_pages
+        self.username = "ldapmaintainerbot"
+        self.icon_emoji = ":robot_face:"
+        self.users_shown = 0
+
+    def get_message_payloads(self, users):
+        """Lazily yields one message payload per page of users."""
+        page = 1
+        blocks = [self._get_page_header_block(page)]
+        lines = []
+        length = 0
+        for user in users:
+            line = self._format_user(user)[:MAX_SECTION_TEXT_LENGTH]
+            if lines and length + len(line) > MAX_SECTION_TEXT_LENGTH:
+                blocks.append(self._get_text_block("\n".join(lines)))
+                lines = []
+                length = 0
+                if len(blocks) == MAX_BLOCKS_PER_MESSAGE:
+                    yield self._get_payload(page, blocks)
+                    if page == self.max_pages:
+                        return
+                    page += 1
+                    blocks = [self._get_page_header_block(page)]
+            lines.append(line)
+            length += len(line) + 1
+            self.users_shown += 1
+        if lines:
+            blocks.append(self._get_text_block("\n".join(lines)))
+        if len(blocks) > 1:
+            yield self._get_payload(page, blocks)
+
+    def _get_payload(self, page, blocks):
         return {
-            "type": "context",
-            "elements": [
-                {
-                    "type": "mrkdwn",
-                    "text": f"Report Generated: {self.report_time}"
-                }
-            ]
+            "channel": self.channel,
+            "thread_ts": self.thread_ts,
+            "username": self.username,
+            "icon_emoji": self.icon_emoji,
+            "text": f"{self.title} (page {page})",
+            "blocks": blocks
         }
 
-    @staticmethod
-    def _get_button_header_block():
+    def _get_page_header_block(self, page):
         return {
             "type": "context",
             "elements": [
                 {
                     "type": "mrkdwn",
-                    "text": (
-                        f"\n Select Approve or Deny to"
-                        f" disable the accounts that"
-                        f" have not updated their passwords"
-                        f" in greater than 120 days"
-                        )
+                    "text": f"*{self.title}* (page {page})"
                 }
             ]
         }
 
-    def _get_buttons_block(self):
-        return {
-            "type": "actions",
-            "elements": self._get_buttons()
-        }
-
-    def _get_buttons(self):
-        actions = ["deny", "approve"]
-        buttons = []
-        for action in actions:
-            if action == "approve":
-                style = "primary"
-            else:
-                style = "danger"
-            buttons.append(
-                self._get_button(
-                    action.capitalize(),
-                    self.task_token,
-                    style
-                )
-            )
-        return buttons
-
-    def _get_button(self, text, value, style):
-        return {
-            "type": "button",
-            "text": {"type": "plain_text", "text": text},
-            "value": value,
-            "action_id": text,
-            "confirm": self.CONFIRMATION_BLOCK,
-            "style": style
-            }
+    @staticmethod
+    def _format_user(user):
+        name = escape_mrkdwn(str(user.get('name', '')))
+        email = escape_mrkdwn(str(user.get('email', '')))
+        days = user.get('days_since_last_pwd_change', '?')
+        return f"\u2022 {name} ({email}) - {days} days"
 
     @staticmethod
     def _get_text_block(text):
         return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
 
 
+def escape_mrkdwn(text):
+    """Escapes the control characters slack expects in mrkdwn text."""
+    return (
+        text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;"))
+
+
+def get_scan_reports(event):
+    """
+    Returns the scan summaries of the ldap query function a report is
+    made of: one per directory when the state machine scanned several
+    (scans), otherwise the single one it invoked the notifier with.
+    """
+    if 'scans' in event:
+        return event['scans']
+    return [event['Payload']]
+
+
+def merge_scan_reports(reports):
+    """
+    Combines the scan summaries of several directories into the summary
+    of a single report: totals and changes are added up and the links to
+    the artifacts are named after their directory.
+    """
+    if len(reports) == 1:
+        return reports[0]
+    totals = collections.Counter()
+    changes = collections.Counter()
+    baseline = True
+    directory_totals = {}
+    artifact_urls = {}
+    for report in reports:
+        name = report.get('directory') or "default"
+        totals.update(report['query_results']['totals'])
+        directory_totals[name] = report['query_results']['totals']
+        report_changes = report['query_results'].get('changes') or {}
+        # a directory's first scan has nothing to compare to
+        if report_changes and not report_changes.get('baseline'):
+            baseline = False
+            changes.update({
+                key: count for key, count in report_changes.items()
+                if key != 'baseline'})
+        for key, url in report.get('artifact_urls', {}).items():
+            artifact_urls[f"{name} {key}"] = url
+    return {
+        "query_results": {
+            "totals": dict(totals),
+            "changes": dict(changes, baseline=baseline)
+        },
+        "artifact_urls": artifact_urls,
+        "directory_totals": directory_totals
+    }
+
+
 def build_slack_user_message(event):
     TARGET_CHANNEL = os.environ['SLACK_CHANNEL_ID']
-    task_token = event['token']
-    payload = event['event']['Payload']
+    # the listener continues the trace from the button value, the
+    # traceparent fits in slack's 2000 character limit next to the token
+    task_token = inject(event['token'])
+    payload = merge_scan_reports(get_scan_reports(event['event']))
     message_body = SlackMessageBuilder(
         channel=TARGET_CHANNEL,
         artifact_urls=payload['artifact_urls'],
         user_counts=payload['query_results']['totals'],
         report_time=datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
-        task_token=task_token
+        task_token=task_token,
+        changes=payload['query_results'].get('changes'),
+        directory_totals=payload.get('directory_totals')
     )
     return message_body.get_message_payload()
 
 
 def build_slack_response_message(original_blocks, msg):
     """Sends a response message to slack."""
-    updated_blocks = original_blocks[0:4]
-    del updated_blocks[3]
-    updated_blocks.append(
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": msg
-            }
-        }
-    )
-    updated_blocks.append(original_blocks[5])
-    return updated_blocks
+    return SlackMessageBuilder.get_response_blocks(original_blocks, msg)
+
+
+@functools.lru_cache(maxsize=None)
+def get_slack_client():
+    """
+    Returns the slack client shared by the whole process. The slack SDK
+    (with aiohttp and its RTM client) is only imported once a message is
+    sent, it is the largest part of the function's cold start.
+    """
+    import slack
+    return slack.WebClient(token=SLACK_API_TOKEN, base_url=SLACK_API_URL)
 
 
 def send_updated_message_to_slack(channel_id, timestamp, message_blocks):
-    client = slack.WebClient(token=SLACK_API_TOKEN)
-    response = client.chat_update(
-        channel=channel_id,
-        ts=timestamp,
-        blocks=message_blocks
-    )
-    log.debug(f"Received response from slack: {response}")
+    client = get_slack_client()
+    with metrics.timer("slack.update"):
+        response = client.chat_update(
+            channel=channel_id,
+            ts=timestamp,
+            blocks=message_blocks
+        )
+    log.debug("Received response from slack: %s", summarize(response.data))
     assert response["ok"]
 
 
 def send_message_to_slack(message):
     """Sends the user status report to slack."""
-    client = slack.WebClient(token=SLACK_API_TOKEN)
-    response = client.chat_postMessage(**message)
+    client = get_slack_client()
+    with metrics.timer("slack.post"):
+        response = client.chat_postMessage(**message)
     assert response["ok"]
+    return response
 
 
-def get_last_modified():
-    return lambda obj: int(obj['LastModified'].strftime('%s'))
-
-
-def get_latest_s3_object(
-    bucket=os.environ['ARTIFACTS_BUCKET'],
-    prefix='slack-response'
+def send_user_details_to_slack(
+    channel_id,
+    thread_ts,
+    object_name,
+    total,
+    title="Users that have not changed their password in 120 days"
 ):
     """
-    Retrieve the newest object in the target s3 bucket
+    Posts the users that will be disabled as replies to the report thread.
+
+    Failures are logged rather than raised so that a problem listing
+    users never blocks the approve/deny buttons in the parent message.
     """
-    response = s3.list_objects_v2(
-        Bucket=bucket,
-        Prefix=prefix)
-    all = response['Contents']
-    return max(all, key=lambda x: x['LastModified'])
+    max_pages = int(os.environ.get('USER_DETAILS_MAX_PAGES', 0)) or None
+    builder = UserDetailThreadBuilder(
+        channel=channel_id,
+        thread_ts=thread_ts,
+        title=title,
+        max_pages=max_pages
+    )
+    client = get_slack_client()
+    from slack.errors import SlackApiError
+    try:
+        users = stream_artifact_bucket(object_name, "120")
+        for message in builder.get_message_payloads(users):
+            with metrics.timer("slack.post"):
+                response = client.chat_postMessage(**message)
+            if not response["ok"]:
+                raise SlackApiError("Failed to post user details", response)
+            metrics.count("slack.thread_messages")
+        if builder.users_shown < total:
+            with metrics.timer("slack.post"):
+                response = client.chat_postMessage(
+                    channel=channel_id,
+                    thread_ts=thread_ts,
+                    text=(
+                        f"{total - builder.users_shown} additional users"
+                        f" were not listed, see the full report for details."
+                    )
+                )
+            if not response["ok"]:
+                raise SlackApiError("Failed to post user count", response)
+            metrics.count("slack.thread_messages")
+    except (SlackApiError, botocore.exceptions.ClientError) as e:
+        metrics.count("slack.thread_errors")
+        log.error("Failed to post user details to slack: %s", e)
 
 
-def retrieve_s3_object_contents(
-    s3_obj,
-    bucket=os.environ['ARTIFACTS_BUCKET']
-):
-    return json.loads(s3.get_object(
-        Bucket=bucket,
-        Key=s3_obj['Key']
-        )['Body'].read().decode('utf-8'))
+def stream_artifact_bucket(object_name, bucket_key):
+    """
+    Lazily yields the users in one bucket of a user_expiration_table
+
+    Relies on the one user per line layout written by the ldap_query
+    function so only a single line of the artifact is decoded at a time.
+    """
+    body = artifact_store.get_client().get_object(
+        Bucket=os.environ['ARTIFACTS_BUCKET'], Key=object_name)['Body']
+    header = f"{json.dumps(bucket_key)}: [".encode('utf-8')
+    in_bucket = False
+    for line in body.iter_lines():
+        line = line.strip()
+        if not in_bucket:
+            in_bucket = line == header
+        elif line.startswith(b"]"):
+            return
+        elif line:
+            yield json.loads(line.rstrip(b","))
 
 
 def get_slack_response():
-    obj = get_latest_s3_object()
-    return retrieve_s3_object_contents(obj)
+    with metrics.timer("s3.download"):
+        return artifact_store.get_latest_json('slack-response')
 
 
+@instrumented
+@profiled
 def handler(event, context):
-    log.debug(f"Received event: {json.dumps(event)}")
+    log.debug("Received event: %s", summarize(event))
     if event.get('message_to_slack'):
         message = event['message_to_slack']
         response = get_slack_response()
@@ -299,6 +545,38 @@ def handler(event, context):
             message_blocks=slack_message
         )
     else:
-        slack_message = build_slack_user_message(event)
-        send_message_to_slack(slack_message)
+        with metrics.timer("slack.build"):
+            slack_message = build_slack_user_message(event)
+        response = send_message_to_slack(slack_message)
+        if os.environ.get('POST_USER_DETAILS') == "true":
+            reports = get_scan_reports(event['event'])
+            for payload in reports:
+                details = get_user_details(payload)
+                if len(reports) > 1:
+                    name = payload.get('directory') or "default"
+                    details['title'] = f"{name}: {details['title']}"
+                if details['object_name']:
+                    send_user_details_to_slack(
+                        channel_id=response['channel'],
+                        thread_ts=response['ts'],
+                        **details
+                    )
     return event
+
+
+def get_user_details(payload):
+    """Returns the artifact listing the users of a scan to post"""
+    artifact_keys = payload.get('artifact_keys', {})
+    changes = payload['query_results'].get('changes')
+    if changes and not changes.get('baseline'):
+        # only list the users that are new to the bucket
+        return {
+            "object_name": artifact_keys.get('user_expiration_diff'),
+            "total": changes['120'],
+            "title": "Users that reached 120 days since the last scan"
+        }
+    return {
+        "object_name": artifact_keys.get('user_expiration_table'),
+        "total": payload['query_results']['totals']['120'],
+        "title": "Users that have not changed their password in 120 days"
+    }
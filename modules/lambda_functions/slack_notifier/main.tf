@@ -48,10 +48,20 @@ module "lambda" {
       SLACK_CHANNEL_ID = var.slack_channel_id
       SFN_ACTIVITY_ARN = var.sfn_activity_arn
       TIMEZONE         = var.timezone
+
+      POST_USER_DETAILS      = var.post_user_details
+      USER_DETAILS_MAX_PAGES = var.user_details_max_pages
+
+      METRICS_NAMESPACE = var.metrics_namespace
+      PROFILER          = var.profiler
+      TRACE_EXPORTER    = var.trace_exporter
     }
   }
 
-  layers = [aws_lambda_layer_version.lambda_layer.arn]
+  layers = [
+    aws_lambda_layer_version.lambda_layer.arn,
+    var.common_layer_arn
+  ]
 
   policy = {
     json = data.aws_iam_policy_document.lambda.json
@@ -42,6 +42,18 @@ variable "timezone" {
   type        = string
 }
 
+variable "post_user_details" {
+  default     = true
+  description = "Post the users that will be disabled as threaded replies to the slack report"
+  type        = bool
+}
+
+variable "user_details_max_pages" {
+  default     = 10
+  description = "Maximum number of threaded messages used to list users, 0 for no limit"
+  type        = number
+}
+
 variable "artifacts_bucket_name" {
   description = "Name of the artifacts bucket"
   type        = string
@@ -50,4 +62,27 @@ variable "artifacts_bucket_name" {
 variable "tags" {
   type    = map(string)
   default = {}
-}
\ No newline at end of file
+}
+
+variable "common_layer_arn" {
+  description = "ARN of the layer with the code shared by the lambda functions"
+  type        = string
+}
+
+variable "metrics_namespace" {
+  default     = "LdapMaintainer"
+  description = "CloudWatch namespace of the embedded metrics emitted by the function"
+  type        = string
+}
+
+variable "profiler" {
+  default     = ""
+  description = "Profiles every invocation and uploads the result to the artifacts bucket when set, one of: cprofile or sampling"
+  type        = string
+}
+
+variable "trace_exporter" {
+  default     = "log"
+  description = "Where the spans of every invocation are exported, one of: log (the function's log), file or none"
+  type        = string
+}
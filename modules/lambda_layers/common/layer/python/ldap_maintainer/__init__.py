@@ -0,0 +1,3 @@
+"""
+Code shared by the ldap maintainer lambda functions, deployed as a layer.
+"""
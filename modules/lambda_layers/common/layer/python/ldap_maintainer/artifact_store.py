@@ -0,0 +1,249 @@
+"""
+Reads and writes the objects in the artifacts bucket.
+
+Every function shares one S3 client per process, created on first use
+with keep-alive connections, a connection pool sized for parallel
+transfers and adaptive retries.
+
+Downloaded objects are cached by ETag, as raw bytes under
+ARTIFACT_CACHE_DIR (in /tmp, which survives between warm invocations)
+and, for json documents, parsed in memory. A cached object is revalidated
+with a conditional GET so a warm invocation that reads the same scan
+again skips both the download and the json parsing. Parsed documents are
+shared between callers and must not be modified.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import botocore.exceptions
+
+from ldap_maintainer.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+ARTIFACT_CACHE_DIR = os.environ.get('ARTIFACT_CACHE_DIR', '/tmp/artifacts')
+# bytes of downloaded objects kept in ARTIFACT_CACHE_DIR
+ARTIFACT_CACHE_SIZE = int(
+    os.environ.get('ARTIFACT_CACHE_SIZE', 256 * 1024 * 1024))
+# parsed json documents kept in memory
+ARTIFACT_MEMORY_CACHE_ENTRIES = int(
+    os.environ.get('ARTIFACT_MEMORY_CACHE_ENTRIES', 8))
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 32))
+
+_client = None
+_client_lock = threading.Lock()
+# (bucket, key) -> (etag, parsed document)
+_documents = collections.OrderedDict()
+
+
+def get_client_config():
+    import botocore.config
+    options = {
+        "max_pool_connections": S3_MAX_POOL_CONNECTIONS,
+        "connect_timeout": 5,
+        "read_timeout": 60,
+        "retries": {"max_attempts": 8, "mode": "adaptive"},
+        "tcp_keepalive": True
+    }
+    try:
+        return botocore.config.Config(**options)
+    except TypeError:
+        # tcp_keepalive needs botocore 1.27, the lambda runtime may be older
+        options.pop("tcp_keepalive")
+        return botocore.config.Config(**options)
+
+
+def get_client():
+    """Returns the S3 client shared by the whole process"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # boto3 is imported with the first client so the functions
+                # that don't touch the bucket start without it
+                import boto3
+                _client = boto3.client('s3', config=get_client_config())
+    return _client
+
+
+def get_bucket(bucket=None):
+    return bucket or os.environ['ARTIFACTS_BUCKET']
+
+
+def get_directory_key(key, directory=None):
+    """
+    Returns the key of an artifact of a named directory, which are kept
+    under the directory's name. The artifacts of a deployment that
+    maintains a single directory have no prefix.
+    """
+    return f"{directory}/{key}" if directory else key
+
+
+def list_objects(prefix, bucket=None):
+    """Yields the objects under prefix, as returned by ListObjectsV2"""
+    paginator = get_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=get_bucket(bucket), Prefix=prefix):
+        yield from page.get('Contents', [])
+
+
+def get_latest_key(prefix, bucket=None):
+    """Returns the key of the newest object under prefix, or None"""
+    latest = None
+    for obj in list_objects(prefix, bucket):
+        if latest is None or obj['LastModified'] > latest['LastModified']:
+            latest = obj
+    return latest['Key'] if latest else None
+
+
+def _get_cache_path(bucket, key):
+    name = hashlib.sha1(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+    return os.path.join(ARTIFACT_CACHE_DIR, name)
+
+
+def _read_cached(bucket, key):
+    """Returns the ETag and body of a cached object, or (None, None)"""
+    path = _get_cache_path(bucket, key)
+    try:
+        with open(f"{path}.etag") as etag_file, open(path, "rb") as body:
+            return etag_file.read(), body.read()
+    except OSError:
+        return None, None
+
+
+def _write_cached(bucket, key, etag, body):
+    if len(body) > ARTIFACT_CACHE_SIZE:
+        return
+    try:
+        os.makedirs(ARTIFACT_CACHE_DIR, exist_ok=True)
+        _evict(len(body))
+        path = _get_cache_path(bucket, key)
+        with open(path, "wb") as cached:
+            cached.write(body)
+        with open(f"{path}.etag", "w") as etag_file:
+            etag_file.write(etag)
+    except OSError as e:
+        # a full /tmp must never fail the invocation
+        log.warning("Failed to cache %s: %s", key, e)
+
+
+def _evict(needed):
+    """Removes the least recently written objects to make room"""
+    entries = []
+    for name in os.listdir(ARTIFACT_CACHE_DIR):
+        path = os.path.join(ARTIFACT_CACHE_DIR, name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    used = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if used + needed <= ARTIFACT_CACHE_SIZE:
+            break
+        os.remove(path)
+        used -= size
+
+
+def _is_not_modified(error):
+    return error.response.get('Error', {}).get('Code') in (
+        "304", "NotModified")
+
+
+def _fetch(bucket, key, etag):
+    """
+    Downloads an object unless it still has etag, returns the new ETag
+    and body or (etag, None) when the cached copy is current.
+    """
+    kwargs = {"Bucket": bucket, "Key": key}
+    if etag:
+        kwargs["IfNoneMatch"] = etag
+    try:
+        response = get_client().get_object(**kwargs)
+    except botocore.exceptions.ClientError as e:
+        if etag and _is_not_modified(e):
+            metrics.count("artifacts.cache_hits")
+            return etag, None
+        raise
+    metrics.count("artifacts.cache_misses")
+    return response['ETag'], response['Body'].read()
+
+
+def get_object(key, bucket=None):
+    """Returns the body of an object, from the cache when it is current"""
+    bucket = get_bucket(bucket)
+    etag, cached = _read_cached(bucket, key)
+    new_etag, body = _fetch(bucket, key, etag)
+    if body is None:
+        return cached
+    _write_cached(bucket, key, new_etag, body)
+    return body
+
+
+def get_json(key, bucket=None):
+    """
+    Returns the parsed json document stored under key. The document is
+    shared with other callers and must not be modified.
+    """
+    bucket = get_bucket(bucket)
+    cache_key = (bucket, key)
+    etag, document = _documents.get(cache_key, (None, None))
+    body = None
+    if etag is None:
+        etag, body = _read_cached(bucket, key)
+    new_etag, downloaded = _fetch(bucket, key, etag)
+    if downloaded is not None:
+        _write_cached(bucket, key, new_etag, downloaded)
+        body, document = downloaded, None
+    if document is None:
+        document = json.loads(body)
+    _documents[cache_key] = (new_etag, document)
+    _documents.move_to_end(cache_key)
+    while len(_documents) > ARTIFACT_MEMORY_CACHE_ENTRIES:
+        _documents.popitem(last=False)
+    return document
+
+
+def get_latest_json(prefix, bucket=None):
+    """
+    Returns the newest json document under prefix.
+    Raises KeyError when there is none.
+    """
+    key = get_latest_key(prefix, bucket)
+    if key is None:
+        raise KeyError(f"No objects under {prefix}")
+    return get_json(key, bucket)
+
+
+def put_object(key, body, bucket=None):
+    """Uploads body (str or bytes), returns False when the upload failed"""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    try:
+        get_client().put_object(
+            Bucket=get_bucket(bucket),
+            ACL="private",
+            Key=key,
+            Body=body
+        )
+    except botocore.exceptions.ClientError as e:
+        # AllAccessDisabled error == bucket not found
+        log.error("Failed to upload %s: %s", key, e)
+        return False
+    return True
+
+
+def put_json(key, document, bucket=None):
+    return put_object(key, json.dumps(document), bucket)
+
+
+def create_presigned_url(key, expiration=3600, bucket=None):
+    try:
+        return get_client().generate_presigned_url(
+            'get_object',
+            Params={'Bucket': get_bucket(bucket), 'Key': key},
+            ExpiresIn=expiration
+        )
+    except botocore.exceptions.ClientError as e:
+        log.error("Failed to presign %s: %s", key, e)
+        return None
@@ -0,0 +1,129 @@
+"""
+Logging setup shared by the lambda functions.
+
+Log calls on the hot paths should never format their arguments up front:
+pass them as logging arguments so they are only rendered when the record
+is emitted, wrap large values in `summarize` so the rendered text is size
+capped, and use `sample` to log only one in every LOG_SAMPLE_RATE
+iterations of a per-user loop.
+
+    log.debug("processing user: %s", summarize(user_obj))
+    log.info(StructuredMessage("disabled users", users=users))
+"""
+import collections
+import json
+import logging
+import os
+import reprlib
+
+DEFAULT_LOG_LEVEL = logging.INFO
+LOG_LEVELS = collections.defaultdict(
+    lambda: DEFAULT_LOG_LEVEL,
+    {
+        'critical': logging.CRITICAL,
+        'error': logging.ERROR,
+        'warning': logging.WARNING,
+        'info': logging.INFO,
+        'debug': logging.DEBUG
+    }
+)
+LOG_FORMAT = (
+    '%(asctime)s.%(msecs)03dZ [%(name)s][%(levelname)-5s]: %(message)s')
+LOG_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# log one in every LOG_SAMPLE_RATE iterations of a sampled stage
+LOG_SAMPLE_RATE = max(int(os.environ.get('LOG_SAMPLE_RATE', 1000)), 1)
+# maximum number of characters a summarized value is rendered with
+LOG_PAYLOAD_LIMIT = int(os.environ.get('LOG_PAYLOAD_LIMIT', 1024))
+
+_sample_counters = collections.Counter()
+
+
+def configure_logging(log_file_name=""):
+    """
+    Configures the root logger from the LOG_LEVEL environment variable.
+
+    Outside of lambda the output goes to log_file_name instead of stderr.
+    """
+    # Lambda initializes a root logger that needs to be removed in order to
+    # set a different logging config
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    if os.environ.get("AWS_EXECUTION_ENV"):
+        log_file_name = ""
+    logging.basicConfig(
+        filename=log_file_name,
+        format=LOG_FORMAT,
+        datefmt=LOG_DATE_FORMAT,
+        level=LOG_LEVELS[os.environ.get('LOG_LEVEL', '').lower()])
+
+
+def sample(stage, rate=None):
+    """
+    Returns True for the first and then every rate-th call per stage.
+    """
+    rate = rate or LOG_SAMPLE_RATE
+    count = _sample_counters[stage]
+    _sample_counters[stage] += 1
+    return count % rate == 0
+
+
+class Summary:
+    """
+    Renders a value lazily, summarizing collections by their length and
+    truncating the text to limit characters.
+    """
+
+    __slots__ = ("value", "limit")
+
+    _repr = reprlib.Repr()
+    _repr.maxlist = _repr.maxdict = _repr.maxset = 10
+    _repr.maxstring = _repr.maxother = 256
+    _repr.maxlevel = 4
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit or LOG_PAYLOAD_LIMIT
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, dict) and all(
+                isinstance(item, (list, tuple)) for item in value.values()):
+            # e.g. the stale user buckets, which can hold the whole directory
+            text = "{" + ", ".join(
+                f"{key!r}: <{len(item)} items>"
+                for key, item in value.items()) + "}"
+        elif isinstance(value, (list, tuple)):
+            text = f"<{len(value)} items> {self._repr.repr(value)}"
+        else:
+            text = self._repr.repr(value)
+        if len(text) > self.limit:
+            text = f"{text[:self.limit]}... ({len(text)} characters)"
+        return text
+
+    __repr__ = __str__
+
+
+summarize = Summary
+
+
+class StructuredMessage:
+    """
+    A message with key value fields rendered as json when it is emitted.
+    https://docs.python.org/3/howto/logging-cookbook.html#implementing-structured-logging
+    """
+
+    __slots__ = ("message", "fields")
+
+    def __init__(self, message, **fields):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self):
+        fields = {
+            key: str(Summary(value))
+            if isinstance(value, (dict, list, tuple)) else value
+            for key, value in self.fields.items()
+        }
+        return f"{self.message} {json.dumps(fields, default=str)}"
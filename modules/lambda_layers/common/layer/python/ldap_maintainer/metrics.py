@@ -0,0 +1,169 @@
+"""
+Per-stage timers and counters emitted as CloudWatch Embedded Metric Format.
+
+Stages are timed with `metrics.timer("ldap.search")` and counted with
+`metrics.count("users.stale", n)`. Nothing is sent anywhere while the
+handler runs: the values are collected in memory and written to stdout as
+EMF JSON once per invocation by the `instrumented` handler decorator, and
+CloudWatch turns them into metrics without any API calls. Timed stages are
+also recorded as spans of the invocation, see `ldap_maintainer.tracing`.
+
+ref: https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html  # noqa: E501
+"""
+import contextlib
+import functools
+import json
+import math
+import os
+import sys
+import time
+
+from ldap_maintainer.tracing import tracer
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'LdapMaintainer')
+FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+# EMF accepts at most 100 metrics per document and 100 values per metric
+MAX_METRICS_PER_DOCUMENT = 100
+MAX_VALUES_PER_METRIC = 100
+
+
+def get_size_bucket(size):
+    """
+    Rounds a directory size down to its order of magnitude (e.g. 25000 ->
+    "10000") so it can be used as a low cardinality dimension.
+    """
+    if size < 1:
+        return "0"
+    return str(10 ** int(math.log10(size)))
+
+
+class Metrics:
+    """Collects metric values and properties for a single invocation"""
+
+    def __init__(self, namespace=METRICS_NAMESPACE, stream=None):
+        self.namespace = namespace
+        self.stream = stream
+        self.reset()
+
+    def reset(self):
+        self.values = {}
+        self.units = {}
+        self.dimensions = {"FunctionName": FUNCTION_NAME}
+        self.properties = {}
+
+    def put(self, name, value, unit="None"):
+        self.values.setdefault(name, []).append(value)
+        self.units[name] = unit
+
+    def count(self, name, value=1):
+        """Adds value to the counter name"""
+        values = self.values.setdefault(name, [0])
+        values[-1] += value
+        self.units[name] = "Count"
+
+    @contextlib.contextmanager
+    def timer(self, name, span=True):
+        """
+        Records the duration of the with block in milliseconds and, unless
+        span is False, the block as a span.
+        """
+        start = time.perf_counter()
+        try:
+            if span:
+                with tracer.span(name):
+                    yield
+            else:
+                yield
+        finally:
+            self.put(
+                name,
+                round((time.perf_counter() - start) * 1000, 3),
+                "Milliseconds")
+
+    def set_dimension(self, name, value):
+        self.dimensions[name] = str(value)
+
+    def set_directory_size(self, size):
+        """Lets every metric of the invocation be graphed by directory size"""
+        self.set_dimension("DirectorySize", get_size_bucket(size))
+        self.set_property("directory_size", size)
+
+    def set_property(self, name, value):
+        """Adds searchable context that is not a metric or dimension"""
+        self.properties[name] = value
+
+    def serialize(self):
+        """Returns the collected values as a list of EMF documents"""
+        names = list(self.values)
+        dimension_sets = [["FunctionName"]]
+        if len(self.dimensions) > 1:
+            dimension_sets.append(sorted(self.dimensions))
+        documents = []
+        for start in range(0, len(names), MAX_METRICS_PER_DOCUMENT):
+            chunk = names[start:start + MAX_METRICS_PER_DOCUMENT]
+            # metrics with more than the allowed number of values are
+            # spread over additional documents
+            rounds = max(
+                math.ceil(len(self.values[name]) / MAX_VALUES_PER_METRIC)
+                for name in chunk)
+            for round_index in range(rounds):
+                offset = round_index * MAX_VALUES_PER_METRIC
+                document = dict(self.properties)
+                document.update(self.dimensions)
+                metrics = []
+                for name in chunk:
+                    values = self.values[name][
+                        offset:offset + MAX_VALUES_PER_METRIC]
+                    if not values:
+                        continue
+                    document[name] = values if len(values) > 1 else values[0]
+                    metrics.append({"Name": name, "Unit": self.units[name]})
+                document["_aws"] = {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.namespace,
+                        "Dimensions": dimension_sets,
+                        "Metrics": metrics
+                    }]
+                }
+                documents.append(document)
+        return documents
+
+    def flush(self):
+        """Writes the collected values to stdout and starts over"""
+        stream = self.stream or sys.stdout
+        for document in self.serialize():
+            stream.write(json.dumps(document, default=str) + "\n")
+        stream.flush()
+        self.reset()
+
+
+metrics = Metrics()
+
+
+def instrumented(handler):
+    """
+    Times the whole invocation as "handler" and flushes the metrics and
+    spans collected during it, whether or not the handler raised.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        metrics.reset()
+        tracer.reset()
+        if context is not None:
+            metrics.set_property(
+                "request_id", getattr(context, "aws_request_id", None))
+        try:
+            with tracer.invocation(event, context) as span:
+                metrics.set_property("trace_id", span.context.trace_id)
+                # the invocation span already covers the handler
+                with metrics.timer("handler", span=False):
+                    return handler(event, context)
+        except Exception:
+            metrics.count("handler.errors")
+            raise
+        finally:
+            metrics.flush()
+            tracer.flush()
+    return wrapper
@@ -0,0 +1,155 @@
+"""
+Optional profiling of the lambda handlers.
+
+Setting the PROFILER environment variable of a function to "cprofile" or
+"sampling" profiles every invocation of its handler and uploads the result
+to the artifacts bucket under the profiles/ prefix:
+
+- cprofile: deterministic cProfile statistics, saved as a pstats file
+  (`python -m pstats`, snakeviz, ...)
+- sampling: the handler's stack is sampled every PROFILE_SAMPLE_INTERVAL
+  seconds and saved as collapsed stacks, ready for flamegraph.pl or
+  speedscope
+
+Objects are tagged with the step function execution and, when the
+function reported one, the directory size. When PROFILER is unset the
+handler is returned undecorated.
+"""
+import collections
+import cProfile
+import functools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from ldap_maintainer.metrics import FUNCTION_NAME, metrics
+
+log = logging.getLogger(__name__)
+
+PROFILER = os.environ.get('PROFILER', '').lower()
+PROFILE_SAMPLE_INTERVAL = float(
+    os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+PROFILES_PREFIX = "profiles"
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the thread that started it from a background
+    thread and counts identical stacks.
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._target = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} "
+                    f"({os.path.basename(code.co_filename)}:"
+                    f"{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def enable(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self):
+        """Returns the samples in the collapsed stack format"""
+        return "".join(
+            f"{stack} {count}\n"
+            for stack, count in self.stacks.most_common()).encode("utf-8")
+
+
+def dump_cprofile(profiler):
+    """Returns the pstats file content of a cProfile.Profile"""
+    with tempfile.NamedTemporaryFile(suffix=".pstats") as stats_file:
+        profiler.dump_stats(stats_file.name)
+        return stats_file.read()
+
+
+def get_execution_name(event):
+    """
+    Returns the name of the step function execution that invoked the
+    handler, passed in the payload as execution_id.
+    """
+    execution_id = None
+    if isinstance(event, dict):
+        execution_id = event.get('execution_id')
+    if not execution_id:
+        return "no-execution"
+    return execution_id.rsplit(":", 1)[-1]
+
+
+def upload_profile(body, extension, event, context):
+    import boto3
+
+    execution = get_execution_name(event)
+    request_id = getattr(context, "aws_request_id", None) or str(time.time())
+    key = (
+        f"{PROFILES_PREFIX}/{FUNCTION_NAME}/{execution}/"
+        f"{request_id}.{extension}")
+    tags = {"execution": execution, "function": FUNCTION_NAME}
+    directory_size = metrics.properties.get("directory_size")
+    if directory_size is not None:
+        tags["directory_size"] = directory_size
+    boto3.client('s3').put_object(
+        Bucket=os.environ['ARTIFACTS_BUCKET'],
+        Key=key,
+        Body=body,
+        Tagging=urlencode(tags)
+    )
+    log.info("Uploaded profile to %s", key)
+
+
+def profiled(handler, profiler=PROFILER):
+    """
+    Profiles the handler with the profiler selected by PROFILER.
+
+    Must be applied inside `instrumented` so the directory size reported
+    through the metrics is still available when the profile is uploaded.
+    """
+    if profiler == "cprofile":
+        new_profiler, dump, extension = (
+            cProfile.Profile, dump_cprofile, "pstats")
+    elif profiler == "sampling":
+        new_profiler, dump, extension = (
+            SamplingProfiler, SamplingProfiler.dump, "collapsed")
+    else:
+        if profiler:
+            log.error("Unknown profiler %s, profiling is disabled", profiler)
+        return handler
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        active = new_profiler()
+        active.enable()
+        try:
+            return handler(event, context)
+        finally:
+            active.disable()
+            try:
+                upload_profile(dump(active), extension, event, context)
+            except Exception:
+                # a failed upload must never fail the invocation
+                log.exception("Failed to upload the profile")
+    return wrapper
@@ -0,0 +1,312 @@
+"""
+Spans of the lambda invocations of a step function execution.
+
+Every invocation is a span and every `metrics.timer` stage a child span of
+it, so a whole run of the state machine can be read as one trace. Spans
+are collected in memory and exported once per invocation by the
+`instrumented` handler decorator, in the field names of the OpenTelemetry
+OTLP/JSON encoding (attributes as a flat object).
+
+The trace context is carried through the step functions payloads: the
+trace id and the id of the execution's root span are derived from the
+execution ARN passed as execution_id, so the invocations of one execution
+share a trace without handing ids from one state to the next, and the
+state's name and entered time, passed as trace, are recorded with the
+invocation. Across the slack approval, the context travels in the button
+value as a W3C traceparent in front of the task token (`inject` and
+`extract`).
+
+The state that ends the execution also passes the execution's start time
+(trace.execution_start) and its invocation exports the root span, from
+the start of the execution until the end of the invocation.
+
+TRACE_EXPORTER selects where spans go:
+
+- log (default): one json document per span on stdout
+- file: one json file per invocation under TRACE_DIR, e.g. for tests
+- none: spans are not exported
+
+ref: https://www.w3.org/TR/trace-context/#traceparent-header
+"""
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'log').lower()
+TRACE_DIR = os.environ.get('TRACE_DIR', 'traces')
+# spans recorded per invocation beyond this are counted but not exported
+MAX_SPANS = int(os.environ.get('TRACE_MAX_SPANS', 1000))
+FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+TRACEPARENT = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}")
+STATUS_OK = "STATUS_CODE_OK"
+STATUS_ERROR = "STATUS_CODE_ERROR"
+
+
+def derive_id(value, length):
+    """Returns an id of length hex digits that is unique to value"""
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:length]
+
+
+def new_id(length):
+    return os.urandom(length // 2).hex()
+
+
+def parse_timestamp(value):
+    """
+    Returns the nanoseconds since the epoch of a step functions timestamp,
+    e.g. 2020-06-01T12:00:00.123Z, or None if it can't be parsed.
+    """
+    try:
+        timestamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    return int(timestamp.timestamp() * 10 ** 9)
+
+
+class SpanContext(namedtuple("SpanContext", "trace_id span_id")):
+    """Identifies a span across processes"""
+
+    __slots__ = ()
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @classmethod
+    def parse(cls, traceparent):
+        """Returns the context of a traceparent, None if it isn't one"""
+        match = TRACEPARENT.fullmatch(traceparent or "")
+        return cls(*match.groups()) if match else None
+
+    @classmethod
+    def from_execution(cls, execution_id):
+        """Returns the context of an execution's root span"""
+        return cls(
+            derive_id(execution_id, 32),
+            derive_id(f"execution:{execution_id}", 16))
+
+
+class Span:
+
+    __slots__ = (
+        "name", "context", "parent_id", "kind", "start", "end",
+        "attributes", "status", "message")
+
+    def __init__(self, name, context, parent_id=None, kind="INTERNAL",
+                 start=None, attributes=None):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start = start or time.time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.status = STATUS_OK
+        self.message = ""
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+    def set_error(self, error):
+        self.status = STATUS_ERROR
+        self.message = f"{type(error).__name__}: {error}"
+
+    def to_json(self):
+        span = {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "name": self.name,
+            "kind": f"SPAN_KIND_{self.kind}",
+            "startTimeUnixNano": self.start,
+            "endTimeUnixNano": self.end,
+            "attributes": self.attributes,
+            "status": {"code": self.status},
+            "resource": {"service.name": FUNCTION_NAME},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.message:
+            span["status"]["message"] = self.message
+        return span
+
+
+class Tracer:
+    """Records the spans of a single invocation"""
+
+    def __init__(self, exporter=TRACE_EXPORTER, directory=TRACE_DIR,
+                 stream=None, max_spans=MAX_SPANS):
+        self.exporter = exporter
+        self.directory = directory
+        self.stream = stream
+        self.max_spans = max_spans
+        self.reset()
+
+    def reset(self):
+        self.active = []
+        self.finished = []
+        self.dropped = 0
+        self.root = None
+
+    def current(self):
+        """Returns the context of the innermost active span, if any"""
+        return self.active[-1].context if self.active else None
+
+    def start_span(self, name, parent=None, kind="INTERNAL", start=None,
+                   **attributes):
+        """
+        Starts a span, a child of parent (a SpanContext) when given or of
+        the innermost active span. Without either it starts a new trace.
+        """
+        parent = parent or self.current()
+        trace_id = parent.trace_id if parent else new_id(32)
+        span = Span(
+            name,
+            SpanContext(trace_id, new_id(16)),
+            parent.span_id if parent else None,
+            kind,
+            start,
+            attributes)
+        self.active.append(span)
+        return span
+
+    def end_span(self, span):
+        span.end = time.time_ns()
+        # spans of generators can end out of order
+        if self.active and self.active[-1] is span:
+            self.active.pop()
+        elif span in self.active:
+            self.active.remove(span)
+        # the invocation span ends last and is always kept
+        if span.kind == "SERVER" or len(self.finished) < self.max_spans:
+            self.finished.append(span)
+        else:
+            self.dropped += 1
+
+    @contextlib.contextmanager
+    def span(self, name, parent=None, **attributes):
+        """Records the with block as a span"""
+        span = self.start_span(name, parent, **attributes)
+        try:
+            yield span
+        except Exception as e:
+            span.set_error(e)
+            raise
+        finally:
+            self.end_span(span)
+
+    @contextlib.contextmanager
+    def invocation(self, event, context):
+        """
+        Records a handler invocation as a span of the execution that
+        invoked it, or as the root of a new trace when it wasn't invoked
+        by the state machine.
+        """
+        name = getattr(context, "function_name", None) or FUNCTION_NAME
+        attributes = {
+            "faas.name": name,
+            "faas.execution": getattr(context, "aws_request_id", None)
+        }
+        parent = None
+        trace = {}
+        execution_id = None
+        if isinstance(event, dict):
+            trace = event.get('trace') or {}
+            execution_id = event.get('execution_id')
+            if execution_id:
+                attributes["sfn.execution"] = execution_id
+                parent = SpanContext.from_execution(execution_id)
+            parent = SpanContext.parse(trace.get('traceparent')) or parent
+        span = self.start_span(name, parent, "SERVER", **attributes)
+        if trace.get('state'):
+            span.set_attribute("sfn.state", trace['state'])
+        entered = parse_timestamp(trace.get('entered'))
+        if entered:
+            # the time between the state machine entering the state and
+            # the handler running: scheduling, cold start and init
+            span.set_attribute(
+                "sfn.state_wait_ms",
+                round((span.start - entered) / 10 ** 6, 3))
+        execution_start = parse_timestamp(trace.get('execution_start'))
+        if execution_id and execution_start:
+            self.root = Span(
+                "execution",
+                SpanContext.from_execution(execution_id),
+                start=execution_start,
+                attributes={"sfn.execution": execution_id})
+        try:
+            yield span
+        except Exception as e:
+            span.set_error(e)
+            raise
+        finally:
+            self.end_span(span)
+
+    def serialize(self):
+        """Returns the finished spans as OTLP/JSON objects"""
+        spans = [span.to_json() for span in self.finished]
+        if self.root is not None:
+            self.root.end = time.time_ns()
+            spans.append(self.root.to_json())
+        if self.dropped and spans:
+            spans[-1]["droppedSpans"] = self.dropped
+        return spans
+
+    def flush(self):
+        """Exports the finished spans and starts over"""
+        spans = self.serialize() if self.exporter != "none" else []
+        if self.exporter == "file" and spans:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(
+                self.directory,
+                f"{FUNCTION_NAME}-{time.time_ns()}-{new_id(8)}.json")
+            with open(path, "w") as spans_file:
+                json.dump(spans, spans_file, default=str)
+        elif self.exporter == "log" and spans:
+            stream = self.stream or sys.stdout
+            for span in spans:
+                stream.write(json.dumps(span, default=str) + "\n")
+            stream.flush()
+        self.reset()
+
+
+tracer = Tracer()
+
+
+def inject(value):
+    """
+    Prefixes value (e.g. a task token) with the traceparent of the active
+    span so whatever receives it can continue the trace.
+    """
+    context = tracer.current()
+    if context is None:
+        return value
+    return f"{context.traceparent} {value}"
+
+
+def extract(value):
+    """
+    Returns the span context injected in value, or None, and the
+    original value.
+    """
+    traceparent, _, rest = value.partition(" ")
+    context = SpanContext.parse(traceparent)
+    if context is None:
+        return None, value
+    return context, rest
+
+
+def read_spans(directory=TRACE_DIR):
+    """Returns the spans the file exporter wrote to directory"""
+    spans = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as spans_file:
+                spans.extend(json.load(spans_file))
+    return spans
@@ -0,0 +1,20 @@
+resource "random_string" "this" {
+  length  = 8
+  special = false
+  upper   = false
+}
+
+data "archive_file" "layer" {
+  type        = "zip"
+  source_dir  = "${path.module}/layer"
+  output_path = "${path.module}/layer_payload.zip"
+}
+
+resource "aws_lambda_layer_version" "this" {
+  filename         = data.archive_file.layer.output_path
+  layer_name       = "${var.project_name}-common-${random_string.this.result}"
+  description      = "Code shared by the ${var.project_name} lambda functions"
+  source_code_hash = data.archive_file.layer.output_base64sha256
+
+  compatible_runtimes = ["python3.7"]
+}
@@ -0,0 +1,4 @@
+output "layer_arn" {
+  description = "The ARN of the shared code layer version"
+  value       = aws_lambda_layer_version.this.arn
+}
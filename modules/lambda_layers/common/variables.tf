@@ -0,0 +1,5 @@
+variable "project_name" {
+  default     = "ldap-maintainer"
+  description = "Name of the project"
+  type        = string
+}
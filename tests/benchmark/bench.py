@@ -0,0 +1,801 @@
+"""
+Local end to end benchmark of the ldap maintainer lambda functions.
+
+Every handler is run in-process, in the order the state machine runs them,
+against local stand-ins: an in-memory directory (fake_ldap), moto for S3,
+DynamoDB, SSM and Step Functions and a stub slack HTTP server. Each
+directory size runs in a fresh interpreter and for every stage the wall
+time, peak RSS and the number of AWS, LDAP and slack calls are reported.
+
+usage:
+    pip install -r tests/benchmark/requirements.txt
+    python tests/benchmark/bench.py --sizes 10000 100000 1000000
+"""
+import argparse
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import hmac
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import pathlib
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import quote_plus
+
+BENCHMARK_DIR = pathlib.Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARK_DIR.parents[1]
+FUNCTIONS_DIR = REPO_ROOT / "modules" / "lambda_functions"
+COMMON_LAYER_DIR = (
+    REPO_ROOT / "modules" / "lambda_layers" / "common" / "layer" / "python")
+
+DOMAIN_BASE = "DC=bench,DC=example,DC=com"
+USERS_DN = f"CN=Users,{DOMAIN_BASE}"
+APPROVER_GROUP_DN = f"CN=LDAP Approvers,{USERS_DN}"
+SVC_USER_DN = f"CN=svc_ldapmaint,{USERS_DN}"
+# every user is a member of the all staff group, large enough to be read
+# in ranges, and of one of the team groups
+ALL_STAFF_DN = f"CN=All Staff,{USERS_DN}"
+TEAM_COUNT = 4
+ARTIFACTS_BUCKET = "ldap-maintainer-benchmark-artifacts"
+DISTRO_TABLE = "ldap-maintainer-benchmark-distros"
+IDEMPOTENCY_TABLE = "ldap-maintainer-benchmark-idempotency"
+PROJECTION_TABLE = "ldap-maintainer-benchmark-projection"
+SSM_KEY = "/benchmark/svc_user_pwd"
+SIGNING_SECRET = "benchmark-signing-secret"
+TASK_TOKEN = "benchmark-task-token"
+EXECUTION_ARN = (
+    "arn:aws:states:us-east-1:123456789012:execution:ldap-maintainer:"
+    "benchmark")
+
+POPULATE_LDAP_DIR = (
+    REPO_ROOT / "tests" / "test_infrastructure" / "modules" / "lambda" /
+    "populate_ldap" / "src")
+# users after the hands off accounts that are members of the approver group
+APPROVER_COUNT = 5
+
+
+def generate_users(size, seed):
+    """
+    Yields (dn, attributes) for size users of the synthetic directory the
+    populate_ldap test function loads, with the first regular users made
+    approvers.
+    """
+    sys.path.insert(0, str(POPULATE_LDAP_DIR))
+    from synthetic_directory import HANDS_OFF_ACCOUNTS
+    from synthetic_directory import generate_users as generate_synthetic
+
+    approvers = range(
+        len(HANDS_OFF_ACCOUNTS), len(HANDS_OFF_ACCOUNTS) + APPROVER_COUNT)
+    for index, user_obj in enumerate(
+            generate_synthetic(size, DOMAIN_BASE, seed=seed)):
+        attributes = user_obj["user"]
+        # assigned by the domain controller itself on a real directory
+        attributes["objectCategory"] = [b"person"]
+        if index in approvers:
+            attributes["memberOf"] = [APPROVER_GROUP_DN.encode()]
+        yield user_obj["dn"], attributes
+
+
+class FakeContext:
+    """Minimal stand-in for the lambda context object"""
+
+    def __init__(self, function_name, timeout=300):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self._deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self._deadline - time.monotonic()) * 1000)
+
+
+class PeakRSSSampler:
+    """Samples the resident set size of this process in the background."""
+
+    INTERVAL = 0.005
+
+    def __init__(self):
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_rss():
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            # ru_maxrss is the lifetime peak (in KiB on linux)
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current_rss())
+            self._stop.wait(self.INTERVAL)
+
+    def __enter__(self):
+        self.peak = self.current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current_rss())
+
+
+class StageRecorder:
+    """Collects per stage timings and call counts."""
+
+    def __init__(self, directory, slack_stub):
+        self.directory = directory
+        self.slack_stub = slack_stub
+        self.aws_calls = collections.Counter()
+        self.results = []
+        # the embedded metrics the handlers flush are captured here
+        # instead of being written to stdout
+        self.metrics_stream = io.StringIO()
+
+    def count_aws_call(self, model, **kwargs):
+        service = model.service_model.service_name
+        self.aws_calls[f"{service}.{model.name}"] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        aws_before = collections.Counter(self.aws_calls)
+        ldap_before = collections.Counter(self.directory.counters)
+        slack_before = collections.Counter(self.slack_stub.calls)
+        self.metrics_stream.seek(0)
+        self.metrics_stream.truncate()
+        with PeakRSSSampler() as rss:
+            start = time.perf_counter()
+            yield
+            wall = time.perf_counter() - start
+        timers, counters = self.get_metrics()
+        self.results.append({
+            "timers_ms": timers,
+            "counters": counters,
+            "stage": name,
+            "wall_seconds": round(wall, 4),
+            "peak_rss_mb": round(rss.peak / 2 ** 20, 1),
+            "aws_calls": dict(self.aws_calls - aws_before),
+            "ldap_calls": dict(self.directory.counters - ldap_before),
+            "slack_calls": dict(self.slack_stub.calls - slack_before),
+        })
+
+    def get_metrics(self):
+        """
+        Returns the summed timers and counters flushed during a stage
+        """
+        timers = collections.Counter()
+        counters = collections.Counter()
+        for line in self.metrics_stream.getvalue().splitlines():
+            document = json.loads(line)
+            for directive in document["_aws"]["CloudWatchMetrics"]:
+                for metric in directive["Metrics"]:
+                    values = document[metric["Name"]]
+                    if not isinstance(values, list):
+                        values = [values]
+                    totals = (
+                        timers if metric["Unit"] == "Milliseconds"
+                        else counters)
+                    totals[metric["Name"]] += sum(values)
+        return (
+            {name: round(value, 3) for name, value in timers.items()},
+            dict(counters))
+
+
+def load_function(name):
+    """Imports a lambda function's handler module under its module name"""
+    source = FUNCTIONS_DIR / name / "src"
+    if not source.is_dir():
+        source = FUNCTIONS_DIR / name
+    # the other modules packaged with the handler are importable on lambda
+    sys.path.insert(0, str(source))
+    path = source / "lambda.py"
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def set_environment(slack_url):
+    os.environ.update({
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        # log to stderr instead of a log file and keep the output quiet
+        "AWS_EXECUTION_ENV": "benchmark",
+        "LOG_LEVEL": "warning",
+        "ARTIFACTS_BUCKET": ARTIFACTS_BUCKET,
+        "LDAPS_URL": "ldaps://benchmark.invalid",
+        "DOMAIN_BASE": DOMAIN_BASE,
+        "SVC_USER_DN": SVC_USER_DN,
+        "SSM_KEY": SSM_KEY,
+        "FILTER_PREFIXES": json.dumps(["svc"]),
+        "HANDS_OFF_ACCOUNTS": json.dumps(["Administrator", "krbtgt"]),
+        "APPROVER_GROUP_DN": APPROVER_GROUP_DN,
+        "SLACK_API_TOKEN": "xoxb-benchmark",
+        "SLACK_API_URL": slack_url,
+        "SLACK_CHANNEL_ID": "CBENCHMARK",
+        "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+        "INVOKE_BASE_URL": "https://benchmark.invalid",
+        "TIMEZONE": "US/Eastern",
+        "POST_USER_DETAILS": "true",
+        "USER_DETAILS_MAX_PAGES": "0",
+        "DYNAMODB_TABLE": DISTRO_TABLE,
+        "IDEMPOTENCY_TABLE": IDEMPOTENCY_TABLE,
+        "PROJECTION_TABLE": PROJECTION_TABLE,
+        # the synthetic directory keeps every user in CN=Users
+        "SHARD_STRATEGY": "prefix",
+        "SHARD_COUNT": "8",
+        # pace the disable writes without slowing the benchmark down
+        "DISABLE_RATE": "5000",
+        "DISABLE_BURST": "50",
+        "REMOVE_GROUP_MEMBERSHIPS": "true",
+        # the spans of every invocation are checked once the run is done
+        "TRACE_EXPORTER": "file",
+        "TRACE_DIR": tempfile.mkdtemp(prefix="ldap-maintainer-traces-"),
+        # keep the warm artifact cache of each run to itself
+        "ARTIFACT_CACHE_DIR": tempfile.mkdtemp(prefix="ldap-maintainer-"),
+    })
+
+
+def create_aws_resources(size, seed):
+    import boto3
+    boto3.client("s3").create_bucket(Bucket=ARTIFACTS_BUCKET)
+    boto3.client("ssm").put_parameter(
+        Name=SSM_KEY, Value="benchmark", Type="SecureString")
+    dynamodb = boto3.client("dynamodb")
+    for table, key in ((DISTRO_TABLE, "account_name"),
+                       (IDEMPOTENCY_TABLE, "idempotency_key")):
+        dynamodb.create_table(
+            TableName=table,
+            KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST")
+    dynamodb.create_table(
+        TableName=PROJECTION_TABLE,
+        KeySchema=[{"AttributeName": "dn", "KeyType": "HASH"}],
+        AttributeDefinitions=[
+            {"AttributeName": "dn", "AttributeType": "S"},
+            {"AttributeName": "bucket", "AttributeType": "S"},
+            {"AttributeName": "directory", "AttributeType": "S"}],
+        GlobalSecondaryIndexes=[{
+            "IndexName": "bucket-index",
+            "KeySchema": [
+                {"AttributeName": "bucket", "KeyType": "HASH"},
+                {"AttributeName": "dn", "KeyType": "RANGE"}],
+            "Projection": {"ProjectionType": "ALL"}}, {
+            "IndexName": "directory-index",
+            "KeySchema": [
+                {"AttributeName": "directory", "KeyType": "HASH"},
+                {"AttributeName": "dn", "KeyType": "RANGE"}],
+            "Projection": {"ProjectionType": "KEYS_ONLY"}}],
+        BillingMode="PAY_PER_REQUEST")
+    # one account per hundred users, each with two distros of 20 members
+    rng = random.Random(seed)
+    table = boto3.resource("dynamodb").Table(DISTRO_TABLE)
+    with table.batch_writer() as batch:
+        for i in range(max(size // 100, 10)):
+            batch.put_item(Item={
+                "account_name": f"account{i:05d}",
+                "email_distros": {
+                    f"Distro{d}": [
+                        f"user{rng.randrange(size):07d}@bench.example.com"
+                        for _ in range(20)]
+                    for d in range(2)
+                }
+            })
+
+
+def get_timestamp():
+    """Returns the current time formatted like the state machine's"""
+    return datetime.now(timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def sfn_event(state, payload, execution_start=None):
+    """
+    Returns the payload of a lambda invoke as the state machine passes it,
+    with the execution and the trace context of the state.
+    """
+    trace = {"state": state, "entered": get_timestamp()}
+    if execution_start:
+        trace["execution_start"] = execution_start
+    return dict(payload, execution_id=EXECUTION_ARN, trace=trace)
+
+
+def get_button_value(blocks, action_id):
+    for block in blocks:
+        for element in block.get("elements", ()):
+            if element.get("action_id") == action_id:
+                return element["value"]
+    raise AssertionError(f"the message has no {action_id} button")
+
+
+def get_interaction_record(message_id, blocks, response_url, timestamp):
+    """Returns a signed SQS record for an approve button press"""
+    payload = {
+        "type": "block_actions",
+        "user": {"id": "UBENCHMARK"},
+        "channel": {"id": "CBENCHMARK"},
+        "actions": [{
+            "action_id": "Approve",
+            "value": get_button_value(blocks, "Approve")}],
+        "response_url": response_url,
+        "message": {"ts": "1.000000", "blocks": blocks},
+    }
+    body = "payload=" + quote_plus(json.dumps(payload))
+    signature = "v0=" + hmac.new(
+        SIGNING_SECRET.encode(),
+        f"v0:{timestamp}:{body}".encode(),
+        hashlib.sha256).hexdigest()
+    return {
+        "messageId": message_id,
+        "body": body,
+        "attributes": {"SentTimestamp": str(timestamp * 1000)},
+        "messageAttributes": {
+            "X-Slack-Request-Timestamp": {
+                "stringValue": str(timestamp), "dataType": "String"},
+            "X-Slack-Signature": {
+                "stringValue": signature, "dataType": "String"},
+        },
+    }
+
+
+def check_trace(directory, stages):
+    """
+    Checks that the spans exported during the run form the trace of the
+    benchmark execution and returns the milliseconds spent in the
+    invocations of every state.
+    """
+    from ldap_maintainer.tracing import SpanContext, read_spans
+    spans = read_spans(directory)
+    execution = SpanContext.from_execution(EXECUTION_ARN)
+    traced = [
+        span for span in spans if span["traceId"] == execution.trace_id]
+    invocations = [
+        span for span in spans
+        if span["attributes"].get("sfn.execution") == EXECUTION_ARN and
+        span["kind"] == "SPAN_KIND_SERVER"]
+    if any(span["traceId"] != execution.trace_id or
+           span.get("parentSpanId") != execution.span_id
+           for span in invocations):
+        raise AssertionError(
+            "an invocation is not a child of the execution's span")
+    span_ids = {span["spanId"] for span in traced} | {execution.span_id}
+    orphans = [
+        span["name"] for span in traced
+        if span.get("parentSpanId") and
+        span["parentSpanId"] not in span_ids]
+    if orphans:
+        raise AssertionError(f"spans without a parent: {orphans}")
+    if {"slack_notifier:report", "slack_listener:approve"} <= set(stages):
+        parents = {
+            span["spanId"]: span.get("parentSpanId") for span in traced}
+
+        def get_invocation(span_id):
+            while parents.get(span_id) not in (None, execution.span_id):
+                span_id = parents[span_id]
+            return span_id
+
+        reports = {
+            span["spanId"] for span in invocations
+            if span["attributes"].get("sfn.state") ==
+            "wait_for_manual_approval"}
+        buttons = [span for span in spans if span["name"] == "slack.button"]
+        if not buttons or any(
+                get_invocation(span.get("parentSpanId")) not in reports
+                for span in buttons):
+            raise AssertionError(
+                "the button presses don't continue the report's trace")
+    if "slack_notifier:status" in stages and not any(
+            span["spanId"] == execution.span_id for span in traced):
+        raise AssertionError("the execution's span was not exported")
+    states = collections.Counter()
+    for span in invocations:
+        states[span["attributes"]["sfn.state"]] += (
+            span["endTimeUnixNano"] - span["startTimeUnixNano"]) / 10 ** 6
+    return {
+        "spans": len(traced),
+        "states_ms": {
+            state: round(value, 3) for state, value in states.items()},
+    }
+
+
+STAGES = (
+    "ldap_query:query",
+    "ldap_query:parallel",
+    "ldap_query:replay",
+    "ldap_query:concurrent",
+    "ldap_query:sharded",
+    "ldap_query:projection",
+    "slack_notifier:report",
+    "slack_listener:approve",
+    "slack_notifier:update",
+    "ldap_query:disable",
+    "ldap_query:rescan",
+    "dynamodb_cleanup:remove",
+    "slack_notifier:status",
+)
+
+
+def get_ldif_line(name, value):
+    """Formats an attribute value the way ldapsearch does, folded at 76"""
+    if value and all(32 <= byte < 127 for byte in value) and \
+            value[:1] not in b" :<":
+        line = name.encode() + b": " + value
+    else:
+        line = name.encode() + b":: " + base64.b64encode(value)
+    folded = [line[:76]] + [
+        b" " + line[start:start + 75] for start in range(76, len(line), 75)]
+    return b"\n".join(folded) + b"\n"
+
+
+def write_ldif(directory, path):
+    """Dumps every entry of the fake directory as LDIF"""
+    with open(path, "wb") as ldif:
+        ldif.write(b"version: 1\n\n")
+        for entry in directory.entries.values():
+            ldif.write(get_ldif_line("dn", entry.dn.encode()))
+            for name, values in entry.attributes.items():
+                for value in values:
+                    ldif.write(get_ldif_line(name, value))
+            ldif.write(b"\n")
+
+
+def scan_directory(ldap_query):
+    """Scans the directory the way the query action does, without uploads"""
+    rows = []
+    diff = ldap_query.ScanDiff(ldap_query.get_previous_scan_index())
+    users = ldap_query.LdapMaintainer().get_stale_users(rows=rows, diff=diff)
+    return users, rows, ldap_query.dump_index(diff.index), diff.changes
+
+
+def run_size(size, seed, stages=STAGES):
+    """
+    Benchmarks the selected stages against a directory of size users.
+
+    Stages always run in state machine order and depend on the artifacts
+    of the stages before them, the query stage is always run.
+    """
+    sys.path.insert(0, str(BENCHMARK_DIR))
+    sys.path.insert(0, str(COMMON_LAYER_DIR))
+    import fake_ldap
+    from slack_stub import SlackStub
+
+    # reject some writes to exercise the disable scheduler's backoff
+    directory = fake_ldap.FakeDirectory(busy_every=100)
+    approver_emails = []
+    groups = collections.defaultdict(list)
+    groups[APPROVER_GROUP_DN] = []
+    for index, (dn, attributes) in enumerate(generate_users(size, seed)):
+        if "memberOf" in attributes:
+            approver_emails.append(attributes["mail"][0].decode())
+        member_of = attributes.setdefault("memberOf", [])
+        member_of.append(ALL_STAFF_DN.encode())
+        member_of.append(
+            f"CN=Team {index % TEAM_COUNT},{USERS_DN}".encode())
+        for group_dn in member_of:
+            groups[group_dn.decode()].append(dn.encode())
+        directory.add(dn, attributes)
+    for group_dn, members in groups.items():
+        directory.add(group_dn, {
+            "objectClass": [b"top", b"group"], "member": members})
+    # the container the ou shards and concurrent searches are planned from
+    directory.add(USERS_DN, {"objectClass": [b"top", b"container"]})
+    fake_ldap.install(directory)
+
+    from moto import mock_aws
+    with SlackStub(user_email=approver_emails[0]) as slack, \
+            mock_aws():
+        set_environment(slack.url)
+        import boto3
+        boto3.setup_default_session()
+        recorder = StageRecorder(directory, slack)
+        from ldap_maintainer.metrics import metrics
+        metrics.stream = recorder.metrics_stream
+        create_aws_resources(size, seed)
+        boto3.DEFAULT_SESSION.events.register(
+            "before-call", recorder.count_aws_call)
+
+        functions = {}
+        with recorder.stage("import"):
+            for name in ("ldap_query", "slack_notifier", "slack_listener",
+                         "dynamodb_cleanup"):
+                functions[name] = load_function(name)
+
+        def invoke(name, event):
+            return functions[name].handler(event, FakeContext(name))
+
+        execution_start = get_timestamp()
+
+        with recorder.stage("ldap_query:query"):
+            query_result = invoke(
+                "ldap_query", {"Input": {"action": "query"}})
+
+        if "ldap_query:parallel" in stages:
+            ldap_query = functions["ldap_query"]
+            serial = scan_directory(ldap_query)
+            ldap_query.CLASSIFY_WORKERS = 2
+            ldap_query.SEARCH_PAGE_SIZE = max(size // 8, 1)
+            try:
+                with recorder.stage("ldap_query:parallel"):
+                    parallel = scan_directory(ldap_query)
+            finally:
+                ldap_query.CLASSIFY_WORKERS = 0
+            if parallel != serial:
+                raise AssertionError(
+                    "the parallel scan differs from the serial scan")
+
+        if "ldap_query:replay" in stages:
+            ldap_query = functions["ldap_query"]
+            # the replay cli imports the handler module as lambda
+            sys.modules["lambda"] = ldap_query
+            import replay
+            dump = os.path.join(os.environ["ARTIFACT_CACHE_DIR"], "dump.ldif")
+            write_ldif(directory, dump)
+            diff = ldap_query.ScanDiff()
+            users = ldap_query.LdapMaintainer().get_stale_users(diff=diff)
+            replayed_diff = ldap_query.ScanDiff()
+            with recorder.stage("ldap_query:replay"):
+                replayed = replay.ReplayMaintainer(dump).get_stale_users(
+                    diff=replayed_diff)
+            if replayed != users or ldap_query.dump_index(
+                    replayed_diff.index) != ldap_query.dump_index(diff.index):
+                raise AssertionError(
+                    "the replayed scan differs from the directory scan")
+
+        if "ldap_query:concurrent" in stages:
+            ldap_query = functions["ldap_query"]
+            serial = scan_directory(ldap_query)[0]
+            ldap_query.SEARCH_CONNECTIONS = 2
+            try:
+                with recorder.stage("ldap_query:concurrent"):
+                    concurrent = scan_directory(ldap_query)[0]
+            finally:
+                ldap_query.SEARCH_CONNECTIONS = 0
+            # the users come back container by container
+            for bucket in serial:
+                if sorted(concurrent[bucket], key=lambda user: user["dn"]) \
+                        != sorted(serial[bucket], key=lambda user: user["dn"]):
+                    raise AssertionError(
+                        f"the concurrent search found other {bucket} users")
+
+        if "ldap_query:sharded" in stages:
+            # the Map state, one shard after the other, as a named
+            # directory of a deployment maintaining several
+            scanned = {"name": "bench"}
+            with recorder.stage("ldap_query:sharded"):
+                plan = invoke("ldap_query", sfn_event(
+                    "plan_ldap_query", {"Input": {
+                        "action": "plan", "directory": scanned}}))
+                shard_results = [
+                    invoke("ldap_query", sfn_event("scan_ldap_shard", {
+                        "Input": {
+                            "action": "scan-shard",
+                            "run_id": plan["run_id"],
+                            "shard": shard,
+                            "directory": scanned}}))
+                    for shard in plan["shards"]
+                ]
+                sharded_result = invoke("ldap_query", sfn_event(
+                    "merge_ldap_shards", {"Input": {
+                        "action": "merge",
+                        "run_id": plan["run_id"],
+                        "shards": shard_results,
+                        "directory": scanned}}))
+            keys = sharded_result["artifact_keys"].values()
+            if not all(key.startswith("bench/") for key in keys):
+                raise AssertionError(
+                    f"sharded scan uploaded {list(keys)} outside bench/")
+            sharded_totals = sharded_result["query_results"]["totals"]
+            if sharded_totals != query_result["query_results"]["totals"]:
+                raise AssertionError(
+                    f"sharded scan found {sharded_totals} instead of "
+                    f"{query_result['query_results']['totals']}")
+            # the directory has no index of its own to diff against yet
+            changes = sharded_result["query_results"]["changes"]
+            if not changes["baseline"]:
+                raise AssertionError(
+                    f"sharded scan diffed against another directory {changes}")
+
+        if "ldap_query:projection" in stages:
+            # the rows belong to the directory that scanned them last
+            counts_event = {"action": "projection", "query": "counts"}
+            if "ldap_query:sharded" in stages:
+                counts_event["directory"] = scanned
+            with recorder.stage("ldap_query:projection"):
+                counts = invoke("ldap_query", {"Input": counts_event})
+            if counts["totals"] != query_result["query_results"]["totals"]:
+                raise AssertionError(
+                    f"projection counted {counts['totals']} instead of "
+                    f"{query_result['query_results']['totals']}")
+
+        notify_event = sfn_event("wait_for_manual_approval", {
+            "token": TASK_TOKEN, "event": {
+                "directories": [{"name": ""}], "scans": [query_result]}})
+        if "slack_notifier:report" in stages:
+            with recorder.stage("slack_notifier:report"):
+                invoke("slack_notifier", notify_event)
+            # the report is posted first, then the user details thread
+            message = slack.messages[0]
+        else:
+            message = functions["slack_notifier"].build_slack_user_message(
+                notify_event)
+        blocks = message["blocks"]
+        if isinstance(blocks, str):
+            blocks = json.loads(blocks)
+        now = int(time.time())
+        # a double click arrives as a second, separately signed request
+        records = [
+            get_interaction_record(
+                f"message-{i}", blocks, f"{slack.url}response", now + i)
+            for i in range(2)
+        ]
+        if "slack_listener:approve" in stages:
+            with recorder.stage("slack_listener:approve"):
+                result = invoke("slack_listener", {"Records": records})
+            if result["batchItemFailures"]:
+                raise AssertionError(
+                    f"the listener failed {result['batchItemFailures']}")
+
+        if "slack_notifier:update" in stages:
+            with recorder.stage("slack_notifier:update"):
+                invoke("slack_notifier", sfn_event(
+                    "notify_slack_of_approval",
+                    {"message_to_slack": "approved"}))
+
+        recovered = 0
+        if "ldap_query:disable" in stages:
+            # a user changes their password while the approval is pending,
+            # the disable action must skip them
+            stale = functions["ldap_query"].get_previous_scan_results()["120"]
+            now = int(time.time() * 10 ** 7) + 116444736000000000
+            directory.modify(stale[0]["dn"], [(
+                fake_ldap.MOD_REPLACE, "pwdLastSet", [str(now).encode()])])
+            recovered = 1
+            with recorder.stage("ldap_query:disable"):
+                # check_disable_progress resumes from the checkpoint until
+                # every user is disabled
+                state, event = "run_ldap_query_again", {"action": "disable"}
+                while True:
+                    result = invoke(
+                        "ldap_query", sfn_event(state, {"Input": event}))
+                    if result["status"] != "incomplete":
+                        break
+                    state, event = "continue_disable", {
+                        "action": "disable",
+                        "checkpoint": result["checkpoint"]}
+            disabled_dns = [user["dn"] for user in stale[recovered:]]
+            # the dynamodb cleanup only acts on the users disabled
+            published = functions["dynamodb_cleanup"].get_disabled_users(
+                result["disabled"])
+            if sorted(user["dn"] for user in published) != sorted(
+                    disabled_dns):
+                raise AssertionError(
+                    f"{len(published)} users published as disabled "
+                    f"instead of {len(disabled_dns)}")
+            in_groups = [
+                dn for dn in disabled_dns
+                if directory.entries[dn.lower()].attributes.get("memberOf")]
+            if in_groups:
+                raise AssertionError(
+                    f"{len(in_groups)} disabled users are still group members")
+            all_staff = directory.entries[ALL_STAFF_DN.lower()]
+            if len(all_staff.attributes["member"]) != size - len(disabled_dns):
+                raise AssertionError(
+                    f"{ALL_STAFF_DN} has {len(all_staff.attributes['member'])}"
+                    f" members instead of {size - len(disabled_dns)}")
+
+        if "ldap_query:rescan" in stages:
+            with recorder.stage("ldap_query:rescan"):
+                rescan_result = invoke(
+                    "ldap_query", {"Input": {"action": "query"}})
+            changes = rescan_result["query_results"]["changes"]
+            disabled = query_result["query_results"]["totals"]["120"] - \
+                recovered
+            if ("ldap_query:disable" in stages and
+                    changes["disabled"] != disabled):
+                raise AssertionError(
+                    f"rescan found {changes['disabled']} newly disabled "
+                    f"users instead of {disabled}")
+
+        if "dynamodb_cleanup:remove" in stages:
+            cleanup_event = {"action": "remove"}
+            if "ldap_query:disable" in stages:
+                cleanup_event["disabled"] = result["disabled"]
+            with recorder.stage("dynamodb_cleanup:remove"):
+                invoke("dynamodb_cleanup", sfn_event(
+                    "dynamodb_cleanup", {"Input": cleanup_event}))
+
+        if "slack_notifier:status" in stages:
+            with recorder.stage("slack_notifier:status"):
+                invoke("slack_notifier", sfn_event(
+                    "send_status_to_slack",
+                    {"message_to_slack": "LDAP operations are complete"},
+                    execution_start))
+
+        trace = check_trace(os.environ["TRACE_DIR"], stages)
+
+    return {
+        "size": size,
+        "totals": query_result["query_results"]["totals"],
+        "stages": recorder.results,
+        "trace": trace,
+    }
+
+
+def format_calls(calls):
+    return ", ".join(f"{name}={count}" for name, count in sorted(calls.items()))
+
+
+def print_report(report):
+    print(f"\n== {report['size']} users (buckets: {report['totals']})")
+    print(f"{'stage':<26}{'wall s':>10}{'peak MB':>10}  calls")
+    for stage in report["stages"]:
+        calls = "; ".join(filter(None, (
+            format_calls(stage["aws_calls"]),
+            format_calls({f"ldap.{k}": v
+                          for k, v in stage["ldap_calls"].items()}),
+            format_calls({f"slack.{k}": v
+                          for k, v in stage["slack_calls"].items()}),
+        )))
+        print(f"{stage['stage']:<26}{stage['wall_seconds']:>10.3f}"
+              f"{stage['peak_rss_mb']:>10.1f}  {calls}")
+        timers = ", ".join(
+            f"{name}={value:.1f}ms"
+            for name, value in sorted(stage["timers_ms"].items())
+            if name != "handler")
+        if timers:
+            print(f"{'':<46}{timers}")
+    states = ", ".join(
+        f"{state}={value:.1f}ms"
+        for state, value in report["trace"]["states_ms"].items())
+    print(f"trace: {report['trace']['spans']} spans; {states}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000],
+        help="number of synthetic users to seed the directory with")
+    parser.add_argument(
+        "--stages", nargs="+", choices=STAGES, default=STAGES,
+        help="stages to benchmark, by default all of them")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    reports = []
+    # a fresh interpreter per size keeps imports and peak RSS independent
+    context = multiprocessing.get_context("spawn")
+    for size in args.sizes:
+        # not a multiprocessing.Pool, its daemonic workers can't fork the
+        # ldap query function's classify workers
+        with concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=context) as pool:
+            report = pool.submit(
+                run_size, size, args.seed, args.stages).result()
+        print_report(report)
+        reports.append(report)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(reports, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+"""
+In-memory stand-in for the parts of python-ldap used by the lambda functions.
+
+`install()` registers the fake `ldap` package in sys.modules so the lambda
+code can be imported and run unchanged against a `FakeDirectory` instead of
+a domain controller. Every operation is counted on the directory so the
+benchmark can report LDAP round trips alongside the AWS API calls.
+"""
+import collections
+import re
+import sys
+import types
+
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+
+MOD_ADD = 0
+MOD_DELETE = 1
+MOD_REPLACE = 2
+
+RES_SEARCH_ENTRY = 100
+RES_SEARCH_RESULT = 101
+RES_MODIFY = 103
+RES_ADD = 105
+
+# values of a multi valued attribute returned per search, like AD's
+# MaxValRange
+MAX_VAL_RANGE = 1500
+# paged searches a connection may keep open, AD's MaxResultSetsPerConn
+MAX_RESULT_SETS_PER_CONN = 10
+
+OPT_REFERRALS = 8
+OPT_NETWORK_TIMEOUT = 0x5005
+OPT_X_TLS_REQUIRE_CERT = 0x6006
+OPT_X_TLS_NEVER = 0
+
+
+class LDAPError(Exception):
+    pass
+
+
+class NO_SUCH_OBJECT(LDAPError):
+    pass
+
+
+class NO_SUCH_ATTRIBUTE(LDAPError):
+    pass
+
+
+class ALREADY_EXISTS(LDAPError):
+    pass
+
+
+class INVALID_CREDENTIALS(LDAPError):
+    pass
+
+
+class SERVER_DOWN(LDAPError):
+    pass
+
+
+class SIZELIMIT_EXCEEDED(LDAPError):
+    pass
+
+
+class FILTER_ERROR(LDAPError):
+    pass
+
+
+class BUSY(LDAPError):
+    pass
+
+
+class UNAVAILABLE(LDAPError):
+    pass
+
+
+class UNWILLING_TO_PERFORM(LDAPError):
+    pass
+
+
+class TIMEOUT(LDAPError):
+    pass
+
+
+class SimplePagedResultsControl:
+    """Stand-in for ldap.controls.SimplePagedResultsControl"""
+
+    controlType = "1.2.840.113556.1.4.319"
+
+    def __init__(self, criticality=False, size=10, cookie=""):
+        self.criticality = criticality
+        self.size = size
+        self.cookie = cookie
+
+
+def escape_filter_chars(assertion_value, escape_mode=0):
+    """Mirror of ldap.filter.escape_filter_chars for text values."""
+    for char, escaped in (("\\", r"\5c"), ("*", r"\2a"), ("(", r"\28"),
+                          (")", r"\29"), ("\x00", r"\00")):
+        assertion_value = assertion_value.replace(char, escaped)
+    return assertion_value
+
+
+def _unescape(value):
+    """Decode the \\xx escapes of a filter assertion value to bytes."""
+    return re.sub(
+        rb"\\([0-9a-fA-F]{2})",
+        lambda match: bytes([int(match.group(1), 16)]),
+        value.encode("utf-8"))
+
+
+def _compare(stored, asserted):
+    """Orders integer syntax values numerically and everything else bytewise"""
+    if stored.lstrip(b"-").isdigit() and asserted.lstrip(b"-").isdigit():
+        return (int(stored) > int(asserted)) - (int(stored) < int(asserted))
+    stored, asserted = stored.lower(), asserted.lower()
+    return (stored > asserted) - (stored < asserted)
+
+
+def _item_matcher(item):
+    match = re.match(r"^([\w.;-]+)(?::([\w.]*):)?(>=|<=|~=|=)(.*)$", item, re.S)
+    if not match:
+        raise FILTER_ERROR(item)
+    attribute, _rule, operator, value = match.groups()
+    attribute = attribute.lower()
+    if operator == "=" and value == "*":
+        return lambda entry: attribute in entry.index
+    if operator == "=" and "*" in value:
+        pieces = [_unescape(piece).lower() for piece in value.split("*")]
+
+        def substring(entry):
+            initial, *middle, final = pieces
+            for stored in entry.index.get(attribute, ()):
+                stored = stored.lower()
+                if not stored.startswith(initial):
+                    continue
+                position = len(initial)
+                for piece in middle:
+                    position = stored.find(piece, position)
+                    if position < 0:
+                        break
+                    position += len(piece)
+                if (position >= 0 and stored.endswith(final)
+                        and len(stored) - len(final) >= position):
+                    return True
+            return False
+        return substring
+    asserted = _unescape(value)
+    if operator == ">=":
+        return lambda entry: any(
+            _compare(stored, asserted) >= 0
+            for stored in entry.index.get(attribute, ()))
+    if operator == "<=":
+        return lambda entry: any(
+            _compare(stored, asserted) <= 0
+            for stored in entry.index.get(attribute, ()))
+    asserted = asserted.lower()
+    return lambda entry: any(
+        stored.lower() == asserted
+        for stored in entry.index.get(attribute, ()))
+
+
+def compile_filter(filter_string):
+    """Compile an RFC 4515 filter string into a predicate over entries."""
+    position = 0
+
+    def parse():
+        nonlocal position
+        if filter_string[position] != "(":
+            raise FILTER_ERROR(filter_string)
+        position += 1
+        operator = filter_string[position]
+        if operator in "&|":
+            position += 1
+            children = []
+            while filter_string[position] == "(":
+                children.append(parse())
+            position += 1
+            if operator == "&":
+                return lambda entry: all(child(entry) for child in children)
+            return lambda entry: any(child(entry) for child in children)
+        if operator == "!":
+            position += 1
+            child = parse()
+            position += 1
+            return lambda entry: not child(entry)
+        end = filter_string.index(")", position)
+        item = filter_string[position:end]
+        position = end + 1
+        return _item_matcher(item)
+
+    try:
+        return parse()
+    except (IndexError, ValueError):
+        raise FILTER_ERROR(filter_string)
+
+
+def _parent_dn(dn):
+    return dn.split(",", 1)[1] if "," in dn else ""
+
+
+class Entry:
+    """A directory object with a lower cased attribute index for matching"""
+
+    __slots__ = ("dn", "attributes", "index")
+
+    def __init__(self, dn, attributes):
+        self.dn = dn
+        self.attributes = attributes
+        self.reindex()
+
+    def reindex(self):
+        self.index = {
+            name.lower(): values for name, values in self.attributes.items()}
+        self.index["distinguishedname"] = [self.dn.encode("utf-8")]
+
+    def project(self, attrlist):
+        """
+        Copy of the attributes, as python-ldap never shares result lists.
+        Ranged attributes (member;range=0-*) return at most MAX_VAL_RANGE
+        values under the name of the range returned, e.g.
+        member;range=0-1499 or member;range=1500-*.
+        """
+        if not attrlist:
+            return {name: list(values)
+                    for name, values in self.attributes.items()}
+        wanted = {name.lower() for name in attrlist}
+        ranges = {}
+        for requested in attrlist:
+            match = re.match(r"^(.+);range=(\d+)-(\d+|\*)$", requested, re.I)
+            if match:
+                ranges[match.group(1).lower()] = int(match.group(2))
+        projected = {}
+        for name, values in self.attributes.items():
+            if name.lower() in ranges:
+                start = ranges[name.lower()]
+                end = start + MAX_VAL_RANGE
+                last = "*" if end >= len(values) else end - 1
+                projected[f"{name};range={start}-{last}"] = list(
+                    values[start:end])
+            elif name.lower() in wanted:
+                projected[name] = list(values)
+        return projected
+
+
+class FakeDirectory:
+    """An in-memory directory tree keyed by lower cased DN."""
+
+    def __init__(self, busy_every=0):
+        """
+        Every busy_every-th modify is rejected with BUSY, like a domain
+        controller that is hitting its admin limits.
+        """
+        self.entries = {}
+        self.counters = collections.Counter()
+        self.busy_every = busy_every
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, dn, attributes):
+        if dn.lower() in self.entries:
+            raise ALREADY_EXISTS({"desc": "Already exists", "matched": dn})
+        attributes = dict(attributes)
+        attributes.setdefault("distinguishedName", [dn.encode("utf-8")])
+        self.entries[dn.lower()] = Entry(dn, attributes)
+
+    def search(self, base, scope, filter_string, attrlist=None):
+        self.counters["search"] += 1
+        base = base.lower()
+        predicate = compile_filter(filter_string or "(objectClass=*)")
+        results = []
+        for key, entry in self.entries.items():
+            if scope == SCOPE_BASE and key != base:
+                continue
+            if scope == SCOPE_ONELEVEL and _parent_dn(key) != base:
+                continue
+            if scope == SCOPE_SUBTREE and not (
+                    key == base or key.endswith("," + base)):
+                continue
+            if predicate(entry):
+                results.append((entry.dn, entry.project(attrlist)))
+        self.counters["entries_returned"] += len(results)
+        return results
+
+    def modify(self, dn, modlist):
+        self.counters["modify"] += 1
+        if self.busy_every and self.counters["modify"] % self.busy_every == 0:
+            self.counters["busy"] += 1
+            raise BUSY({"desc": "Server is busy"})
+        entry = self.entries.get(dn.lower())
+        if entry is None:
+            raise NO_SUCH_OBJECT({"desc": "No such object", "matched": dn})
+        for operation, attribute, values in modlist:
+            current = next(
+                (name for name in entry.attributes
+                 if name.lower() == attribute.lower()), attribute)
+            values = list(values or [])
+            if operation == MOD_REPLACE:
+                entry.attributes[current] = values
+            elif operation == MOD_ADD:
+                entry.attributes.setdefault(current, []).extend(values)
+            elif operation == MOD_DELETE:
+                if not values:
+                    entry.attributes.pop(current, None)
+                else:
+                    stored = {
+                        value.lower()
+                        for value in entry.attributes.get(current, [])}
+                    lowered = {value.lower() for value in values}
+                    # the whole modify fails when a value is missing
+                    if not lowered <= stored:
+                        raise NO_SUCH_ATTRIBUTE({
+                            "desc": "No such attribute", "matched": dn})
+                    entry.attributes[current] = [
+                        value for value in entry.attributes.get(current, [])
+                        if value.lower() not in lowered]
+                    if current.lower() == "member":
+                        self._unlink_members(entry.dn, values)
+        entry.reindex()
+
+    def _unlink_members(self, group_dn, members):
+        """Maintains the memberOf back links of removed members"""
+        group = group_dn.encode("utf-8").lower()
+        for member in members:
+            entry = self.entries.get(member.decode("utf-8").lower())
+            if entry is None or "memberOf" not in entry.attributes:
+                continue
+            entry.attributes["memberOf"] = [
+                value for value in entry.attributes["memberOf"]
+                if value.lower() != group]
+            entry.reindex()
+
+
+class FakeConnection:
+    """Connection object returned by the fake ldap.initialize"""
+
+    def __init__(self, directory, uri):
+        self.directory = directory
+        self.uri = uri
+        self.bound = False
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who=None, cred=None):
+        self.directory.counters["bind"] += 1
+        self.bound = True
+
+    bind_s = simple_bind_s
+
+    def unbind(self):
+        self.bound = False
+
+    unbind_s = unbind
+
+    def search_s(self, base, scope, filterstr=None, attrlist=None,
+                 attrsonly=0):
+        return self.directory.search(base, scope, filterstr, attrlist)
+
+    def add_s(self, dn, modlist):
+        self.directory.counters["add"] += 1
+        self.directory.add(dn, {name: list(values)
+                                for name, values in modlist})
+
+    def modify_s(self, dn, modlist):
+        self.directory.modify(dn, modlist)
+
+    def search_ext(self, base, scope, filterstr=None, attrlist=None,
+                   attrsonly=0, serverctrls=None, clientctrls=None,
+                   timeout=-1, sizelimit=0):
+        """
+        Asynchronous search whose messages are read with result3, paged
+        when serverctrls hold a SimplePagedResultsControl. Like AD, a new
+        paged search is refused while MAX_RESULT_SETS_PER_CONN others are
+        still open on the connection.
+        """
+        self._paged = getattr(self, "_paged", {})
+        self._messages = getattr(self, "_messages", {})
+        control = next((
+            control for control in serverctrls or ()
+            if isinstance(control, SimplePagedResultsControl)), None)
+        if control is not None and control.cookie:
+            remaining = self._paged.pop(control.cookie)
+        elif (control is not None and
+              len(self._paged) >= MAX_RESULT_SETS_PER_CONN):
+            raise UNWILLING_TO_PERFORM(
+                {"desc": "Server is unwilling to perform"})
+        else:
+            remaining = collections.deque(
+                self.directory.search(base, scope, filterstr, attrlist))
+        messages = collections.deque()
+        count = control.size if control is not None else len(remaining)
+        while count and remaining:
+            messages.append((RES_SEARCH_ENTRY, [remaining.popleft()], []))
+            count -= 1
+        controls = []
+        if control is not None:
+            cookie = b""
+            if remaining:
+                cookie = str(len(self._paged) + 1).encode()
+                while cookie in self._paged:
+                    cookie += b"+"
+                self._paged[cookie] = remaining
+            controls.append(SimplePagedResultsControl(
+                control.criticality, control.size, cookie))
+        messages.append((RES_SEARCH_RESULT, [], controls))
+        msgid = len(self._messages) + 1
+        while msgid in self._messages:
+            msgid += 1
+        self._messages[msgid] = messages
+        return msgid
+
+    def result3(self, msgid=-1, all=1, timeout=None):
+        """Returns the next message of a search_ext, one at a time"""
+        messages = self._messages[msgid]
+        result_type, data, controls = messages.popleft()
+        if not messages:
+            del self._messages[msgid]
+        return result_type, data, msgid, controls
+
+    def _start(self, result_type, operation, *args):
+        """Runs operation and keeps its outcome for result()"""
+        self._pending = getattr(self, "_pending", {})
+        msgid = len(self._pending) + 1
+        while msgid in self._pending:
+            msgid += 1
+        try:
+            operation(*args)
+            self._pending[msgid] = (result_type, None)
+        except LDAPError as error:
+            self._pending[msgid] = (result_type, error)
+        return msgid
+
+    def add(self, dn, modlist):
+        """Asynchronous add, the outcome is reported by result()"""
+        return self._start(RES_ADD, self.add_s, dn, modlist)
+
+    def modify(self, dn, modlist):
+        """Asynchronous modify, the outcome is reported by result()"""
+        return self._start(RES_MODIFY, self.modify_s, dn, modlist)
+
+    def result(self, msgid=-1, all=1, timeout=None):
+        result_type, error = self._pending.pop(msgid)
+        if error is not None:
+            raise error
+        return (result_type, [])
+
+
+class AsyncSearchList:
+    """Stand-in for ldap.asyncsearch.List"""
+
+    SIZELIMIT_EXCEEDED = SIZELIMIT_EXCEEDED
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._search = None
+        self._pending = None
+        self.allResults = []
+
+    def startSearch(self, searchRoot, searchScope, filterStr,
+                    attrList=None, attrsOnly=0, timeout=-1, sizelimit=0,
+                    serverctrls=None, clientctrls=None):
+        self._search = (searchRoot, searchScope, filterStr, attrList)
+
+    def processResults(self, ignoreResultsNumber=0, processResultsCount=0,
+                       timeout=-1):
+        """
+        Appends up to processResultsCount entries (all when 0) to
+        allResults, returns 1 while there are more.
+        """
+        if self._pending is None:
+            self._pending = collections.deque(
+                self._connection.directory.search(*self._search))
+        count = processResultsCount or len(self._pending)
+        while count and self._pending:
+            self.allResults.append(
+                (RES_SEARCH_ENTRY, self._pending.popleft()))
+            count -= 1
+        return 1 if self._pending else 0
+
+
+def addModlist(entry, ignore_attr_types=None):
+    return [(name, values) for name, values in entry.items() if values]
+
+
+def install(directory):
+    """Register the fake ldap modules, bound to directory, in sys.modules."""
+    ldap = types.ModuleType("ldap")
+    for name, value in list(globals().items()):
+        if name.isupper() or (
+                isinstance(value, type) and issubclass(value, LDAPError)):
+            setattr(ldap, name, value)
+    ldap.set_option = lambda option, value: None
+    ldap.initialize = lambda uri, **kwargs: FakeConnection(directory, uri)
+
+    controls = types.ModuleType("ldap.controls")
+    controls.SimplePagedResultsControl = SimplePagedResultsControl
+    asyncsearch = types.ModuleType("ldap.asyncsearch")
+    asyncsearch.List = AsyncSearchList
+    ldap_filter = types.ModuleType("ldap.filter")
+    ldap_filter.escape_filter_chars = escape_filter_chars
+    modlist = types.ModuleType("ldap.modlist")
+    modlist.addModlist = addModlist
+
+    ldap.asyncsearch = asyncsearch
+    ldap.controls = controls
+    ldap.filter = ldap_filter
+    ldap.modlist = modlist
+    sys.modules.update({
+        "ldap": ldap,
+        "ldap.asyncsearch": asyncsearch,
+        "ldap.controls": controls,
+        "ldap.filter": ldap_filter,
+        "ldap.modlist": modlist,
+    })
+    return ldap
@@ -0,0 +1,168 @@
+"""
+Import time budgets of the ldap maintainer lambda handlers.
+
+Every handler module is loaded in a fresh interpreter under
+`python -X importtime`, the way the lambda runtime loads it on a cold
+start, with the environment of the benchmark. The check fails when the
+imports of a handler take longer than its budget and lists the imports
+that cost the most.
+
+usage:
+    pip install -r tests/benchmark/requirements.txt
+    python tests/benchmark/importtime.py --budget 500 \\
+        --budget slack_notifier=100 --repeat 3
+
+python-ldap is replaced by the benchmark's fake ldap package when it isn't
+installed, its import time is then not part of the ldap query function's.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+import bench
+
+HANDLERS = ("ldap_query", "slack_notifier", "slack_listener",
+            "dynamodb_cleanup")
+# milliseconds of imports a handler may take, --budget overrides them.
+# The notifier defers the slack SDK and boto3 to the first message sent.
+DEFAULT_BUDGET_MS = 600
+BUDGETS_MS = {"slack_notifier": 100}
+MARKER = "importtime: handler"
+
+# runs in the measured interpreter: anything imported before the marker,
+# e.g. the fake ldap package, is not counted
+LOADER = """
+import importlib.util
+import sys
+
+sys.path[:0] = {paths!r}
+if {fake_ldap!r} and importlib.util.find_spec("ldap") is None:
+    import fake_ldap
+    fake_ldap.install(fake_ldap.FakeDirectory())
+sys.stderr.write({marker!r} + "\\n")
+spec = importlib.util.spec_from_file_location({name!r}, {path!r})
+module = importlib.util.module_from_spec(spec)
+sys.modules[{name!r}] = module
+spec.loader.exec_module(module)
+"""
+
+
+def get_source(name):
+    source = bench.FUNCTIONS_DIR / name / "src"
+    return source if source.is_dir() else bench.FUNCTIONS_DIR / name
+
+
+def parse_importtime(output):
+    """
+    Returns the (module, self us, cumulative us) of the imports the
+    handler made itself, those that -X importtime reports after the marker
+    at the top level of its import tree.
+    """
+    imports = []
+    measuring = False
+    for line in output.splitlines():
+        if line == MARKER:
+            measuring = True
+            continue
+        if not measuring or not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # the header line
+            continue
+        name = fields[2].rstrip()
+        # nested imports are indented by two spaces per level
+        if name[1:2] == " ":
+            continue
+        imports.append(
+            (name.strip(), int(fields[0]), int(fields[1])))
+    if not measuring:
+        raise RuntimeError(f"handler import failed:\n{output}")
+    return imports
+
+
+def measure(name, fake_ldap=True):
+    """Returns the top level imports of a handler's cold start"""
+    source = get_source(name)
+    loader = LOADER.format(
+        paths=[str(source), str(bench.COMMON_LAYER_DIR),
+               str(bench.BENCHMARK_DIR)],
+        fake_ldap=fake_ldap,
+        marker=MARKER,
+        name=name,
+        path=str(source / "lambda.py"))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", loader],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, env=os.environ.copy())
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"importing {name} failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def parse_budgets(values):
+    """
+    Returns the default budget and the budgets by handler, in ms. A
+    default given on the command line replaces BUDGETS_MS.
+    """
+    default = None
+    budgets = {}
+    for value in values or ():
+        name, _, budget = value.rpartition("=")
+        if name and name not in HANDLERS:
+            raise ValueError(f"unknown handler {name}")
+        if name:
+            budgets[name] = float(budget)
+        else:
+            default = float(budget)
+    if default is None:
+        return DEFAULT_BUDGET_MS, dict(BUDGETS_MS, **budgets)
+    return default, budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--budget", action="append",
+        help="import time budget in ms, for every handler (500) or one of "
+             "them (slack_notifier=100), may be repeated")
+    parser.add_argument(
+        "--handlers", nargs="+", choices=HANDLERS, default=HANDLERS)
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="cold starts per handler, the fastest one is checked")
+    parser.add_argument(
+        "--top", type=int, default=5,
+        help="number of the most expensive imports listed per handler")
+    args = parser.parse_args()
+    try:
+        default, budgets = parse_budgets(args.budget)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # the handlers read their configuration at import time
+    bench.set_environment("http://127.0.0.1:9/")
+    over = []
+    print(f"{'handler':<20}{'import ms':>10}{'budget ms':>10}  slowest")
+    for name in args.handlers:
+        runs = [measure(name) for _ in range(max(args.repeat, 1))]
+        imports = min(runs, key=lambda run: sum(us for _, _, us in run))
+        total_ms = sum(us for _, _, us in imports) / 1000
+        budget = budgets.get(name, default)
+        slowest = ", ".join(
+            f"{module}={us / 1000:.1f}"
+            for module, _, us in sorted(
+                imports, key=lambda item: item[2], reverse=True)[:args.top])
+        print(f"{name:<20}{total_ms:>10.1f}{budget:>10.0f}  {slowest}")
+        if total_ms > budget:
+            over.append(name)
+    if over:
+        print(f"over budget: {', '.join(over)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
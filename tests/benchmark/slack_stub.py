@@ -0,0 +1,90 @@
+"""
+Stub of the slack web api served over HTTP on localhost.
+
+The notifier's slack.WebClient and the listener's urllib calls are pointed
+at this server through SLACK_API_URL, and interaction response_urls are
+generated against it, so slack traffic is exercised (and counted) end to
+end without reaching slack.
+"""
+import collections
+import http.server
+import json
+import threading
+import time
+from urllib.parse import parse_qs
+
+
+class SlackStub:
+    """Records every slack api call and answers with canned responses."""
+
+    def __init__(self, channel="CBENCHMARK", user_email=None):
+        self.channel = channel
+        self.user_email = user_email
+        self.calls = collections.Counter()
+        self.payload_bytes = 0
+        # the arguments of every chat.postMessage call
+        self.messages = []
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/api/"
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                self._respond(body)
+
+            def do_GET(self):
+                self._respond(self.path.partition("?")[2].encode("utf-8"))
+
+            def _respond(self, body):
+                method = self.path.split("?")[0].rsplit("/", 1)[-1]
+                stub.calls[method] += 1
+                stub.payload_bytes += len(body)
+                response = json.dumps(stub.respond(method, body))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response.encode("utf-8"))
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def parse_arguments(body):
+        """Returns the arguments of a json or form encoded api call"""
+        text = body.decode("utf-8")
+        try:
+            return json.loads(text)
+        except ValueError:
+            return {
+                key: values[0] for key, values in parse_qs(text).items()}
+
+    def respond(self, method, body):
+        if method == "chat.postMessage":
+            self.messages.append(self.parse_arguments(body))
+        if method == "users.info":
+            user_id = parse_qs(body.decode("utf-8")).get("user", [""])[0]
+            return {
+                "ok": True,
+                "user": {
+                    "id": user_id,
+                    "profile": {"email": self.user_email}
+                }
+            }
+        return {"ok": True, "channel": self.channel, "ts": f"{time.time():.6f}"}
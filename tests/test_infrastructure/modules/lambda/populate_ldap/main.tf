@@ -45,9 +45,10 @@ module "lambda" {
   description   = "Creates test users in standalone simplead instance"
   handler       = "lambda.handler"
   runtime       = "python3.7"
-  timeout       = 30
+  # loading a synthetic directory takes far longer than the test users
+  timeout       = var.synthetic_user_count > 0 ? 900 : 30
 
-  source_path = "${path.module}/lambda.py"
+  source_path = "${path.module}/src"
 
   environment = {
     variables = {
@@ -57,6 +58,11 @@ module "lambda" {
       SVC_USER_PWD = var.svc_user_pwd
       LOG_LEVEL    = var.log_level
       TEST_USERS   = jsonencode(var.test_users)
+
+      SYNTHETIC_USER_COUNT = var.synthetic_user_count
+      SYNTHETIC_SEED       = var.synthetic_seed
+      DISABLE_USER_COUNT   = var.disable_user_count
+      BULK_ADD_WINDOW      = var.bulk_add_window
     }
   }
 
@@ -3,6 +3,7 @@ import json
 import logging
 import os
 import random
+from collections import deque
 from datetime import datetime
 from time import sleep
 
@@ -10,8 +11,13 @@ import ldap
 import ldap.asyncsearch
 import ldap.modlist
 
+from synthetic_directory import (
+    HANDS_OFF_ACCOUNTS,
+    generate_users,
+    without_system_attributes
+)
 
-DEFAULT_LOG_LEVEL = logging.DEBUG
+DEFAULT_LOG_LEVEL = logging.INFO
 LOG_LEVELS = collections.defaultdict(
     lambda: DEFAULT_LOG_LEVEL,
     {
@@ -46,6 +52,11 @@ LDAPS_URL = os.environ['LDAPS_URL']
 DOMAIN_BASE = os.environ['DOMAIN_BASE']
 SVC_USER_DN = os.environ['SVC_USER_DN']
 SVC_USER_PWD = os.environ['SVC_USER_PWD']
+SYNTHETIC_USER_COUNT = int(os.environ.get('SYNTHETIC_USER_COUNT', 0))
+SYNTHETIC_SEED = int(os.environ.get('SYNTHETIC_SEED', 0))
+DISABLE_USER_COUNT = int(os.environ.get('DISABLE_USER_COUNT', 5))
+# number of add operations kept in flight by the bulk loader
+BULK_ADD_WINDOW = int(os.environ.get('BULK_ADD_WINDOW', 64))
 
 
 class LdapMaintainer:
@@ -150,6 +161,37 @@ class LdapMaintainer:
             except ldap.ALREADY_EXISTS:
                 continue
 
+    def bulk_add_users(self, users, window=BULK_ADD_WINDOW):
+        """
+        Pipelines asynchronous adds, keeping up to window operations in
+        flight instead of waiting on a round trip per user.
+        Returns a counter of added and already existing users.
+        """
+        con = self.connect()
+        in_flight = deque()
+        counts = collections.Counter()
+
+        def collect():
+            msgid = in_flight.popleft()
+            try:
+                con.result(msgid)
+                counts['added'] += 1
+            except ldap.ALREADY_EXISTS:
+                counts['already_exists'] += 1
+
+        for user_obj in users:
+            in_flight.append(con.add(
+                user_obj['dn'],
+                ldap.modlist.addModlist(user_obj['user'])))
+            if len(in_flight) >= window:
+                collect()
+        while in_flight:
+            collect()
+        log.info(
+            f"Added {counts['added']} users, "
+            f"{counts['already_exists']} already existed")
+        return counts
+
     @staticmethod
     def ldap_retry(func, max_tries=4, sleep_time=2):
         """ldap retry function with back off timer
@@ -172,12 +214,12 @@ class LdapMaintainer:
                 sleep(sleep_time)
                 sleep_time *= 2
 
-    def disable_random_users(self, user_list):
+    def disable_random_users(self, user_list, count=DISABLE_USER_COUNT):
         con = self.connect()
         date = datetime.now().strftime("%Y-%m-%d-T%H%M")
         d = f"***Disabled {date} by ldapmaintbot***"
-        # get a random list of 5 users and disable them
-        random_list = random.sample(user_list, 5)
+        # get a random list of users and disable them
+        random_list = random.sample(user_list, min(count, len(user_list)))
         for user_obj in random_list:
             disable_user = [(
                 ldap.MOD_REPLACE,
@@ -265,10 +307,31 @@ def generate_test_user_objects(test_users):
     return user_list
 
 
+def sample_users(users, indices, sample):
+    """Passes users through, appending the ones at indices to sample"""
+    for index, user_obj in enumerate(users):
+        if index in indices:
+            sample.append(user_obj)
+        yield user_obj
+
+
 def handler(event, context):
+    ldap_maint = LdapMaintainer()
+    if SYNTHETIC_USER_COUNT:
+        users = without_system_attributes(
+            generate_users(SYNTHETIC_USER_COUNT, DOMAIN_BASE, SYNTHETIC_SEED))
+        # keep only the users that will be disabled rather than the
+        # whole directory, never picking a hands off account
+        candidates = range(len(HANDS_OFF_ACCOUNTS), SYNTHETIC_USER_COUNT)
+        rng = random.Random(SYNTHETIC_SEED)
+        indices = set(rng.sample(
+            candidates, min(DISABLE_USER_COUNT, len(candidates))))
+        disable = []
+        ldap_maint.bulk_add_users(sample_users(users, indices, disable))
+        ldap_maint.disable_random_users(disable)
+        return
     # http://listofrandomnames.com/index.cfm
     test_users = json.loads(os.environ['TEST_USERS'])
     users = generate_test_user_objects(test_users)
-    ldap_maint = LdapMaintainer()
     ldap_maint.add_users(users)
     ldap_maint.disable_random_users(users)
@@ -0,0 +1,285 @@
+"""
+Seeded, streaming generator of realistic synthetic directory users.
+
+Users are generated one at a time so arbitrarily large fixtures can be
+written straight to LDIF (for slapadd) or pipelined into a live directory
+without ever being held in memory. The same seed always produces the same
+directory.
+
+usage:
+    python synthetic_directory.py --count 1000000 \
+        --domain-base DC=foo,DC=bar,DC=com > users.ldif
+"""
+import argparse
+import base64
+import random
+import struct
+import sys
+import time
+
+# January 1, 1970 as MS file time
+EPOCH_AS_FILETIME = 116444736000000000
+HUNDREDS_OF_NANOSECONDS = 10000000
+
+FIRST_NAMES = [
+    "Adam", "Alice", "Amir", "Ana", "Ben", "Carla", "Chen", "Chris", "Dana",
+    "David", "Elena", "Emma", "Fatima", "Frank", "Grace", "Hana", "Igor",
+    "Isla", "Jane", "John", "Juan", "Kai", "Laura", "Liam", "Maria", "Mei",
+    "Nadia", "Noah", "Olga", "Omar", "Paul", "Priya", "Quinn", "Rosa", "Sam",
+    "Sofia", "Tom", "Uma", "Victor", "Wen", "Xavier", "Yara", "Zoe",
+]
+
+LAST_NAMES = [
+    "Adams", "Baker", "Chen", "Clarkson", "Diaz", "Dickens", "Evans",
+    "Garcia", "Haddad", "Ivanov", "Johnson", "Kim", "Kowalski", "Lee",
+    "Mathis", "Morgan", "Nguyen", "Novak", "Ogden", "Okafor", "Paige",
+    "Patel", "Rossi", "Sato", "Schmidt", "Silva", "Smith", "Terry", "Tran",
+    "Walker", "Wang", "Yilmaz",
+]
+
+# accounts that exist in every directory and must never be touched
+HANDS_OFF_ACCOUNTS = [
+    "Administrator",
+    "Guest",
+    "AWS_WorkSpacesAdmin",
+    "AWS_WorkMail_Consul",
+    "krbtgt",
+]
+
+# (weight, minimum age, maximum age) of a user's password in days, None
+# for passwords that have never been set
+DEFAULT_PASSWORD_AGES = [
+    (55, 0, 59),
+    (12, 60, 89),
+    (8, 90, 119),
+    (15, 120, 365),
+    (7, 366, 2000),
+    (3, None, None),
+]
+
+# weights of the userAccountControl values users are created with
+# https://jackstromberg.com/2013/01/useraccountcontrol-attributeflag-values/
+DEFAULT_UAC_WEIGHTS = {
+    "512": 80,     # Enabled Account
+    "514": 8,      # Disabled Account
+    "66048": 6,    # Enabled, Password Doesn't Expire
+    "66050": 2,    # Disabled, Password Doesn't Expire
+    "544": 2,      # Enabled, Password Not Required
+    "262656": 1,   # Enabled, Smartcard Required
+    "4096": 1,     # Workstation trust account
+}
+
+# weights of the three letter sAMAccountName prefixes, "" for none
+DEFAULT_PREFIX_WEIGHTS = {
+    "": 90,
+    "svc": 5,
+    "adm": 3,
+    "tst": 2,
+}
+
+# share of users described as test accounts
+TEST_ACCOUNT_RATE = 0.01
+
+# attributes that a domain controller assigns itself and rejects on add
+SYSTEM_ATTRIBUTES = ("objectGUID", "objectSid", "pwdLastSet")
+
+
+def _weighted(weights):
+    """Returns (population, cumulative weights) for random.choices"""
+    population = list(weights)
+    cumulative = []
+    total = 0
+    for value in population:
+        total += weights[value]
+        cumulative.append(total)
+    return population, cumulative
+
+
+def get_domain_sid(rng):
+    """Returns the three sub authorities of a random domain SID"""
+    return tuple(rng.getrandbits(32) for _ in range(3))
+
+
+def encode_sid(domain_sid, rid):
+    """Binary encoding of S-1-5-21-<domain_sid>-<rid>"""
+    sub_authorities = (21,) + domain_sid + (rid,)
+    return (
+        struct.pack("<BB", 1, len(sub_authorities)) +
+        (5).to_bytes(6, "big") +
+        struct.pack(f"<{len(sub_authorities)}I", *sub_authorities)
+    )
+
+
+def days_to_filetime(now, days):
+    return int(
+        (now - days * 86400) * HUNDREDS_OF_NANOSECONDS) + EPOCH_AS_FILETIME
+
+
+def generate_users(
+    count,
+    domain_base,
+    seed=0,
+    password_ages=DEFAULT_PASSWORD_AGES,
+    uac_weights=DEFAULT_UAC_WEIGHTS,
+    prefix_weights=DEFAULT_PREFIX_WEIGHTS,
+    hands_off_accounts=HANDS_OFF_ACCOUNTS,
+    now=None
+):
+    """
+    Lazily yields count byte encoded user objects, starting with the hands
+    off accounts.
+
+    output:
+
+    {
+        "dn" = "CN=Jane Doe 1b,CN=Users,DC=foo,DC=bar,DC=com",
+        "user" = {
+            "givenName": [b'Jane']
+            ...
+        }
+    }
+    """
+    rng = random.Random(seed)
+    now = time.time() if now is None else now
+    domain_sid = get_domain_sid(rng)
+    ages, age_weights = _weighted({
+        index: age[0] for index, age in enumerate(password_ages)})
+    uacs, uac_cumulative = _weighted(uac_weights)
+    prefixes, prefix_cumulative = _weighted(prefix_weights)
+    users_dn = f"CN=Users,{domain_base}"
+
+    for index in range(count):
+        # RIDs below 1000 are reserved for well known principals
+        rid = 1000 + index
+        if index < len(hands_off_accounts):
+            name = hands_off_accounts[index]
+            given_name, surname = name, ""
+            sam_name = name
+            uac = "66048"
+        else:
+            given_name = rng.choice(FIRST_NAMES)
+            surname = rng.choice(LAST_NAMES)
+            # the index keeps names unique however large the directory
+            name = f"{given_name} {surname} {index:x}"
+            prefix = rng.choices(prefixes, cum_weights=prefix_cumulative)[0]
+            sam_name = f"{prefix}{given_name}.{surname}{index:x}".lower()
+            uac = rng.choices(uacs, cum_weights=uac_cumulative)[0]
+
+        _, min_age, max_age = password_ages[
+            rng.choices(ages, cum_weights=age_weights)[0]]
+        if min_age is None:
+            pwd_last_set = 0
+        else:
+            pwd_last_set = days_to_filetime(
+                now, rng.uniform(min_age, max_age + 1))
+        if rng.random() < TEST_ACCOUNT_RATE:
+            description = "Test account"
+        else:
+            description = f"Synthetic account {index}"
+
+        user = {
+            "cn": [name],
+            "displayName": [name],
+            "description": [description],
+            "givenName": [given_name],
+            "mail": [f"{sam_name}@{domain_base_to_dns(domain_base)}"],
+            "name": [name],
+            "objectClass": [
+                "top",
+                "person",
+                "organizationalPerson",
+                "user"
+            ],
+            "pwdLastSet": [str(pwd_last_set)],
+            "sAMAccountName": [sam_name],
+            "userAccountControl": [uac],
+        }
+        if surname:
+            user["sn"] = [surname]
+        user = {
+            attribute: [value.encode("utf-8") for value in values]
+            for attribute, values in user.items()
+        }
+        user["objectGUID"] = [rng.getrandbits(128).to_bytes(16, "little")]
+        user["objectSid"] = [encode_sid(domain_sid, rid)]
+        yield {"dn": f"CN={name},{users_dn}", "user": user}
+
+
+_dns_cache = {}
+
+
+def domain_base_to_dns(domain_base):
+    """DC=foo,DC=bar,DC=com -> foo.bar.com"""
+    dns = _dns_cache.get(domain_base)
+    if dns is None:
+        dns = _dns_cache[domain_base] = ".".join(
+            part.split("=", 1)[1] for part in domain_base.split(",")
+            if part.strip().upper().startswith("DC="))
+    return dns
+
+
+def without_system_attributes(users):
+    """Drops the attributes a domain controller won't accept on add"""
+    for user_obj in users:
+        yield {
+            "dn": user_obj["dn"],
+            "user": {
+                attribute: values
+                for attribute, values in user_obj["user"].items()
+                if attribute not in SYSTEM_ATTRIBUTES
+            }
+        }
+
+
+def _is_ldif_safe(value):
+    # RFC 2849 SAFE-STRING: no NUL/CR/LF, no leading space, colon or <
+    # and no trailing space, ASCII only
+    return bool(value) and value.isascii() and not (
+        value[:1] in b" :<" or value.endswith(b" ") or
+        any(byte in value for byte in b"\x00\r\n"))
+
+
+def _fold(line, width=76):
+    """Fold a LDIF line into continuation lines of width characters"""
+    if len(line) <= width:
+        return line + "\n"
+    lines = [line[:width]]
+    for start in range(width, len(line), width - 1):
+        lines.append(" " + line[start:start + width - 1])
+    return "\n".join(lines) + "\n"
+
+
+def write_ldif(users, stream):
+    """Writes users to stream as LDIF content records, returns the count"""
+    written = 0
+    for user_obj in users:
+        stream.write(_fold(f"dn: {user_obj['dn']}"))
+        for attribute, values in user_obj["user"].items():
+            for value in values:
+                if _is_ldif_safe(value):
+                    stream.write(_fold(f"{attribute}: {value.decode()}"))
+                else:
+                    encoded = base64.b64encode(value).decode()
+                    stream.write(_fold(f"{attribute}:: {encoded}"))
+        stream.write("\n")
+        written += 1
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--count", type=int, required=True)
+    parser.add_argument("--domain-base", required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-system-attributes", action="store_true",
+        help="omit attributes the DC assigns itself (objectGUID, ...)")
+    args = parser.parse_args()
+    users = generate_users(args.count, args.domain_base, seed=args.seed)
+    if args.no_system_attributes:
+        users = without_system_attributes(users)
+    write_ldif(users, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -45,4 +45,28 @@ variable "test_users" {
   default     = []
   type        = list(string)
   description = "List of test users in Firstname Lastname format"
-}
\ No newline at end of file
+}
+
+variable "synthetic_user_count" {
+  default     = 0
+  description = "Number of synthetic users to generate and load instead of test_users, 0 to disable"
+  type        = number
+}
+
+variable "synthetic_seed" {
+  default     = 0
+  description = "Seed of the synthetic directory generator"
+  type        = number
+}
+
+variable "disable_user_count" {
+  default     = 5
+  description = "Number of randomly selected users to disable after loading"
+  type        = number
+}
+
+variable "bulk_add_window" {
+  default     = 64
+  description = "Number of add operations the synthetic bulk loader keeps in flight"
+  type        = number
+}
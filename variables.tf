@@ -5,7 +5,13 @@ variable "project_name" {
 }
 
 variable "ldaps_url" {
-  description = "LDAPS URL for the target domain"
+  description = "LDAPS URL for the target domain, or a comma separated list of the URLs of its domain controllers"
+  type        = string
+}
+
+variable "ldap_srv_domain" {
+  default     = ""
+  description = "DNS name of the domain whose SRV records list the domain controllers to use instead of ldaps_url, requires dnspython in the python-ldap layer"
   type        = string
 }
 
@@ -39,18 +45,66 @@ variable "slack_channel_id" {
   type        = string
 }
 
+variable "post_user_details" {
+  default     = true
+  description = "Post the users that will be disabled as threaded replies to the slack report"
+  type        = bool
+}
+
+variable "user_details_max_pages" {
+  default     = 10
+  description = "Maximum number of threaded messages used to list users, 0 for no limit"
+  type        = number
+}
+
 variable "log_level" {
   default     = "Info"
   description = "Log level of the lambda output, one of: Debug, Info, Warning, Error, or Critical"
   type        = string
 }
 
+variable "log_sample_rate" {
+  default     = 1000
+  description = "Only one in this many users is logged by the ldap query function at the Debug log level"
+  type        = number
+}
+
+variable "profiler" {
+  default     = ""
+  description = "Profiles every lambda invocation and uploads the result to the profiles/ prefix of the artifacts bucket when set, one of: cprofile or sampling"
+  type        = string
+}
+
+variable "trace_exporter" {
+  default     = "log"
+  description = "Where the lambda functions export the spans of every invocation, one of: log (the function's log, as OTLP/JSON), file or none"
+  type        = string
+}
+
+variable "metrics_namespace" {
+  default     = "LdapMaintainer"
+  description = "CloudWatch namespace of the embedded metrics emitted by the lambda functions"
+  type        = string
+}
+
 variable "slack_signing_secret" {
   default     = ""
   description = "The slack application's signing secret"
   type        = string
 }
 
+variable "slack_signing_secret_ssm_key" {
+  default     = ""
+  description = "SSM parameter key that contains the slack signing secret, takes precedence over slack_signing_secret"
+  type        = string
+}
+
+variable "approver_group_dn" {
+  default     = ""
+  description = "Distinguished name of the group whose members may approve or deny disabling users, empty to allow anyone in the slack channel"
+  type        = string
+}
+
 variable "filter_prefixes" {
   default     = []
   description = "List of three letter user name prefixes to filter out of the user search results"
@@ -65,4 +119,70 @@ variable "dynamodb_table_name" {
 variable "tags" {
   type    = map(string)
   default = {}
-}
\ No newline at end of file
+}
+
+variable "shard_strategy" {
+  default     = "ou"
+  description = "How the directory scan is split into shards, one of: ou (one shard per top level OU or container), prefix (sAMAccountName initial ranges) or none"
+  type        = string
+}
+
+variable "shard_count" {
+  default     = 8
+  description = "Number of sAMAccountName initial ranges scanned when shard_strategy is prefix"
+  type        = number
+}
+
+variable "shard_concurrency" {
+  default     = 10
+  description = "Maximum number of shards scanned at the same time, 0 for no limit"
+  type        = number
+}
+
+variable "directories" {
+  default     = []
+  description = "Directories maintained by the deployment, each a map of name, ldaps_url, domain_base, svc_user_dn, ssm_key and optionally ldap_srv_domain and approver_group_dn. Fields left out fall back to the deployment's own directory, an empty list maintains only that one"
+  type        = list(map(string))
+}
+
+variable "directory_concurrency" {
+  default     = 0
+  description = "Maximum number of directories scanned or disabled at the same time, 0 for no limit"
+  type        = number
+}
+
+variable "disable_rate" {
+  default     = 25
+  description = "Maximum number of accounts disabled per second"
+  type        = number
+}
+
+variable "disable_max_concurrency" {
+  default     = 8
+  description = "Maximum number of disable requests in flight at once, the actual number adapts to how busy the domain controller is"
+  type        = number
+}
+
+variable "classify_workers" {
+  default     = 0
+  description = "Worker processes that decode and classify the users while the directory is searched, 0 does it in the handler. Only useful with a memory_size that comes with several vCPUs"
+  type        = number
+}
+
+variable "ldap_query_memory_size" {
+  default     = 128
+  description = "Memory size of the ldap query function in MB, lambda allocates vCPUs in proportion to it (6 at 10240MB)"
+  type        = number
+}
+
+variable "search_connections" {
+  default     = 0
+  description = "Connections over which the query action searches every top level OU and container concurrently, 0 searches the whole domain in a single request"
+  type        = number
+}
+
+variable "remove_group_memberships" {
+  default     = false
+  description = "Remove the disabled users from the groups they are members of"
+  type        = bool
+}